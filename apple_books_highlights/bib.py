@@ -2,11 +2,52 @@
 Handles BibTeX parsing and metadata matching.
 """
 import re
+import unicodedata
 import bibtexparser
 from bibtexparser.bparser import BibTexParser
 from bibtexparser.customization import convert_to_unicode
 from thefuzz import fuzz
-from typing import List, Optional, Dict, Any
+from typing import Iterable, List, Optional, Dict, Any
+
+# marks an exact key shared by several entries, which can't decide a match
+AMBIGUOUS = object()
+
+
+def normalize_isbn(value: str) -> Optional[str]:
+    """Returns the ISBN-13 for an ISBN-10 or ISBN-13 in any formatting, else None."""
+    digits = re.sub(r'[^0-9Xx]', '', value or '').upper()
+    if len(digits) == 10 and digits[:9].isdigit():
+        core = '978' + digits[:9]
+        check = (10 - sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(core)) % 10) % 10
+        return core + str(check)
+    if len(digits) == 13 and digits.isdigit():
+        return digits
+    return None
+
+
+def normalize_doi(value: str) -> Optional[str]:
+    value = (value or '').strip().lower()
+    value = re.sub(r'^(https?://(dx\.)?doi\.org/|doi:\s*)', '', value)
+    return value if value.startswith('10.') else None
+
+
+def normalize_title(title: str) -> str:
+    """Lower-cases, strips accents, braces and punctuation, and collapses spaces."""
+    title = unicodedata.normalize('NFKD', title or '')
+    title = ''.join(c for c in title if not unicodedata.combining(c))
+    title = re.sub(r'[^\w\s]', ' ', title.lower())
+    return ' '.join(title.split())
+
+
+def main_title(title: str) -> str:
+    """The title without its subtitle."""
+    return re.split(r'\s*(?::|\s[-–—]\s)', title or '', maxsplit=1)[0]
+
+
+def last_name(author: str) -> str:
+    words = normalize_title(author).split()
+    return words[-1] if words else ''
+
 
 class BibTexLibrarian:
     """Manages loading, searching, and normalizing a BibTeX library."""
@@ -19,6 +60,16 @@ class BibTexLibrarian:
             bibtex_path: The path to the .bib file.
         """
         self.db = self._load_bibtex(bibtex_path)
+        # Exact-key indexes, consulted before fuzzy matching
+        self._by_asset_id: Dict[str, Dict[str, Any]] = {}
+        # entries by exact key, or AMBIGUOUS
+        self._by_isbn: Dict[str, Any] = {}
+        self._by_doi: Dict[str, Any] = {}
+        self._by_title_author: Dict[Any, Any] = {}
+        self._build_indexes()
+        # Results of find_bibtex_entry, so long-running processes (watch mode)
+        # only pay for fuzzy matching once per book
+        self._match_cache: Dict[Any, Optional[Dict[str, Any]]] = {}
 
     def _load_bibtex(self, bibtex_path: str) -> bibtexparser.bibdatabase.BibDatabase:
         """
@@ -29,6 +80,63 @@ class BibTexLibrarian:
             parser.customization = convert_to_unicode
             return bibtexparser.load(bibtex_file, parser=parser)
 
+    @staticmethod
+    def _add_key(index: Dict[Any, Any], key: Any, entry: Dict[str, Any]) -> None:
+        if not key:
+            return
+        if index.get(key, entry) is not entry:
+            index[key] = AMBIGUOUS
+        else:
+            index[key] = entry
+
+    def _title_author_keys(self, title: str, author: str) -> Iterable[Any]:
+        surname = last_name(author)
+        if not surname:
+            return []
+        # full titles are tried before titles without their subtitle
+        return [('title', normalize_title(title), surname),
+                ('main', normalize_title(main_title(title)), surname)]
+
+    def _build_indexes(self) -> None:
+        for entry in self.db.entries:
+            for asset_id in re.split(r'[,;\s]+', entry.get('asset_id', '')):
+                self._add_key(self._by_asset_id, asset_id.upper(), entry)
+            for isbn in re.split(r'[,;/]|\s+(?=[0-9])', entry.get('isbn', '')):
+                self._add_key(self._by_isbn, normalize_isbn(isbn), entry)
+            self._add_key(self._by_doi, normalize_doi(entry.get('doi', '')), entry)
+
+            authors = self._get_authors_from_entry(entry)
+            if authors:
+                title = self._strip_braces(entry.get('title', ''))
+                for key in self._title_author_keys(title, authors[0]):
+                    self._add_key(self._by_title_author, key, entry)
+
+    def find_exact_entry(self, title: str = None, authors: List[str] = None,
+                         asset_id: str = None, isbn: str = None,
+                         doi: str = None) -> Optional[Dict[str, Any]]:
+        """
+        Looks a book up by its identifiers, then by its normalized title and
+        first author's last name.
+
+        Returns:
+            The entry, or None when no key identifies exactly one entry.
+        """
+        candidates = [
+            (self._by_asset_id, asset_id.upper() if asset_id else None),
+            (self._by_isbn, normalize_isbn(isbn) if isbn else None),
+            (self._by_doi, normalize_doi(doi) if doi else None),
+        ]
+        authors_list = authors if isinstance(authors, list) else [authors] if authors else []
+        if title and authors_list and authors_list[0]:
+            candidates += [(self._by_title_author, key)
+                           for key in self._title_author_keys(title, authors_list[0])]
+
+        for index, key in candidates:
+            entry = index.get(key) if key else None
+            if entry is not None and entry is not AMBIGUOUS:
+                return entry
+        return None
+
     def _normalize_initials(self, name: str) -> str:
         return re.sub(r'\b([A-Z])\.\b', r'\1', name)
 
@@ -62,11 +170,27 @@ class BibTexLibrarian:
         return self._parse_names(entry.get('editor', ''))
 
     def find_bibtex_entry(
-        self, title: str, authors: List[str], title_threshold: int = 80, author_threshold: int = 80
+        self, title: str, authors: List[str], title_threshold: int = 80, author_threshold: int = 80,
+        asset_id: str = None, isbn: str = None, doi: str = None
     ) -> Optional[Dict[str, Any]]:
         """
         Finds the best matching BibTeX entry for a given book title and author.
+
+        Exact keys (asset_id, ISBN, DOI, normalized title and first author)
+        are tried first; fuzzy matching on title and authors is the fallback.
         """
+        cache_key = (title, tuple(authors) if isinstance(authors, list) else authors,
+                     title_threshold, author_threshold, asset_id, isbn, doi)
+        if cache_key not in self._match_cache:
+            entry = self.find_exact_entry(title, authors, asset_id=asset_id, isbn=isbn, doi=doi)
+            if entry is None:
+                entry = self._find_bibtex_entry(title, authors, title_threshold, author_threshold)
+            self._match_cache[cache_key] = entry
+        return self._match_cache[cache_key]
+
+    def _find_bibtex_entry(
+        self, title: str, authors: List[str], title_threshold: int, author_threshold: int
+    ) -> Optional[Dict[str, Any]]:
         best_match = None
         best_score = 0
 
@@ -1,11 +1,13 @@
+import re
+import queue
 import pathlib
 import sqlite3
-import functools
-import subprocess
+import threading
+import contextlib
 from time import sleep
-from tqdm import tqdm
+from urllib.parse import quote
 
-from typing import (List, Dict, Union)
+from typing import (List, Dict, Tuple, Union, Optional, Iterable, Iterator)
 
 
 SqliteQueryType = List[Dict[str, Union[str, int]]]
@@ -26,6 +28,13 @@ BOOKS_APP_PATH = (
 
 BOOKS_APP_NAME = "Books"
 
+# When set, extraction reads from a local mirror (see mirror.py) instead of
+# the live databases
+MIRROR_PATH: Optional[pathlib.Path] = None
+
+# Connections kept open to the default library (or its mirror)
+POOL_SIZE = 4
+
 
 ATTACH_BOOKS_QUERY = """
 attach database ? as books
@@ -46,12 +55,14 @@ NOTE_LIST_FIELDS = [
     'modified_date'
 ]
 
+# Table names are unqualified so the query runs both against the live
+# annotation database with BKLibrary attached and against the mirror
 NOTE_LIST_QUERY = """
 select 
 ZANNOTATIONUUID as annotation_id, 
 ZANNOTATIONASSETID as asset_id, 
-books.ZBKLIBRARYASSET.ZTITLE as title, 
-books.ZBKLIBRARYASSET.ZAUTHOR as author,
+ZBKLIBRARYASSET.ZTITLE as title, 
+ZBKLIBRARYASSET.ZAUTHOR as author,
 ZANNOTATIONLOCATION as location,
 ZANNOTATIONSELECTEDTEXT as selected_text, 
 ZANNOTATIONNOTE as note,
@@ -62,18 +73,128 @@ ZANNOTATIONMODIFICATIONDATE as modified_date
 
 from ZAEANNOTATION
 
-left join books.ZBKLIBRARYASSET
-on ZAEANNOTATION.ZANNOTATIONASSETID = books.ZBKLIBRARYASSET.ZASSETID
+left join ZBKLIBRARYASSET
+on ZAEANNOTATION.ZANNOTATIONASSETID = ZBKLIBRARYASSET.ZASSETID
 
 where ZANNOTATIONDELETED = 0 and (title not null and author not null) and ((selected_text != '' and selected_text not null) or note not null)
-
+{filter}
 order by ZANNOTATIONASSETID, ZPLLOCATIONRANGESTART;
 """
 
+# One book's notes, as NOTE_LIST_QUERY. The book's row is looked up once up
+# front: joining per annotation would scan ZBKLIBRARYASSET for every row.
+BOOK_NOTE_LIST_QUERY = """
+select
+ZANNOTATIONUUID as annotation_id,
+ZANNOTATIONASSETID as asset_id,
+book.ZTITLE as title,
+book.ZAUTHOR as author,
+ZANNOTATIONLOCATION as location,
+ZANNOTATIONSELECTEDTEXT as selected_text,
+ZANNOTATIONNOTE as note,
+ZANNOTATIONREPRESENTATIVETEXT as represent_text,
+ZFUTUREPROOFING5 as chapter,
+ZANNOTATIONSTYLE as style,
+ZANNOTATIONMODIFICATIONDATE as modified_date
+
+from (select ZTITLE, ZAUTHOR from ZBKLIBRARYASSET where ZASSETID = :asset_id limit 1) as book
+
+join ZAEANNOTATION on ZANNOTATIONASSETID = :asset_id
+
+where ZANNOTATIONDELETED = 0 and (title not null and author not null) and ((selected_text != '' and selected_text not null) or note not null)
+order by ZPLLOCATIONRANGESTART;
+"""
+
+# Books with any annotation (including deleted ones) touched after a given
+# Core Data timestamp, used for incremental syncs
+CHANGED_ASSETS_QUERY = """
+select distinct ZANNOTATIONASSETID
+from ZAEANNOTATION
+where ZANNOTATIONMODIFICATIONDATE > ? and ZANNOTATIONASSETID not null
+"""
+
+# Annotations deleted in Books after a given Core Data timestamp. Core Data
+# keeps them as rows flagged ZANNOTATIONDELETED and bumps their modification
+# date, so recent deletions are found through the modification date
+DELETED_ANNOTATIONS_QUERY = """
+select
+ZANNOTATIONUUID as annotation_id,
+ZANNOTATIONASSETID as asset_id,
+ZBKLIBRARYASSET.ZTITLE as title,
+ZBKLIBRARYASSET.ZAUTHOR as author,
+ZANNOTATIONMODIFICATIONDATE as modified_date
+
+from ZAEANNOTATION
+
+left join ZBKLIBRARYASSET
+on ZAEANNOTATION.ZANNOTATIONASSETID = ZBKLIBRARYASSET.ZASSETID
+
+where ZANNOTATIONMODIFICATIONDATE > ? and ZANNOTATIONDELETED = 1 and ZANNOTATIONASSETID not null
+order by ZANNOTATIONASSETID;
+"""
+
+DELETED_FIELDS = ['annotation_id', 'asset_id', 'title', 'author', 'modified_date']
+
+MAX_MODIFIED_DATE_QUERY = """
+select max(ZANNOTATIONMODIFICATIONDATE) from ZAEANNOTATION
+"""
+
+ANNOTATED_ASSETS_QUERY = """
+select distinct ZANNOTATIONASSETID
+from ZAEANNOTATION
+where ZANNOTATIONDELETED = 0 and ZANNOTATIONASSETID not null
+"""
+
+
+# ZBKLIBRARYASSET columns that may identify a book, used when present
+IDENTIFIER_COLUMNS = ('ZISBN', 'ZEPUBID')
+
+ISBN_PATTERN = re.compile(r'(?:97[89])?\d{9}[\dXx]')
+
+
+def set_database_paths(annotation_db_path: Union[str, pathlib.Path] = None,
+                       book_db_path: Union[str, pathlib.Path] = None) -> None:
+    """
+    Points extraction at different AEAnnotation/BKLibrary directories, e.g.
+    an archived copy of the databases or a synthetic benchmark fixture.
+    """
+    global ANNOTATION_DB_PATH, BOOK_DB_PATH
+
+    if annotation_db_path is not None:
+        ANNOTATION_DB_PATH = pathlib.Path(annotation_db_path).expanduser()
+    if book_db_path is not None:
+        BOOK_DB_PATH = pathlib.Path(book_db_path).expanduser()
+
+    close_pool()
+
+
+def set_mirror_path(mirror_path: Union[str, pathlib.Path, None]) -> None:
+    """Reads from the mirror at ``mirror_path``, or the live databases for None."""
+    global MIRROR_PATH
+
+    MIRROR_PATH = pathlib.Path(mirror_path).expanduser() if mirror_path else None
+    close_pool()
+
+
+def refresh_mirror(force: bool = False) -> Tuple[bool, bool]:
+    """
+    Updates the mirror from the live databases, if a mirror is configured.
+
+    Returns:
+        Whether the annotations and the library were refreshed.
+    """
+    if MIRROR_PATH is None:
+        return False, False
+
+    from apple_books_highlights.mirror import BooksMirror
+
+    sqlite_file, assets_file = get_database_files()
+    return BooksMirror(MIRROR_PATH).refresh(sqlite_file, assets_file, force=force)
+
+
+def get_database_files() -> Tuple[pathlib.Path, pathlib.Path]:
+    """Returns the annotation and library database files."""
 
-@functools.lru_cache(maxsize=1)
-def get_ibooks_database() -> sqlite3.Cursor:
-    
     sqlite_files = list(ANNOTATION_DB_PATH.glob("*.sqlite"))
 
     if len(sqlite_files) == 0:
@@ -88,27 +209,342 @@ def get_ibooks_database() -> sqlite3.Cursor:
     else:
         assets_file = assets_files[0]
 
-    db1 = sqlite3.connect(str(sqlite_file), check_same_thread=False)
-    cursor = db1.cursor()
-    cursor.execute(
-        ATTACH_BOOKS_QUERY,
-        (str(assets_file),)
-    )
+    return sqlite_file, assets_file
+
+
+def get_library_files(directory: Union[str, pathlib.Path]) -> Tuple[pathlib.Path, pathlib.Path]:
+    """
+    Finds the annotation and library databases of a library source: either a
+    directory with AEAnnotation/ and BKLibrary/ subdirectories (like Books'
+    Documents folder), or one holding the *.sqlite files themselves.
+    """
+    directory = pathlib.Path(directory).expanduser()
+
+    for anno_dir, book_dir in ((directory / "AEAnnotation", directory / "BKLibrary"),
+                               (directory, directory)):
+        sqlite_files = sorted(anno_dir.glob("AEAnnotation*.sqlite"))
+        assets_files = sorted(book_dir.glob("BKLibrary*.sqlite"))
+        if sqlite_files and assets_files:
+            return sqlite_files[0], assets_files[0]
+
+    raise FileNotFoundError(f"No AEAnnotation/BKLibrary databases found in {directory}")
+
+
+def readonly_uri(path: Union[str, pathlib.Path]) -> str:
+    """A read-only SQLite URI for a database file, safe for any path."""
+    return f"file:{quote(pathlib.Path(path).resolve().as_posix())}?mode=ro"
+
+
+def _connect(sqlite_file: pathlib.Path, assets_file: Optional[pathlib.Path] = None) -> sqlite3.Connection:
+    """Opens a read-only connection, with the library database attached as `books`."""
+    # connections move between threads, but are only used by one at a time
+    db = sqlite3.connect(readonly_uri(sqlite_file), uri=True, check_same_thread=False)
+    if assets_file is not None:
+        db.execute(ATTACH_BOOKS_QUERY, (readonly_uri(assets_file),))
+    return db
+
+
+class ConnectionPool:
+    """
+    A bounded set of read-only connections to one annotation database, each
+    with the library database attached, for use from several threads.
+    """
+
+    def __init__(self, sqlite_file: pathlib.Path, assets_file: Optional[pathlib.Path] = None,
+                 size: int = POOL_SIZE):
+        """
+        Args:
+            sqlite_file: The annotation database (or the mirror).
+            assets_file: The library database to attach; None for the mirror,
+                which holds both tables.
+            size: The most connections open at once; callers beyond that wait.
+        """
+        self.sqlite_file = sqlite_file
+        self.assets_file = assets_file
+        self.size = size
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._closed = False
 
-    return cursor
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
 
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if not can_open:
+            return self._idle.get()
 
-def fetch_annotations(refresh: bool, sleep_time: int = 20) -> SqliteQueryType:
+        try:
+            return _connect(self.sqlite_file, self.assets_file)
+        except BaseException:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Lends a connection for the duration of the ``with`` block."""
+        db = self._acquire()
+        try:
+            yield db
+        finally:
+            if self._closed:
+                db.close()
+            else:
+                self._idle.put(db)
+
+    def close(self) -> None:
+        """Closes the idle connections; those still lent out close when returned."""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Returns the pool for the default library, or for the mirror if one is set."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            if MIRROR_PATH is not None:
+                if not MIRROR_PATH.exists():
+                    refresh_mirror()
+                _pool = ConnectionPool(MIRROR_PATH)
+            else:
+                _pool = ConnectionPool(*get_database_files())
+        return _pool
+
+
+def close_pool() -> None:
+    """Closes the default library's connections; the next query opens new ones."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+@contextlib.contextmanager
+def connection() -> Iterator[sqlite3.Connection]:
+    """Lends a read-only connection to the default library (or its mirror)."""
+    with get_pool().connection() as db:
+        yield db
+
+
+def refresh_database(sleep_time: int = 20) -> None:
+    """Refreshes the database by opening Books, waiting and quitting it."""
+    import subprocess
+    from tqdm import tqdm
+
+    subprocess.run(f"open {BOOKS_APP_PATH}".split())
+    print("Refreshing database...")
+    for i in tqdm(range(sleep_time)):
+        sleep(1)
+    subprocess.run(["osascript", "-e" , f'quit app "{BOOKS_APP_NAME}"'])
+
+
+def iter_annotation_rows(refresh: bool = False, sleep_time: int = 20,
+                         asset_ids: Optional[Iterable[str]] = None) -> Iterator[Tuple]:
+    """
+    Yields raw annotation rows straight from the cursor, as tuples in
+    NOTE_LIST_FIELDS order, without building intermediate dicts. The
+    connection is held until the rows are consumed.
+    """
     # refresh database by opening Books and waiting
     if refresh:
-        subprocess.run(f"open {BOOKS_APP_PATH}".split())
-        print("Refreshing database...")
-        for i in tqdm(range(sleep_time)):
-            sleep(1)
-        subprocess.run(["osascript", "-e" , f'quit app "{BOOKS_APP_NAME}"'])
-    cur = get_ibooks_database()
-    exe = cur.execute(NOTE_LIST_QUERY)
-    res = exe.fetchall()
+        refresh_database(sleep_time)
+    with connection() as db:
+        yield from _query_notes(db, asset_ids)
+
+
+def _query_notes(cur: Union[sqlite3.Cursor, sqlite3.Connection],
+                 asset_ids: Optional[Iterable[str]] = None) -> Iterator[Tuple]:
+    if asset_ids is None:
+        exe = cur.execute(NOTE_LIST_QUERY.format(filter=''))
+    else:
+        asset_ids = list(asset_ids)
+        placeholders = ', '.join('?' * len(asset_ids))
+        exe = cur.execute(
+            NOTE_LIST_QUERY.format(filter=f'and ZANNOTATIONASSETID in ({placeholders})'),
+            asset_ids
+        )
+    return iter(exe)
+
+
+def fetch_annotations(refresh: bool, sleep_time: int = 20,
+                      asset_ids: Optional[Iterable[str]] = None) -> SqliteQueryType:
+    res = iter_annotation_rows(refresh, sleep_time, asset_ids)
     annos = [dict(zip(NOTE_LIST_FIELDS, r)) for r in res]
 
     return annos
+
+
+def fetch_annotated_asset_ids() -> List[str]:
+    """Returns the books that have annotations."""
+    with connection() as db:
+        return [str(r[0]) for r in db.execute(ANNOTATED_ASSETS_QUERY)]
+
+
+def fetch_book_annotations(asset_id: str) -> SqliteQueryType:
+    """
+    Fetches one book's annotations, in the same form as fetch_annotations.
+    Worker threads can call this concurrently; each call borrows its own
+    pooled connection.
+    """
+    with connection() as db:
+        res = db.execute(BOOK_NOTE_LIST_QUERY, {'asset_id': asset_id})
+        return [dict(zip(NOTE_LIST_FIELDS, r)) for r in res]
+
+
+def fetch_changed_asset_ids(since: Optional[float]) -> List[str]:
+    """Returns the books whose annotations changed after ``since``."""
+    with connection() as db:
+        res = db.execute(CHANGED_ASSETS_QUERY, (since or 0,)).fetchall()
+    return [str(r[0]) for r in res]
+
+
+def fetch_deleted_annotations(since: Optional[float] = None,
+                              files: Optional[Tuple[pathlib.Path, pathlib.Path]] = None) -> SqliteQueryType:
+    """
+    Returns the annotations deleted in Books after ``since`` (all of them for
+    None), with their book's title and author.
+
+    Args:
+        since: A Core Data timestamp, e.g. SyncState.last_modified.
+        files: A library source (see get_library_files); the default library
+            (or its mirror) if None.
+    """
+    with (connection() if files is None else contextlib.closing(_connect(*files))) as db:
+        res = db.execute(DELETED_ANNOTATIONS_QUERY, (since or 0,)).fetchall()
+    return [dict(zip(DELETED_FIELDS, r)) for r in res]
+
+
+def fetch_max_modified_date() -> Optional[float]:
+    """Returns the latest annotation modification date (Core Data time)."""
+    with connection() as db:
+        return db.execute(MAX_MODIFIED_DATE_QUERY).fetchone()[0]
+
+
+def fetch_library_annotations(files: Tuple[pathlib.Path, pathlib.Path],
+                              asset_ids: Optional[Iterable[str]] = None) -> SqliteQueryType:
+    """
+    Fetches the annotations of one library source on its own connection, so
+    several sources can be read in parallel.
+
+    Args:
+        files: The annotation and library database files, see get_library_files.
+        asset_ids: Only fetch these books.
+    """
+    with contextlib.closing(_connect(*files)) as db:
+        return [dict(zip(NOTE_LIST_FIELDS, r)) for r in _query_notes(db, asset_ids)]
+
+
+def fetch_libraries(sources: List[Tuple[pathlib.Path, pathlib.Path]],
+                    asset_ids: Optional[Iterable[str]] = None,
+                    max_workers: Optional[int] = None) -> SqliteQueryType:
+    """
+    Fetches and consolidates the annotations of several library sources.
+
+    Sources are read in parallel. An annotation found in more than one
+    source (same annotation_id) is kept once, in its most recently modified
+    version, and the result is ordered by book and position like
+    fetch_annotations.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if asset_ids is not None:
+        asset_ids = list(asset_ids)
+
+    workers = max_workers or min(len(sources), 8) or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda files: fetch_library_annotations(files, asset_ids), sources))
+
+    if len(results) == 1:
+        return results[0]
+
+    newest: Dict[str, Dict[str, Union[str, int]]] = {}
+    for annos in results:
+        for anno in annos:
+            kept = newest.get(anno['annotation_id'])
+            if kept is None or (anno['modified_date'] or 0) > (kept['modified_date'] or 0):
+                newest[anno['annotation_id']] = anno
+
+    from apple_books_highlights.util import parse_epubcfi
+
+    return sorted(newest.values(), key=lambda a: (a['asset_id'], parse_epubcfi(a['location'])))
+
+
+def _parse_identifiers(values: Dict[str, Optional[str]]) -> Dict[str, str]:
+    """Picks an ISBN and a DOI out of a book's identifier columns."""
+    identifiers: Dict[str, str] = {}
+    for column, value in values.items():
+        if not value:
+            continue
+        value = str(value).strip()
+        lower = value.lower()
+        # EPUB ids are often urn:isbn:..., sometimes a DOI or a bare ISBN
+        if lower.startswith(('urn:isbn:', 'isbn:')):
+            identifiers.setdefault('isbn', value.rsplit(':', 1)[-1])
+        elif lower.startswith(('doi:', '10.')) or 'doi.org/' in lower:
+            identifiers.setdefault('doi', value)
+        elif column == 'ZISBN' or ISBN_PATTERN.fullmatch(re.sub(r'[\s-]', '', value)):
+            identifiers.setdefault('isbn', value)
+    return identifiers
+
+
+def _query_identifiers(cur: Union[sqlite3.Cursor, sqlite3.Connection]) -> Dict[str, Dict[str, str]]:
+    available = {r[1] for r in cur.execute('pragma table_info(ZBKLIBRARYASSET)')}
+    columns = [c for c in IDENTIFIER_COLUMNS if c in available]
+    if not columns:
+        return {}
+
+    res = cur.execute(f"select ZASSETID, {', '.join(columns)} from ZBKLIBRARYASSET")
+    identifiers = {}
+    for row in res:
+        parsed = _parse_identifiers(dict(zip(columns, row[1:])))
+        if parsed:
+            identifiers[str(row[0])] = parsed
+    return identifiers
+
+
+def fetch_book_identifiers(files: Optional[Tuple[pathlib.Path, pathlib.Path]] = None) -> Dict[str, Dict[str, str]]:
+    """
+    Returns the ISBN and/or DOI of each book in the library, from whichever
+    identifier columns ZBKLIBRARYASSET has, keyed by asset id.
+
+    Args:
+        files: A library source (see get_library_files); the default library
+            (or its mirror) if None.
+    """
+    with (connection() if files is None else contextlib.closing(_connect(*files))) as db:
+        return _query_identifiers(db)
+
+
+def fetch_book_paths(files: Optional[Tuple[pathlib.Path, pathlib.Path]] = None) -> Dict[str, str]:
+    """
+    Returns the file path Books recorded for each book (ZPATH), keyed by
+    asset id, if the library has that column.
+
+    Args:
+        files: A library source (see get_library_files); the default library
+            (or its mirror) if None.
+    """
+    with (connection() if files is None else contextlib.closing(_connect(*files))) as db:
+        if 'ZPATH' not in {r[1] for r in db.execute('pragma table_info(ZBKLIBRARYASSET)')}:
+            return {}
+        res = db.execute('select ZASSETID, ZPATH from ZBKLIBRARYASSET where ZPATH not null')
+        return {str(asset_id): path for asset_id, path in res}
@@ -0,0 +1,144 @@
+"""
+Finds overlapping and nested highlights of the same passage in a book.
+
+Apple Books often keeps several highlights over the same text, e.g. after a
+highlight is extended or re-coloured. Their CFI ranges are sorted once and
+overlaps are found in a single sweep, so a book costs O(n log n).
+"""
+from typing import Any, Dict, List, Optional
+
+from .util import parse_epubcfi_range
+
+DEDUP_MODES = ('merge', 'flag')
+
+# shortest text shared by two partly overlapping highlights for them to be
+# joined into one; anything shorter is likely a coincidence
+MIN_TEXT_OVERLAP = 12
+
+NOTE_SEPARATOR = ' / '
+
+
+def find_overlaps(annotations: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Groups highlights whose CFI ranges overlap, directly or through a chain
+    of other highlights.
+
+    Args:
+        annotations: Raw annotation data for a single book from booksdb.
+
+    Returns:
+        The groups of two or more overlapping highlights, each in reading order.
+    """
+    ranged = []
+    for ann in annotations:
+        try:
+            bounds = parse_epubcfi_range(ann.get('location'))
+        except (ValueError, IndexError):
+            bounds = None
+        if bounds is not None:
+            ranged.append((bounds[0], bounds[1], ann))
+
+    ranged.sort(key=lambda r: (r[0], r[1]))
+
+    groups = []
+    current: List[Dict[str, Any]] = []
+    current_end: Optional[List[int]] = None
+    for start, end, ann in ranged:
+        # ranges that merely touch (one ends where the next starts) don't overlap
+        if current_end is not None and start < current_end:
+            current.append(ann)
+            if end > current_end:
+                current_end = end
+        else:
+            if len(current) > 1:
+                groups.append(current)
+            current = [ann]
+            current_end = end
+    if len(current) > 1:
+        groups.append(current)
+
+    return groups
+
+
+def _join_text(first: str, second: str) -> Optional[str]:
+    """Joins two texts on the longest end of ``first`` that starts ``second``."""
+    if second in first:
+        return first
+    if first in second:
+        return second
+    for k in range(min(len(first), len(second)) - 1, MIN_TEXT_OVERLAP - 1, -1):
+        if first.endswith(second[:k]):
+            return first + second[k:]
+    return None
+
+
+def _merge_group(group: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Merges a group into as few highlights as its texts allow. The earliest
+    highlight of each merged run keeps its id and position.
+    """
+    merged = [dict(group[0])]
+    for ann in group[1:]:
+        target = merged[-1]
+        text = _join_text(target.get('selected_text') or '', ann.get('selected_text') or '')
+        if text is None:
+            # the texts don't line up, so keep both
+            merged.append(dict(ann))
+            continue
+
+        target['selected_text'] = text
+        notes = [n for n in (target.get('note'), ann.get('note')) if n]
+        if len(notes) == 2 and notes[1] in notes[0]:
+            notes = notes[:1]
+        target['note'] = NOTE_SEPARATOR.join(notes) if notes else None
+        if (ann.get('modified_date') or 0) > (target.get('modified_date') or 0):
+            target['modified_date'] = ann['modified_date']
+    return merged
+
+
+def dedup_annotations(annotations: List[Dict[str, Any]], mode: str = 'merge') -> List[Dict[str, Any]]:
+    """
+    Merges or flags a book's overlapping highlights.
+
+    Args:
+        annotations: Raw annotation data for a single book from booksdb.
+        mode: 'merge' to fold overlapping highlights into one, 'flag' to keep
+            them all and list the ids each overlaps with under 'overlaps_with'.
+
+    Returns:
+        The annotations, in their original order.
+    """
+    if mode not in DEDUP_MODES:
+        raise ValueError(f"Unknown dedup mode {mode!r}, expected one of {DEDUP_MODES}")
+
+    groups = find_overlaps(annotations)
+    if not groups:
+        return annotations
+
+    if mode == 'flag':
+        flags: Dict[int, List[str]] = {}
+        for group in groups:
+            ids = [a['annotation_id'] for a in group]
+            for ann in group:
+                flags[id(ann)] = [i for i in ids if i != ann['annotation_id']]
+        result = []
+        for ann in annotations:
+            if id(ann) in flags:
+                ann = dict(ann, overlaps_with=flags[id(ann)])
+            result.append(ann)
+        return result
+
+    replaced: Dict[int, Dict[str, Any]] = {}
+    dropped = set()
+    for group in groups:
+        merged = _merge_group(group)
+        kept_ids = {a['annotation_id'] for a in merged}
+        for ann in group:
+            if ann['annotation_id'] not in kept_ids:
+                dropped.add(id(ann))
+        by_id = {a['annotation_id']: a for a in merged}
+        for ann in group:
+            if ann['annotation_id'] in by_id:
+                replaced[id(ann)] = by_id[ann['annotation_id']]
+
+    return [replaced.get(id(ann), ann) for ann in annotations if id(ann) not in dropped]
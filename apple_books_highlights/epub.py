@@ -0,0 +1,236 @@
+"""
+Fills in missing chapter names from the books' EPUB tables of contents.
+
+Apple Books only sometimes stores a chapter name with a highlight. The
+highlight's CFI does however say which spine item (XHTML file) it is in, and
+the EPUB's nav document (EPUB 3) or NCX (EPUB 2) names the chapter each spine
+item belongs to. Only container.xml, the package document and the TOC are
+read, straight from the zip (or from the unpacked directory Books keeps), and
+the result is cached per book keyed by the file's mtime, so each EPUB is
+opened once.
+"""
+import os
+import json
+import pathlib
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import unquote
+
+from .util import parse_epubcfi
+
+PathLike = Union[str, pathlib.Path]
+
+# (spine position, chapter title), ordered by spine position
+Toc = List[Tuple[int, str]]
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def _find_all(root: ET.Element, name: str) -> List[ET.Element]:
+    return [el for el in root.iter() if _local(el.tag) == name]
+
+
+def _text(el: ET.Element) -> str:
+    return ' '.join(''.join(el.itertext()).split())
+
+
+class _EpubReader:
+    """Reads single files from a zipped or unpacked EPUB."""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._zip = None if path.is_dir() else zipfile.ZipFile(str(path))
+
+    def read(self, name: str) -> bytes:
+        if self._zip is not None:
+            return self._zip.read(name)
+        return (self.path / name).read_bytes()
+
+    def close(self) -> None:
+        if self._zip is not None:
+            self._zip.close()
+
+
+def _resolve(base: str, href: str) -> str:
+    """Resolves ``href`` relative to the document at ``base``, without its fragment."""
+    href = unquote(href.split('#', 1)[0])
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base), href))
+
+
+def read_toc(path: PathLike) -> Toc:
+    """
+    Parses an EPUB's table of contents into the spine position at which each
+    chapter starts.
+
+    Args:
+        path: The .epub file, or the directory of an unpacked EPUB.
+
+    Returns:
+        (spine position, title) pairs; positions count itemrefs from 0.
+    """
+    reader = _EpubReader(pathlib.Path(path))
+    try:
+        container = ET.fromstring(reader.read('META-INF/container.xml'))
+        opf_path = _find_all(container, 'rootfile')[0].get('full-path')
+        opf = ET.fromstring(reader.read(opf_path))
+
+        manifest = {}
+        nav_path = ncx_path = None
+        for item in _find_all(opf, 'item'):
+            href = _resolve(opf_path, item.get('href', ''))
+            manifest[item.get('id')] = href
+            if 'nav' in (item.get('properties') or '').split():
+                nav_path = href
+            elif item.get('media-type') == 'application/x-dtbncx+xml':
+                ncx_path = href
+
+        spine = _find_all(opf, 'spine')
+        itemrefs = _find_all(spine[0], 'itemref') if spine else []
+        positions = {}
+        for i, ref in enumerate(itemrefs):
+            positions.setdefault(manifest.get(ref.get('idref')), i)
+        if spine and spine[0].get('toc') in manifest:
+            ncx_path = manifest[spine[0].get('toc')]
+
+        entries: List[Tuple[str, str]] = []
+        if nav_path is not None:
+            nav = ET.fromstring(reader.read(nav_path))
+            for el in _find_all(nav, 'nav'):
+                types = el.get('{http://www.idpf.org/2007/ops}type', '') or el.get('type', '')
+                if 'toc' in types.split():
+                    entries = [(_resolve(nav_path, a.get('href', '')), _text(a))
+                               for a in _find_all(el, 'a') if a.get('href')]
+                    break
+        if not entries and ncx_path is not None:
+            ncx = ET.fromstring(reader.read(ncx_path))
+            for point in _find_all(ncx, 'navPoint'):
+                label = next(iter(_find_all(point, 'text')), None)
+                content = next(iter(_find_all(point, 'content')), None)
+                if label is not None and content is not None:
+                    entries.append((_resolve(ncx_path, content.get('src', '')), _text(label)))
+    finally:
+        reader.close()
+
+    # the first entry pointing into a spine item names it (later ones are
+    # sections within it, or nested entries revisiting it)
+    starts: Dict[int, str] = {}
+    for href, title in entries:
+        position = positions.get(href)
+        if position is not None and title and position not in starts:
+            starts[position] = title
+    return sorted(starts.items())
+
+
+def spine_position(location: str) -> Optional[int]:
+    """The spine position (itemref index from 0) a CFI points into."""
+    try:
+        offsets = parse_epubcfi(location)
+    except (ValueError, IndexError):
+        return None
+    # /6 is the package's spine element, /N its (N/2)th itemref
+    if len(offsets) < 2 or offsets[0] != 6:
+        return None
+    return offsets[1] // 2 - 1
+
+
+def chapter_at(toc: Toc, position: int) -> Optional[str]:
+    """The title of the chapter a spine position belongs to."""
+    title = None
+    for start, name in toc:
+        if start > position:
+            break
+        title = name
+    return title
+
+
+class ChapterEnricher:
+    """Fills in missing chapter names using cached EPUB tables of contents."""
+
+    def __init__(self, cache_path: PathLike, epub_dir: Optional[PathLike] = None,
+                 book_paths: Optional[Dict[str, str]] = None):
+        """
+        Args:
+            cache_path: The JSON file caching each book's parsed TOC.
+            epub_dir: A directory holding the EPUBs as ``<asset_id>.epub``.
+            book_paths: EPUB paths by asset id, e.g. from
+                booksdb.fetch_book_paths; tried before ``epub_dir``.
+        """
+        self.cache_path = pathlib.Path(cache_path).expanduser()
+        self.epub_dir = pathlib.Path(epub_dir).expanduser() if epub_dir else None
+        self.book_paths = book_paths or {}
+        self._cache: Dict[str, Dict] = {}
+        self._dirty = False
+
+        if self.cache_path.exists():
+            try:
+                self._cache = json.loads(self.cache_path.read_text(encoding='utf-8'))
+            except ValueError:
+                self._cache = {}
+
+    def find_epub(self, asset_id: str) -> Optional[pathlib.Path]:
+        candidates = []
+        if self.book_paths.get(asset_id):
+            candidates.append(pathlib.Path(self.book_paths[asset_id]).expanduser())
+        if self.epub_dir is not None:
+            candidates.append(self.epub_dir / f'{asset_id}.epub')
+        for path in candidates:
+            if path.exists():
+                return path
+        return None
+
+    def toc(self, asset_id: str) -> Toc:
+        """Returns the book's TOC, parsing its EPUB only if it changed."""
+        path = self.find_epub(asset_id)
+        if path is None:
+            return []
+
+        st = path.stat()
+        stamp = [str(path), st.st_mtime_ns, st.st_size]
+        cached = self._cache.get(asset_id)
+        if cached is not None and cached['stamp'] == stamp:
+            return [tuple(entry) for entry in cached['toc']]
+
+        try:
+            toc = read_toc(path)
+        except (OSError, KeyError, IndexError, ET.ParseError, zipfile.BadZipFile):
+            # unreadable or DRM-protected books are remembered as having no TOC
+            toc = []
+        self._cache[asset_id] = {'stamp': stamp, 'toc': toc}
+        self._dirty = True
+        return toc
+
+    def enrich(self, asset_id: str, annotations: List[Dict]) -> int:
+        """
+        Sets the chapter of the book's annotations that have none.
+
+        Returns:
+            The number of annotations given a chapter.
+        """
+        missing = [a for a in annotations if not a.get('chapter')]
+        if not missing:
+            return 0
+        toc = self.toc(asset_id)
+        if not toc:
+            return 0
+
+        filled = 0
+        for ann in missing:
+            position = spine_position(ann.get('location'))
+            chapter = chapter_at(toc, position) if position is not None else None
+            if chapter:
+                ann['chapter'] = chapter
+                filled += 1
+        return filled
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_name(self.cache_path.name + '.tmp')
+        tmp_path.write_text(json.dumps(self._cache), encoding='utf-8')
+        os.replace(tmp_path, self.cache_path)
+        self._dirty = False
@@ -2,21 +2,73 @@
 Handles the export of enriched annotations to a Readwise-ready CSV file.
 """
 import csv
+import io
 import json
 import pathlib
+from typing import List, Optional, Tuple
+
+from . import profiling
+from .fragments import FragmentCache, version_of
+from .staging import StagingArea, source
+from .util import content_hash
+
+# Readwise required headers
+HEADERS = ["Title", "Author", "Category", "Source URL", "Highlight", "Note", "Location"]
+
+
+def _encode_rows(rows: List[Tuple[str, ...]]) -> List[str]:
+    """Encodes each row as a CSV line, as csv.writer writes it."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    lines = []
+    for row in rows:
+        writer.writerow(row)
+        lines.append(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate()
+    return lines
+
 
 class CsvExporter:
     """Orchestrates the creation of a Readwise-compatible CSV file."""
 
-    def __init__(self, output_dir: str):
+    def __init__(self, output_dir: str, cache: Optional[FragmentCache] = None,
+                 staging: Optional[StagingArea] = None):
         """
         Initializes the exporter with the output directory.
 
         Args:
             output_dir: The directory where CSV files will be saved.
+            cache: Reuses the encoded rows of unchanged highlights from
+                earlier runs.
+            staging: Writes the files into this staging area instead, to be
+                committed to ``output_dir`` at the end of the sync.
         """
         self.output_dir = pathlib.Path(output_dir)
+        self.staging = staging
+        if self.staging is not None:
+            self.output_dir = self.staging.directory('csv', self.output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.cache = cache
+        if self.cache is not None:
+            self.cache.use_version('csv', version_of(HEADERS))
+
+    def _lines(self, annotation_ids: List[str], rows: List[Tuple[str, ...]]) -> List[str]:
+        """Encodes the rows, reusing cached lines."""
+        if self.cache is None:
+            return _encode_rows(rows)
+
+        digests = {i: content_hash('\x1f'.join(row)) for i, row in zip(annotation_ids, rows)}
+        lines = self.cache.get_many('csv', digests)
+        profiling.count('csv_rows_cached', len(lines))
+
+        missing = [(i, row) for i, row in zip(annotation_ids, rows) if i not in lines]
+        if missing:
+            encoded = _encode_rows([row for _, row in missing])
+            new_lines = {i: line for (i, _), line in zip(missing, encoded)}
+            self.cache.put_many('csv', [(i, digests[i], line) for i, line in new_lines.items()])
+            lines.update(new_lines)
+        return [lines[i] for i in annotation_ids]
 
     def export(self, enriched_json_path: str):
         """
@@ -25,39 +77,32 @@ class CsvExporter:
         Args:
             enriched_json_path: Path to the enriched JSON file.
         """
-        with open(enriched_json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with profiling.stage('read_json'):
+            with open(source(enriched_json_path, self.staging), 'r', encoding='utf-8') as f:
+                data = json.load(f)
 
         metadata = data.get("metadata", {})
         annotations = data.get("annotations", [])
 
-        if not annotations:
-            return
-
         # Construct filename
         filename = f"{metadata['citation_key']} {metadata['entry_type']}-ab.csv"
         output_path = self.output_dir / filename
 
-        # Readwise required headers
-        headers = ["Title", "Author", "Category", "Source URL", "Highlight", "Note", "Location"]
-
-        with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=headers)
-            writer.writeheader()
-
-            for annot in annotations:
-                source_url = ""
-                if metadata.get("doi"):
-                    source_url = f'https://doi.org/{metadata.get("doi")}'
-                elif metadata.get("url"):
-                    source_url = metadata.get("url")
-
-                writer.writerow({
-                    "Title": metadata.get("title", ""),
-                    "Author": ", ".join(metadata.get("authors", [])),
-                    "Category": "books",
-                    "Source URL": source_url,
-                    "Highlight": annot.get("highlight", ""),
-                    "Note": annot.get("note", ""),
-                    "Location": annot.get("chapter", ""),
-                })
+        # a book whose highlights were all deleted keeps just the header
+        if not annotations and not source(output_path, self.staging).exists():
+            return
+
+        source_url = ""
+        if metadata.get("doi"):
+            source_url = f'https://doi.org/{metadata.get("doi")}'
+        elif metadata.get("url"):
+            source_url = metadata.get("url")
+        book = (metadata.get("title") or "", ", ".join(metadata.get("authors", [])), "books", source_url)
+
+        rows = [book + (annot.get("highlight") or "", annot.get("note") or "", annot.get("chapter") or "")
+                for annot in annotations]
+
+        with profiling.stage('write_csv', book=metadata.get('asset_id')):
+            lines = self._lines([annot['annotation_id'] for annot in annotations], rows)
+            with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
+                csvfile.write(''.join(_encode_rows([tuple(HEADERS)]) + lines))
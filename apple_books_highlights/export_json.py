@@ -6,13 +6,18 @@ import pathlib
 import html
 import re
 from typing import List, Optional, Dict, Any
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, model_serializer
 
+from . import profiling
 from .bib import BibTexLibrarian
+from .staging import StagingArea, source
 
 # Pydantic Models for data validation and serialization
 class Annotation(BaseModel):
     """Data model for a single highlight annotation."""
+    # accept the exported field names too, so enriched JSON can be read back
+    model_config = ConfigDict(populate_by_name=True)
+
     annotation_id: str
     highlight: Optional[str] = Field(None, alias='selected_text')
     note: Optional[str] = None
@@ -20,6 +25,16 @@ class Annotation(BaseModel):
     color: Optional[int] = Field(None, alias='style')
     chapter: Optional[str] = None
     modified_date: Any = Field(None, alias='modified_date')
+    # ids of overlapping highlights, set by `sync --dedup flag`
+    overlaps_with: Optional[List[str]] = None
+
+    @model_serializer(mode='wrap')
+    def _omit_unflagged(self, handler):
+        # keep the JSON of unflagged highlights unchanged
+        data = handler(self)
+        if data.get('overlaps_with') is None:
+            data.pop('overlaps_with', None)
+        return data
 
 class Metadata(BaseModel):
     """Data model for the book's metadata."""
@@ -42,14 +57,19 @@ class EnrichedJSON(BaseModel):
 class JsonExporter:
     """Orchestrates the creation of an enriched JSON file for a book."""
 
-    def __init__(self, output_dir: str):
+    def __init__(self, output_dir: str, staging: Optional[StagingArea] = None):
         """
         Initializes the exporter with the output directory.
 
         Args:
             output_dir: The directory where JSON files will be saved.
+            staging: Writes the files into this staging area instead, to be
+                committed to ``output_dir`` at the end of the sync.
         """
         self.output_dir = pathlib.Path(output_dir)
+        self.staging = staging
+        if self.staging is not None:
+            self.output_dir = self.staging.directory('json', self.output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
     def _sanitize_text(self, s: str) -> str:
@@ -69,51 +89,140 @@ class JsonExporter:
         s = " ".join([ln for ln in lines if ln])
         return s.strip()
 
-    def export(self, annotations: List[Dict[str, Any]], bib_librarian: BibTexLibrarian) -> Optional[pathlib.Path]:
+    def match(self, first_annotation: Dict[str, Any], bib_librarian: BibTexLibrarian,
+              identifiers: Optional[Dict[str, str]] = None) -> Optional[Dict[str, Any]]:
+        """Returns the normalized BibTeX metadata of an annotation's book, or None."""
+        asset_id = first_annotation.get('asset_id')
+
+        # Find the best matching BibTeX entry
+        with profiling.stage('find_bibtex_entry', book=asset_id):
+            bib_entry = bib_librarian.find_bibtex_entry(
+                first_annotation.get('title'), [first_annotation.get('author')],
+                asset_id=asset_id, **(identifiers or {}))
+
+        if not bib_entry:
+            return None
+
+        # Normalize metadata from the BibTeX entry
+        normalized_meta = bib_librarian.normalize_meta(bib_entry)
+        normalized_meta['asset_id'] = asset_id
+        return normalized_meta
+
+    def path_for(self, metadata: Metadata) -> pathlib.Path:
+        """The JSON file of the book with this metadata."""
+        return self.output_dir / f"{metadata.citation_key} {metadata.entry_type}-ab.json"
+
+    def build(self, annotations: List[Dict[str, Any]], bib_librarian: BibTexLibrarian,
+              identifiers: Optional[Dict[str, str]] = None) -> Optional[EnrichedJSON]:
         """
-        Creates and saves an enriched JSON file for a given book.
+        Enriches a book's annotations with its BibTeX metadata.
 
         Args:
             annotations: A list of raw annotation data for a single book from booksdb.
             bib_librarian: An initialized BibTexLibrarian instance.
+            identifiers: The book's ISBN/DOI from booksdb.fetch_book_identifiers,
+                for an exact match before fuzzy matching.
 
         Returns:
-            The path to the created JSON file, or None if no BibTeX match was found.
+            The validated model, or None if no BibTeX match was found.
         """
         if not annotations:
             return None
 
-        first_annotation = annotations[0]
-        book_title = first_annotation.get('title')
-        book_author = first_annotation.get('author')
-        asset_id = first_annotation.get('asset_id')
+        normalized_meta = self.match(annotations[0], bib_librarian, identifiers)
+        if normalized_meta is None:
+            return None
+        return self.enrich(annotations, normalized_meta)
 
-        # Find the best matching BibTeX entry
-        bib_entry = bib_librarian.find_bibtex_entry(book_title, [book_author])
+    def enrich(self, annotations: List[Dict[str, Any]], normalized_meta: Dict[str, Any]) -> EnrichedJSON:
+        """
+        Sanitizes a book's annotations and validates them with its metadata.
 
-        if not bib_entry:
-            return None
+        Args:
+            annotations: A list of raw annotation data for a single book from booksdb.
+            normalized_meta: The book's metadata, from ``match``.
 
-        # Normalize metadata from the BibTeX entry
-        normalized_meta = bib_librarian.normalize_meta(bib_entry)
-        normalized_meta['asset_id'] = asset_id
+        Returns:
+            The validated model.
+        """
+        asset_id = normalized_meta['asset_id']
 
         # Sanitize text fields before validation
-        for ann in annotations:
-            ann['selected_text'] = self._sanitize_text(ann.get('selected_text'))
-            ann['note'] = self._sanitize_text(ann.get('note'))
+        with profiling.stage('sanitize_text', book=asset_id):
+            for ann in annotations:
+                ann['selected_text'] = self._sanitize_text(ann.get('selected_text'))
+                ann['note'] = self._sanitize_text(ann.get('note'))
 
         # Create Pydantic models
-        metadata = Metadata(**normalized_meta)
-        parsed_annotations = [Annotation.parse_obj(a) for a in annotations]
+        with profiling.stage('validate', book=asset_id):
+            metadata = Metadata(**normalized_meta)
+            parsed_annotations = [Annotation.parse_obj(a) for a in annotations]
 
-        enriched_data = EnrichedJSON(metadata=metadata, annotations=parsed_annotations)
+            return EnrichedJSON(metadata=metadata, annotations=parsed_annotations)
 
-        # Construct filename and write to JSON file
-        filename = f"{metadata.citation_key} {metadata.entry_type}-ab.json"
-        output_path = self.output_dir / filename
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(enriched_data.model_dump_json(indent=2))
+    def write(self, enriched_data: EnrichedJSON) -> pathlib.Path:
+        """
+        Saves an enriched model as JSON.
+
+        Args:
+            enriched_data: The model returned by ``build``.
+
+        Returns:
+            The path to the JSON file.
+        """
+        metadata = enriched_data.metadata
+        output_path = self.path_for(metadata)
+
+        with profiling.stage('write_json', book=metadata.asset_id):
+            with open(output_path, 'w', encoding='utf-8') as f:
+                f.write(enriched_data.model_dump_json(indent=2))
 
         return output_path
+
+    def export(self, annotations: List[Dict[str, Any]], bib_librarian: BibTexLibrarian,
+               identifiers: Optional[Dict[str, str]] = None) -> Optional[pathlib.Path]:
+        """
+        Creates and saves an enriched JSON file for a given book.
+
+        Args:
+            annotations: A list of raw annotation data for a single book from booksdb.
+            bib_librarian: An initialized BibTexLibrarian instance.
+            identifiers: The book's ISBN/DOI, see ``build``.
+
+        Returns:
+            The path to the created JSON file, or None if no BibTeX match was found.
+        """
+        enriched_data = self.build(annotations, bib_librarian, identifiers)
+        if enriched_data is None:
+            return None
+        return self.write(enriched_data)
+
+    def remove(self, tombstones: List[Dict[str, Any]], normalized_meta: Dict[str, Any]) -> Optional[EnrichedJSON]:
+        """
+        Drops deleted annotations from a book's existing JSON file, for books
+        that aren't re-exported because none of their annotations are left.
+
+        Args:
+            tombstones: The book's deleted annotations, from
+                booksdb.fetch_deleted_annotations.
+            normalized_meta: The book's metadata, from ``match``.
+
+        Returns:
+            The book's remaining model (written back if anything was
+            dropped), or None if the book was never exported.
+        """
+        if not tombstones:
+            return None
+
+        path = source(self.path_for(Metadata(**normalized_meta)), self.staging)
+        if not path.exists():
+            return None
+
+        with profiling.stage('read_json', book=normalized_meta['asset_id']):
+            enriched = EnrichedJSON.model_validate_json(path.read_bytes())
+        deleted = {t['annotation_id'] for t in tombstones}
+        kept = [a for a in enriched.annotations if a.annotation_id not in deleted]
+        if len(kept) < len(enriched.annotations):
+            enriched.annotations = kept
+            self.write(enriched)
+        return enriched
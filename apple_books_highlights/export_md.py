@@ -5,8 +5,14 @@ import json
 import pathlib
 import re
 from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 from jinja2 import Environment, FileSystemLoader, Template
 
+from . import profiling
+from .fragments import FragmentCache, version_of
+from .staging import StagingArea, source
+from .util import atomic_write_text, content_hash
+
 # As per TECHNICAL.md, this is the required timestamp format for Obsidian.
 OBSIDIAN_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
 
@@ -22,36 +28,117 @@ COLOR_MAP = {
 }
 
 # This is the template for appending NEW highlights to an existing file.
+# Each highlight's block is rendered from templates/annotation_block.md.
 APPEND_TEMPLATE = """ 
 
 ### New highlights added on [[@{{ metadata.citation_key }}|{{ date_short }}]]
 
-{% for annotation in annotations %}
-<!-- an_id: {{ annotation.annotation_id }} -->
-- {{ annotation.highlight }}
-{% if annotation.chapter %}> chapter:  `{{ annotation.chapter }}`
-{% endif %}> tags: {{ annotation.tag | default('#general-ab') }}
-{% if annotation.note %}
-
->[!memo]
-> {{ annotation.note }}
-{% endif %}
+{% for block in blocks %}
+{{ block }}
 
 
 {% endfor %}
 """
 
+BLOCK_TEMPLATE_NAME = 'annotation_block.md'
+
+# Ends each block when a batch of them is rendered in one go
+BLOCK_SEPARATOR = '\ue000'
+
+# Sidecar in the Markdown directory recording, per file and annotation, the
+# hash of the annotation fields a block was rendered from and of the block as
+# written. Hidden, so Obsidian doesn't list it.
+BLOCK_INDEX_NAME = '.md_blocks.json'
+
+# Put before a highlight deleted in Books whose block can't be removed
+# because it was edited by hand (or written before md_update was enabled)
+DELETED_MARK = ">[!deleted] Deleted in Apple Books on {date}\n\n"
+DELETED_MARK_PATTERN = re.compile(r">\[!deleted\][^\n]*\n\n$")
+
+MARKER_PATTERN = re.compile(r"<!-- an_id: (.*?) -->")
+
+# One rendered annotation block, from its an_id marker to the end of its
+# note. Highlights and notes are sanitized to a single line, so text the user
+# adds after a block (even right under its note) isn't part of it.
+BLOCK_PATTERN = re.compile(
+    r"<!-- an_id: [^\n]*? -->\n"
+    r"- [^\n]*\n"
+    r"(?:> chapter:  `[^`\n]*`\n)?"
+    r"> tags: [^\n]*\n"
+    r"(?:\n+>\[!memo\]\n> [^\n]*\n)?"
+)
+
+
+def index_blocks(content: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Maps each annotation id in a Markdown file to the range its block can
+    occupy: from its marker to the next marker (or the end of the file).
+    """
+    markers = [(m.group(1), m.start()) for m in MARKER_PATTERN.finditer(content)]
+    ends = [start for _, start in markers[1:]] + [len(content)]
+    return {an_id: (start, end) for (an_id, start), end in zip(markers, ends)}
+
+
+def block_span(content: str, region: Tuple[int, int]) -> Optional[Tuple[int, int]]:
+    """The exact span of the rendered block in a region from index_blocks."""
+    match = BLOCK_PATTERN.match(content, *region)
+    return match.span() if match else None
+
+
+def source_hash(annotation: Dict[str, Any]) -> str:
+    """Hashes the annotation fields a block is rendered from."""
+    fields = [annotation.get(k) or '' for k in ('annotation_id', 'highlight', 'chapter', 'tag', 'note')]
+    return content_hash('\x1f'.join(map(str, fields)))
+
+
 class MarkdownExporter:
-    """Orchestrates the creation and append-only updating of Markdown files."""
+    """Orchestrates the creation and updating of Markdown files."""
 
-    def __init__(self, output_dir: str):
+    def __init__(self, output_dir: str, update: bool = False, cache: Optional[FragmentCache] = None,
+                 staging: Optional[StagingArea] = None):
+        """
+        Args:
+            output_dir: The directory where Markdown files will be saved.
+            update: Also re-render the blocks of highlights that changed in
+                Books since they were written, instead of only appending new
+                ones. Blocks edited by hand are left alone.
+            cache: Reuses the blocks of a new note whose book is unchanged
+                since they were rendered in an earlier run.
+            staging: Writes the files into this staging area instead, to be
+                committed to ``output_dir`` at the end of the sync.
+        """
         self.output_dir = pathlib.Path(output_dir)
+        self.staging = staging
+        if self.staging is not None:
+            self.output_dir = self.staging.directory('md', self.output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.update = update
         
         template_dir = pathlib.Path(__file__).parent / 'templates'
         self.jinja_env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True, lstrip_blocks=True)
         self.main_template = self.jinja_env.get_template('export_md_template.md')
         self.append_template = Template(APPEND_TEMPLATE)
+        self.block_template = self.jinja_env.get_template(BLOCK_TEMPLATE_NAME)
+        # the block template in a loop, to render many blocks with one call
+        block_source = self.jinja_env.loader.get_source(self.jinja_env, BLOCK_TEMPLATE_NAME)[0]
+        self.blocks_template = self.jinja_env.from_string(
+            '{% for annotation in annotations %}' + block_source + BLOCK_SEPARATOR + '{% endfor %}')
+
+        self.cache = cache
+        if self.cache is not None:
+            # a book's blocks, keyed by asset id and the hash of its enriched JSON
+            self.cache.use_version('md', version_of(block_source, COLOR_MAP, 'book'))
+
+        self.index_path = self.output_dir / BLOCK_INDEX_NAME
+        self._blocks: Dict[str, Dict[str, List[str]]] = {}
+        self._dirty = False
+        index_source = source(self.index_path, self.staging)
+        if self.update and index_source.exists():
+            try:
+                self._blocks = json.loads(index_source.read_text(encoding='utf-8'))
+            except ValueError:
+                # without it every block counts as written before update mode
+                self._blocks = {}
 
     def _add_tags_to_annotations(self, annotations):
         """Adds a 'tag' field to each annotation based on its color code."""
@@ -59,52 +146,236 @@ class MarkdownExporter:
             ann['tag'] = COLOR_MAP.get(ann.get('color'), '#general-ab')
         return annotations
 
-    def export(self, enriched_json_path: str):
-        """Creates or updates a Markdown file from an enriched JSON file."""
-        with open(enriched_json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+    def _render_blocks(self, annotations) -> List[str]:
+        """Renders each annotation's block."""
+        blocks = self.blocks_template.render(annotations=annotations).split(BLOCK_SEPARATOR)[:-1]
+        if len(blocks) != len(annotations):
+            # a highlight contains the separator itself
+            blocks = [self.block_template.render(annotation=ann) for ann in annotations]
+        return blocks
+
+    def _book_blocks(self, asset_id: str, digest: str, annotations) -> List[str]:
+        """
+        Renders the blocks of all of a book's annotations, reusing the ones
+        cached for the same enriched JSON.
+
+        A whole book is cached as one entry, as hashing and looking up each
+        annotation costs more than rendering it.
+        """
+        if self.cache is not None:
+            cached = self.cache.get_many('md', {asset_id: digest}).get(asset_id)
+            if cached is not None:
+                blocks = cached.split(BLOCK_SEPARATOR)[:-1]
+                if len(blocks) == len(annotations):
+                    profiling.count('md_blocks_cached', len(blocks))
+                    return blocks
+
+        blocks = self._render_blocks(annotations)
+        if self.cache is not None and all(BLOCK_SEPARATOR not in block for block in blocks):
+            self.cache.put_many('md', [(asset_id, digest, ''.join(b + BLOCK_SEPARATOR for b in blocks))])
+        return blocks
+
+    def _record_blocks(self, filename: str, annotations, blocks: List[str]) -> None:
+        """Remembers the hashes of the blocks just written."""
+        records = self._blocks.setdefault(filename, {})
+        for ann, block in zip(annotations, blocks):
+            records[ann['annotation_id']] = [source_hash(ann), content_hash(block)]
+        self._dirty = True
+
+    def _update_blocks(self, filename: str, content: str, annotations) -> Tuple[str, int, int]:
+        """
+        Re-renders the blocks of annotations that changed since they were
+        written and splices them into ``content``.
+
+        Returns:
+            The new content, the number of blocks replaced and the number of
+            changed blocks skipped because they were edited by hand.
+        """
+        blocks = index_blocks(content)
+        records = self._blocks.setdefault(filename, {})
+        changed = []
+        skipped = 0
+        for ann in annotations:
+            an_id = ann['annotation_id']
+            region = blocks.get(an_id)
+            if region is None:
+                continue
+            digest = source_hash(ann)
+            record = records.get(an_id)
+            if record is not None and record[0] == digest:
+                continue
+
+            span = block_span(content, region)
+            if span is None:
+                # the block's layout was changed by hand
+                skipped += 1
+                continue
+            block = content[span[0]:span[1]]
+            if record is not None and record[1] != content_hash(block):
+                skipped += 1
+                continue
+            changed.append((ann, span, block, record))
+
+        replacements = []
+        rendered_blocks = self._render_blocks([ann for ann, _, _, _ in changed]) if changed else []
+        for (ann, span, block, record), rendered in zip(changed, rendered_blocks):
+            if record is None and rendered != block:
+                # a block from before update mode is only known to be ours
+                # if it is exactly what we'd write now
+                skipped += 1
+                continue
+            records[ann['annotation_id']] = [source_hash(ann), content_hash(rendered)]
+            self._dirty = True
+            if rendered != block:
+                replacements.append((span, rendered))
+
+        if not replacements:
+            return content, 0, skipped
+
+        pieces = []
+        position = 0
+        for (start, end), rendered in sorted(replacements):
+            pieces.append(content[position:start])
+            pieces.append(rendered)
+            position = end
+        pieces.append(content[position:])
+        return ''.join(pieces), len(replacements), skipped
+
+    def _remove_blocks(self, filename: str, content: str, deleted: Iterable[str],
+                       date: str) -> Tuple[str, int]:
+        """
+        Removes the blocks of annotations deleted in Books. Blocks that may
+        hold text of the user's (edited by hand, or not recorded because
+        they were written without md_update) are kept and marked instead.
+
+        Returns:
+            The new content and the number of blocks removed or marked.
+        """
+        blocks = index_blocks(content)
+        records = self._blocks.get(filename, {})
+        edits = []
+        for an_id in deleted:
+            region = blocks.get(an_id)
+            if region is None:
+                continue
+            record = records.pop(an_id, None)
+            if record is not None:
+                self._dirty = True
+            span = block_span(content, region)
+            if span is not None and record is not None and record[1] == content_hash(content[span[0]:span[1]]):
+                # take the blank lines after it along
+                end = span[1]
+                while end < region[1] and content[end] == '\n':
+                    end += 1
+                edits.append((span[0], end, ''))
+            elif not DELETED_MARK_PATTERN.search(content, max(0, region[0] - 200), region[0]):
+                edits.append((region[0], region[0], DELETED_MARK.format(date=date)))
+
+        if not edits:
+            return content, 0
+
+        pieces = []
+        position = 0
+        for start, end, text in sorted(edits):
+            pieces.append(content[position:start])
+            pieces.append(text)
+            position = end
+        pieces.append(content[position:])
+        return ''.join(pieces), len(edits)
+
+    def export(self, enriched_json_path: str, deleted: Optional[Iterable[str]] = None):
+        """
+        Creates or updates a Markdown file from an enriched JSON file.
+
+        Args:
+            enriched_json_path: Path to the enriched JSON file.
+            deleted: Ids of the book's annotations deleted in Books, whose
+                blocks are removed from an existing file.
+        """
+        with profiling.stage('read_json'):
+            with open(source(enriched_json_path, self.staging), 'r', encoding='utf-8') as f:
+                text = f.read()
+            data = json.loads(text)
         
         metadata = data['metadata']
         annotations = self._add_tags_to_annotations(data['annotations'])
 
         filename = f"{metadata['citation_key']} {metadata['entry_type']}-ab.md"
         md_path = self.output_dir / filename
+        current_path = source(md_path, self.staging)
 
         now = datetime.now()
         now_str = now.strftime(OBSIDIAN_TIMESTAMP_FORMAT)
 
-        if not md_path.exists():
+        if not current_path.exists():
             # --- Create new file ---
+            with profiling.stage('render_markdown', book=metadata['asset_id']):
+                blocks = self._book_blocks(metadata['asset_id'], content_hash(text), annotations)
             render_context = {
                 "metadata": metadata,
                 "annotations": annotations,
+                "blocks": blocks,
                 "creation_date": now_str,
                 "modified_date": now_str,
                 "creation_date_short": now.strftime('%Y-%m-%d')
             }
-            markdown_content = self.main_template.render(render_context)
-            md_path.write_text(markdown_content, encoding='utf-8')
+            with profiling.stage('render_markdown', book=metadata['asset_id']):
+                markdown_content = self.main_template.render(render_context)
+            with profiling.stage('write_markdown', book=metadata['asset_id']):
+                md_path.write_text(markdown_content, encoding='utf-8')
+            if self.update:
+                self._record_blocks(filename, annotations, blocks)
         else:
             # --- Update existing file ---
-            content = md_path.read_text(encoding='utf-8')
+            with profiling.stage('read_markdown', book=metadata['asset_id']):
+                content = current_path.read_text(encoding='utf-8')
             existing_ids = set(re.findall(r"<!-- an_id: (.*?) -->", content))
+
+            updated = 0
+            if self.update:
+                with profiling.stage('update_markdown', book=metadata['asset_id']):
+                    content, updated, skipped = self._update_blocks(filename, content, annotations)
+                profiling.count('md_blocks_updated', updated, book=metadata['asset_id'])
+                if skipped:
+                    profiling.count('md_blocks_edited', skipped, book=metadata['asset_id'])
             
+            removed = 0
+            if deleted:
+                with profiling.stage('update_markdown', book=metadata['asset_id']):
+                    content, removed = self._remove_blocks(filename, content, deleted, now.strftime('%Y-%m-%d'))
+                profiling.count('md_blocks_deleted', removed, book=metadata['asset_id'])
+
             new_annotations = [ann for ann in annotations if ann['annotation_id'] not in existing_ids]
 
-            if not new_annotations:
-                return # No new highlights to add
+            if not new_annotations and not updated and not removed:
+                return # No new, changed or deleted highlights
 
-            # Append new highlights to the file
-            append_context = {
-                "metadata": metadata,
-                "annotations": new_annotations,
-                "date_short": now.strftime('%Y-%m-%d')
-            }
-            append_content = self.append_template.render(append_context)
-            with md_path.open('a', encoding='utf-8') as f:
-                f.write(append_content)
-
-            # Update the 'modified' timestamp in the YAML front matter
-            # Use a lambda to ensure the replacement is handled correctly
-            new_content = re.sub(r"^(modified: ).*$", lambda m: m.group(1) + now_str, content, flags=re.MULTILINE)
-            md_path.write_text(new_content, encoding='utf-8')
+            append_content = ''
+            if new_annotations:
+                # Append new highlights to the file
+                with profiling.stage('render_markdown', book=metadata['asset_id']):
+                    blocks = self._render_blocks(new_annotations)
+                append_context = {
+                    "metadata": metadata,
+                    "annotations": new_annotations,
+                    "blocks": blocks,
+                    "date_short": now.strftime('%Y-%m-%d')
+                }
+                with profiling.stage('render_markdown', book=metadata['asset_id']):
+                    append_content = self.append_template.render(append_context)
+            with profiling.stage('write_markdown', book=metadata['asset_id']):
+                # Update the 'modified' timestamp in the YAML front matter
+                # Use a lambda to ensure the replacement is handled correctly
+                new_content = re.sub(r"^(modified: ).*$", lambda m: m.group(1) + now_str, content, count=1, flags=re.MULTILINE)
+                # Write the appended highlights together with the updated front
+                # matter, otherwise rewriting the front matter drops them again
+                md_path.write_text(new_content + append_content, encoding='utf-8')
+            if self.update and new_annotations:
+                self._record_blocks(filename, new_annotations, blocks)
+
+    def save(self) -> None:
+        """Writes the block index, if update mode changed it."""
+        if not self._dirty:
+            return
+        atomic_write_text(self.index_path, json.dumps(self._blocks))
+        self._dirty = False
@@ -0,0 +1,172 @@
+"""
+A persistent cache of rendered fragments: CSV rows per annotation, and the
+Markdown blocks of a whole book.
+
+Each fragment is stored under its kind and key (an annotation id, or a
+book's asset id), with a hash of what it was rendered from. A lookup only
+hits while that hash matches, so highlights edited in Books are rendered
+again. Every kind has a
+version (e.g. a hash of its template and COLOR_MAP); when it changes, the
+kind's fragments are dropped. The least recently used fragments are evicted
+once the cache holds more than ``max_entries``.
+
+Recency is tracked per run rather than per lookup, and a fragment's is only
+refreshed once it is a few runs old, so an unchanged library costs no writes
+on most runs.
+"""
+import json
+import pathlib
+import sqlite3
+from typing import Dict, Iterable, Tuple, Union
+
+from .util import content_hash
+
+PathLike = Union[str, pathlib.Path]
+
+DEFAULT_MAX_ENTRIES = 200_000
+
+# annotation_id holds a fragment's key, which is the asset id for Markdown
+SCHEMA = """
+create table if not exists fragments (
+    kind text not null,
+    annotation_id text not null,
+    digest text not null,
+    body text not null,
+    last_used integer not null,
+    primary key (kind, annotation_id)
+);
+create index if not exists fragments_lru on fragments (last_used);
+
+create table if not exists fragment_versions (
+    kind text primary key,
+    version text not null
+);
+
+create table if not exists fragment_runs (
+    id integer primary key check (id = 0),
+    run integer not null
+);
+"""
+
+# SQLite's default limit on host parameters is 999 on older builds
+LOOKUP_BATCH = 500
+
+# Runs a fragment may go unrefreshed; eviction order is exact up to this
+TOUCH_INTERVAL = 8
+
+
+class FragmentCache:
+    """Rendered fragments keyed by annotation id (or asset id) and a source hash."""
+
+    def __init__(self, path: PathLike, max_entries: int = DEFAULT_MAX_ENTRIES):
+        """
+        Args:
+            path: The SQLite file holding the cache; created if missing.
+            max_entries: The most fragments kept, over all kinds.
+        """
+        self.path = pathlib.Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(str(self.path))
+        # a lost write only costs a re-render, so don't wait for the disk
+        self.conn.execute('pragma journal_mode = wal')
+        self.conn.execute('pragma synchronous = normal')
+        self.conn.executescript(SCHEMA)
+
+        self._versions: Dict[str, str] = dict(self.conn.execute('select kind, version from fragment_versions'))
+        self._size = self.conn.execute('select count(*) from fragments').fetchone()[0]
+        with self.conn:
+            self.conn.execute('insert into fragment_runs values (0, 1) '
+                              'on conflict (id) do update set run = run + 1')
+        self._run = self.conn.execute('select run from fragment_runs').fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def use_version(self, kind: str, version: str) -> None:
+        """Drops the fragments of ``kind`` if they were rendered by another version."""
+        if self._versions.get(kind) == version:
+            return
+        with self.conn:
+            cur = self.conn.execute('delete from fragments where kind = ?', (kind,))
+            self.conn.execute('insert or replace into fragment_versions values (?, ?)', (kind, version))
+        self._size -= max(cur.rowcount, 0)
+        self._versions[kind] = version
+
+    def get_many(self, kind: str, digests: Dict[str, str]) -> Dict[str, str]:
+        """
+        Looks up fragments.
+
+        Args:
+            kind: The kind of fragment, e.g. 'md' or 'csv'.
+            digests: The current source hash of each key wanted.
+
+        Returns:
+            The fragments whose hash still matches, by key.
+        """
+        ids = list(digests)
+        found: Dict[str, str] = {}
+        stale = []
+        for i in range(0, len(ids), LOOKUP_BATCH):
+            batch = ids[i:i + LOOKUP_BATCH]
+            placeholders = ', '.join('?' * len(batch))
+            rows = self.conn.execute(
+                f'select annotation_id, digest, body, last_used from fragments '
+                f'where kind = ? and annotation_id in ({placeholders})',
+                [kind] + batch)
+            for annotation_id, digest, body, last_used in rows:
+                if digests[annotation_id] == digest:
+                    found[annotation_id] = body
+                    if last_used <= self._run - TOUCH_INTERVAL:
+                        stale.append((self._run, kind, annotation_id))
+
+        if stale:
+            with self.conn:
+                self.conn.executemany(
+                    'update fragments set last_used = ? where kind = ? and annotation_id = ?', stale)
+        return found
+
+    def put_many(self, kind: str, fragments: Iterable[Tuple[str, str, str]]) -> None:
+        """
+        Stores fragments, replacing older renderings under the same keys.
+
+        Args:
+            kind: The kind of fragment.
+            fragments: (key, source hash, fragment) triples.
+        """
+        rows = [(kind, annotation_id, digest, body, self._run) for annotation_id, digest, body in fragments]
+        if not rows:
+            return
+        with self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                'insert into fragments (kind, annotation_id, digest, body, last_used) values (?, ?, ?, ?, ?) '
+                'on conflict (kind, annotation_id) do update set '
+                'digest = excluded.digest, body = excluded.body, last_used = excluded.last_used',
+                rows)
+        # over-counts replaced rows; evict() recounts before removing any
+        self._size += self.conn.total_changes - before
+        # evict in batches rather than on every insert past the limit
+        if self._size > self.max_entries * 1.1:
+            self.evict()
+
+    def evict(self) -> int:
+        """Removes the least recently used fragments beyond ``max_entries``."""
+        self._size = self.conn.execute('select count(*) from fragments').fetchone()[0]
+        excess = self._size - self.max_entries
+        if excess <= 0:
+            return 0
+        with self.conn:
+            self.conn.execute(
+                'delete from fragments where rowid in '
+                '(select rowid from fragments order by last_used limit ?)', (excess,))
+        self._size -= excess
+        return excess
+
+
+def version_of(*parts) -> str:
+    """A short hash of the things a kind of fragment is rendered with."""
+    return content_hash(json.dumps(parts, sort_keys=True, default=str))[:16]
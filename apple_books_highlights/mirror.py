@@ -0,0 +1,181 @@
+"""
+Maintains a local, indexed copy of the Apple Books databases.
+
+The first refresh copies the annotation database with the SQLite backup API
+and adds the library table next to it, so both live in one file. Later
+refreshes only run when a source file changed, and then copy just the
+changed rows. Extraction can then run against the mirror, with indexes
+suited to our queries, without touching Books.app's live files.
+"""
+import json
+import pathlib
+import sqlite3
+from typing import List, Optional, Tuple, Union
+
+from apple_books_highlights.booksdb import readonly_uri
+from apple_books_highlights.state import file_fingerprint
+
+PathLike = Union[str, pathlib.Path]
+
+ANNOTATION_TABLE = 'ZAEANNOTATION'
+ASSET_TABLE = 'ZBKLIBRARYASSET'
+
+MIRROR_INDEXES = [
+    # note listing: filter on deleted, order by book and position
+    f"""create index if not exists mirror_anno_listing
+        on {ANNOTATION_TABLE} (ZANNOTATIONDELETED, ZANNOTATIONASSETID, ZPLLOCATIONRANGESTART)""",
+    # incremental queries: changed books and latest modification date
+    f"""create index if not exists mirror_anno_modified
+        on {ANNOTATION_TABLE} (ZANNOTATIONMODIFICATIONDATE, ZANNOTATIONASSETID)""",
+    # covering index for the title/author join
+    f"""create index if not exists mirror_asset_lookup
+        on {ASSET_TABLE} (ZASSETID, ZTITLE, ZAUTHOR)""",
+]
+
+META_SCHEMA = """
+create table if not exists mirror_meta (
+    key text primary key,
+    value text
+)
+"""
+
+
+class BooksMirror:
+    """A single SQLite file holding copies of the annotation and library tables."""
+
+    def __init__(self, path: PathLike):
+        self.path = pathlib.Path(path).expanduser()
+
+    def connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        return sqlite3.connect(str(self.path), check_same_thread=False)
+
+    def _get_meta(self, conn: sqlite3.Connection, key: str) -> Optional[object]:
+        try:
+            row = conn.execute('select value from mirror_meta where key = ?', (key,)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, conn: sqlite3.Connection, key: str, value: object) -> None:
+        conn.execute(META_SCHEMA)
+        conn.execute('insert or replace into mirror_meta (key, value) values (?, ?)',
+                     (key, json.dumps(value)))
+
+    @staticmethod
+    def _table_sql(conn: sqlite3.Connection, schema: str, table: str) -> Optional[str]:
+        row = conn.execute(
+            f"select sql from {schema}.sqlite_master where type = 'table' and name = ?",
+            (table,)
+        ).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _columns(conn: sqlite3.Connection, schema: str, table: str) -> List[str]:
+        return [r[1] for r in conn.execute(f'pragma {schema}.table_info({table})')]
+
+    def _backup_annotations(self, annotation_file: PathLike) -> None:
+        src = sqlite3.connect(readonly_uri(annotation_file), uri=True)
+        dst = self.connect()
+        try:
+            # a page-level copy of a consistent snapshot; replaces the whole
+            # mirror, so the library table and indexes are rebuilt after it
+            src.backup(dst)
+        finally:
+            src.close()
+            dst.close()
+
+    def _sync_annotations(self, conn: sqlite3.Connection) -> int:
+        """Copies new and changed annotation rows from the attached source."""
+        columns = self._columns(conn, 'src', ANNOTATION_TABLE)
+        # Core Data bumps Z_OPT on every save of a row
+        version = 'Z_OPT' if 'Z_OPT' in columns else 'ZANNOTATIONMODIFICATIONDATE'
+        cur = conn.execute(f"""
+            insert or replace into main.{ANNOTATION_TABLE}
+            select s.* from src.{ANNOTATION_TABLE} s
+            left join main.{ANNOTATION_TABLE} m on m.Z_PK = s.Z_PK
+            where m.Z_PK is null or m.{version} is not s.{version}
+        """)
+        changed = cur.rowcount
+        cur = conn.execute(f"""
+            delete from main.{ANNOTATION_TABLE}
+            where Z_PK not in (select Z_PK from src.{ANNOTATION_TABLE})
+        """)
+        return changed + cur.rowcount
+
+    def _copy_assets(self, conn: sqlite3.Connection) -> None:
+        source_sql = self._table_sql(conn, 'lib', ASSET_TABLE)
+        if source_sql is None:
+            raise sqlite3.OperationalError(f'{ASSET_TABLE} missing from library database')
+        if self._table_sql(conn, 'main', ASSET_TABLE) != source_sql:
+            conn.execute(f'drop table if exists main.{ASSET_TABLE}')
+            conn.execute(source_sql)
+        conn.execute(f'delete from main.{ASSET_TABLE}')
+        conn.execute(f'insert into main.{ASSET_TABLE} select * from lib.{ASSET_TABLE}')
+
+    def refresh(self, annotation_file: PathLike, assets_file: PathLike,
+                force: bool = False) -> Tuple[bool, bool]:
+        """
+        Brings the mirror up to date with the source databases.
+
+        Returns:
+            Whether the annotations and the library were refreshed.
+        """
+        anno_fp = file_fingerprint([annotation_file])
+        asset_fp = file_fingerprint([assets_file])
+
+        conn = self.connect() if self.path.exists() else None
+        full = force or conn is None
+        if conn is not None:
+            stored_anno_fp = self._get_meta(conn, 'annotation_fingerprint')
+            stored_asset_fp = self._get_meta(conn, 'asset_fingerprint')
+            if stored_anno_fp is None:
+                full = True
+            elif not full and stored_anno_fp == anno_fp and stored_asset_fp == asset_fp:
+                conn.close()
+                return False, False
+
+        if not full:
+            conn.execute('attach database ? as src', (readonly_uri(annotation_file),))
+            # the incremental copy relies on both tables having the same layout
+            if (self._table_sql(conn, 'src', ANNOTATION_TABLE)
+                    != self._table_sql(conn, 'main', ANNOTATION_TABLE)):
+                full = True
+            conn.execute('detach database src')
+
+        if full:
+            if conn is not None:
+                conn.close()
+            self._backup_annotations(annotation_file)
+            conn = self.connect()
+            refresh_annotations = refresh_assets = True
+        else:
+            refresh_annotations = stored_anno_fp != anno_fp
+            refresh_assets = stored_asset_fp != asset_fp
+
+        try:
+            with conn:
+                if refresh_annotations and not full:
+                    conn.execute('attach database ? as src', (readonly_uri(annotation_file),))
+                if refresh_assets:
+                    conn.execute('attach database ? as lib', (readonly_uri(assets_file),))
+
+                if refresh_annotations and not full:
+                    self._sync_annotations(conn)
+                if refresh_assets:
+                    self._copy_assets(conn)
+
+                for sql in MIRROR_INDEXES:
+                    conn.execute(sql)
+                self._set_meta(conn, 'annotation_fingerprint', anno_fp)
+                self._set_meta(conn, 'asset_fingerprint', asset_fp)
+
+            for schema in ('src', 'lib'):
+                if schema in [r[1] for r in conn.execute('pragma database_list')]:
+                    conn.execute(f'detach database {schema}')
+            if full:
+                conn.execute('analyze')
+        finally:
+            conn.close()
+
+        return refresh_annotations, refresh_assets
@@ -1,27 +1,71 @@
+import os
 import re
+import json
 import pathlib
 import datetime as dt
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 
+import yaml
 import frontmatter
-from typing import (List, Dict, Optional, Union, Any, Callable)
+from typing import (List, Dict, Optional, Union, Any, Callable, Iterable, Tuple)
 from dateutil import parser as duparser
 from slugify import slugify
 
 from apple_books_highlights.util import (
-    cmp_to_key, query_compare_no_asset_id, TEMPLATE_ENVIRONMENT,
-    NS_TIME_INTERVAL_SINCE_1970)
-from apple_books_highlights.booksdb import SqliteQueryType
+    parse_epubcfi, TEMPLATE_ENVIRONMENT, core_data_to_datetime,
+    datetime_to_core_data, content_hash, atomic_write_text)
+from apple_books_highlights.booksdb import SqliteQueryType, NOTE_LIST_FIELDS
+
+
+# Name of the per-directory index of note headers, keyed by file mtime/size
+BOOK_INDEX_FILENAME = '.booklist_index.json'
+
+# Below this many files to (re)read, a thread pool isn't worth starting
+PARALLEL_LOAD_THRESHOLD = 16
+
+FRONT_MATTER_DELIM = re.compile(r'^-{3,}\s*$')
+
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 
 class BookMetadataError(Exception):
     pass
 
 
+def read_front_matter(filename: pathlib.Path) -> Optional[Dict[str, Any]]:
+    """
+    Reads and parses only the YAML front matter of a note, stopping at the
+    closing delimiter instead of loading the whole file.
+    """
+    lines = []
+    with open(filename, 'r', encoding='utf-8') as f:
+        if not FRONT_MATTER_DELIM.match(f.readline()):
+            return None
+        for line in f:
+            if FRONT_MATTER_DELIM.match(line):
+                break
+            lines.append(line)
+        else:
+            return None
+
+    try:
+        metadata = yaml.load(''.join(lines), Loader=YAML_LOADER)
+    except yaml.YAMLError:
+        return None
+    return metadata if isinstance(metadata, dict) else None
+
+
 class Annotation(object):
 
+    # a library can hold 100k+ highlights, so skip the per-instance __dict__
+    __slots__ = ('location', 'selected_text', 'represent_text', 'chapter',
+                 'style', 'note', '_modified')
+
     def __init__(self, location: str, selected_text: str=None, 
                  note: str=None, represent_text: str=None, chapter: str=None, 
-                 style: str=None, modified_date: dt.datetime=None) -> None:
+                 style: str=None, modified_date: dt.datetime=None,
+                 modified_ts: Union[int, float]=None) -> None:
 
         if (selected_text is None) and (note is None):
             raise ValueError('specify either selected_text or note')
@@ -35,7 +79,23 @@ class Annotation(object):
         self.chapter = chapter
         self.style = style
         self.note = stripspaces(note)
-        self.modified_date = modified_date
+
+        # whichever of the raw Core Data timestamp or the datetime was given
+        # is kept as is and converted when the other one is read; Book
+        # caches the latest of its annotations
+        self._modified = modified_ts if modified_ts is not None else modified_date
+
+    @property
+    def modified_ts(self) -> Optional[float]:
+        if isinstance(self._modified, dt.datetime):
+            return datetime_to_core_data(self._modified)
+        return self._modified
+
+    @property
+    def modified_date(self) -> Optional[dt.datetime]:
+        if self._modified is None or isinstance(self._modified, dt.datetime):
+            return self._modified
+        return core_data_to_datetime(self._modified)
 
     def __getitem__(self, key: str) -> Any:
         return getattr(self, key)
@@ -44,7 +104,9 @@ class Annotation(object):
 class Book(object):
 
     def __init__(self, asset_id: str=None, 
-                 filename: pathlib.Path=None) -> None:
+                 filename: pathlib.Path=None,
+                 header: Dict[str, Any]=None,
+                 file_hash: str=None) -> None:
 
         args_present = asset_id is not None
         file_present = filename is not None
@@ -54,37 +116,62 @@ class Book(object):
 
         self._modified_date: Optional[dt.datetime] = None
         self._annotations: List[Annotation] = []
+        # latest annotation timestamp, kept up to date by the annotations
+        # setter rather than recomputed on every access
+        self._anno_max_ts: Optional[float] = None
+        self._anno_max_date: Optional[dt.datetime] = None
         self._sync_notes = True
+        self._path: Optional[pathlib.Path] = None
+        self._prev_content: Optional[str] = None
+        self._reader_notes = ''
+        # sha256 of the note file as last read or written, if known
+        self._file_hash = file_hash
 
         if args_present:
             self._asset_id = asset_id
             self._author: Optional[str] = None
             self._title: Optional[str] = None
-            self._prev_content: Optional[str] = None
-            self._reader_notes = ''
 
         if file_present:
-            self._process_file(filename)
+            self._process_file(filename, header)
 
-    def _process_file(self, filename: pathlib.Path) -> None:
+    def _process_file(self, filename: pathlib.Path,
+                      header: Dict[str, Any]=None) -> None:
 
+        # Only the front matter is read here; the body is parsed lazily by
+        # _load_body once the book actually has to be rewritten
         self._filename = filename.name
+        self._path = filename
 
-        book = frontmatter.load(filename)
+        if header is None:
+            header = read_front_matter(filename)
 
-        if 'asset_id' not in book.keys():
+        if not header or 'asset_id' not in header:
             raise BookMetadataError('asset_id missing')
 
-        self._asset_id = book['asset_id']
-        self._author = book['author']
-        self._title = book['title']
+        self._asset_id = header['asset_id']
+        self._author = header['author']
+        self._title = header['title']
+
+        if header.get('modified_date') is not None:
+            modified_date = header['modified_date']
+            if not isinstance(modified_date, dt.datetime):
+                try:
+                    # we write ISO dates ourselves; dateutil is the slow fallback
+                    modified_date = dt.datetime.fromisoformat(str(modified_date))
+                except ValueError:
+                    modified_date = duparser.parse(str(modified_date))
+            self._modified_date = modified_date
 
-        if 'modified_date' in book.keys():
-            self._modified_date = duparser.parse(book['modified_date'])
+        if 'sync_notes' in header:
+            self._sync_notes = bool(header['sync_notes'])
 
-        if 'sync_notes' in book.keys():
-            self._sync_notes = bool(book['sync_notes'])
+    def _load_body(self) -> None:
 
+        if self._path is None or self._prev_content is not None:
+            return
+
+        book = frontmatter.load(self._path)
         self._prev_content = book.content
 
         self._reader_notes = ''
@@ -170,11 +257,7 @@ class Book(object):
         if len(self._annotations) == 0:
             return False
 
-        anno_max = max([
-            anno.modified_date
-            for anno in self._annotations
-        ])
-        return anno_max > self._modified_date
+        return self.annotations_modified_date > self._modified_date
 
     @property
     def annotations(self) -> List[Annotation]:
@@ -183,7 +266,19 @@ class Book(object):
     @annotations.setter
     def annotations(self, anno: List[Annotation]) -> None:
         self._annotations = anno
-        self._annotations.sort(key=cmp_to_key(query_compare_no_asset_id))
+        # epubcfi_compare orders CFIs like plain list comparison, so each
+        # location is parsed once instead of once per comparison
+        self._annotations.sort(key=lambda a: parse_epubcfi(a.location))
+        self._anno_max_ts = max(
+            (a.modified_ts for a in anno if a.modified_ts is not None),
+            default=None)
+        self._anno_max_date = None
+
+    @property
+    def annotations_modified_date(self) -> Optional[dt.datetime]:
+        if self._anno_max_date is None and self._anno_max_ts is not None:
+            self._anno_max_date = core_data_to_datetime(self._anno_max_ts)
+        return self._anno_max_date
 
     @property
     def num_annotations(self) -> int:
@@ -191,10 +286,12 @@ class Book(object):
 
     @property
     def prev_content(self) -> str:
+        self._load_body()
         return self._prev_content
 
     @property
     def content(self) -> str:
+        self._load_body()
         template = TEMPLATE_ENVIRONMENT.get_template("markdown_template.md")
 
         # print(self._reader_notes[:1000])
@@ -207,22 +304,44 @@ class Book(object):
         )
         return md
 
-    def write(self, path: pathlib.Path) -> None:
+    @property
+    def filename(self) -> str:
+        return self._filename
+
+    @property
+    def file_hash(self) -> Optional[str]:
+        return self._file_hash
+
+    @property
+    def sync_notes(self) -> bool:
+        return self._sync_notes
+
+    def _existing_hash(self, fn: pathlib.Path) -> Optional[str]:
+        if self._file_hash is not None and self._path == fn:
+            return self._file_hash
+        try:
+            with open(fn, 'r', encoding='utf-8') as f:
+                return content_hash(f.read())
+        except FileNotFoundError:
+            return None
+
+    def write(self, path: pathlib.Path) -> bool:
+        """
+        Renders the note and writes it unless the file on disk already has
+        identical content.
+
+        Returns:
+            True if the file was written.
+        """
 
         if not path.is_dir():
             raise NotADirectoryError(f'{str(path)} is not a directory')
 
         if not self._sync_notes:
             print('sync locked for', self._title)
-            return
-        
-        print('updating', self._title)
+            return False
 
-        mod_date = max([
-            anno.modified_date
-            for anno in self._annotations
-        ])
-        mod_date_str = mod_date.isoformat()
+        mod_date_str = self.annotations_modified_date.isoformat()
 
         fmpost = frontmatter.Post(
             self.content,
@@ -233,33 +352,113 @@ class Book(object):
         )
 
         fn = path / self._filename
+        s = frontmatter.dumps(fmpost)
+        new_hash = content_hash(s)
+
+        if new_hash == self._existing_hash(fn):
+            self._file_hash = new_hash
+            self._path = fn
+            return False
+
+        print('updating', self._title)
 
-        with open(fn, 'w') as f:
-            s = frontmatter.dumps(fmpost)
-            f.write(s)
+        atomic_write_text(fn, s)
+        self._file_hash = new_hash
+        self._path = fn
+        self._modified_date = self.annotations_modified_date
+        return True
 
 
 class BookList(object):
 
-    def __init__(self, path: pathlib.Path) -> None:
+    def __init__(self, path: pathlib.Path, max_workers: int=None) -> None:
 
         if not path.is_dir():
             raise NotADirectoryError(f'{str(path)} is not a directory')
 
         self._path = path
+        self._max_workers = max_workers
+        self._index: Dict[str, Any] = {}
         self.books: dict = {}
 
         if self._path.exists():
             self.books = self._load_books(self._path)
 
+    def _read_index(self, path: pathlib.Path) -> Dict[str, Any]:
+        try:
+            with open(path / BOOK_INDEX_FILENAME, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return index if isinstance(index, dict) else {}
+
+    def _write_index(self, path: pathlib.Path, index: Dict[str, Any]) -> None:
+        index_path = path / BOOK_INDEX_FILENAME
+        tmp_path = index_path.with_name(index_path.name + '.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            # the index is only a cache; a read-only directory just means
+            # headers get re-read next time
+            pass
+
     def _load_books(self, path: pathlib.Path) -> Dict[str, Book]:
 
-        book_files = path.glob('*.md')
+        old_index = self._read_index(path)
+        index: Dict[str, Any] = {}
+        self._index = index
+        stale = []
+
+        # files whose mtime and size match the index aren't reopened at all
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.md') or not entry.is_file():
+                    continue
+                st = entry.stat()
+                cached = old_index.get(entry.name)
+                if (cached is not None and cached['mtime_ns'] == st.st_mtime_ns
+                        and cached['size'] == st.st_size):
+                    index[entry.name] = cached
+                else:
+                    index[entry.name] = {
+                        'mtime_ns': st.st_mtime_ns,
+                        'size': st.st_size,
+                        'header': None,
+                    }
+                    stale.append(entry.name)
+
+        def read_header(name: str) -> Optional[Dict[str, Any]]:
+            header = read_front_matter(path / name)
+            if not header or 'asset_id' not in header:
+                return None
+            return {
+                k: (v.isoformat() if isinstance(v, (dt.date, dt.datetime)) else v)
+                for k, v in header.items()
+                if k in ('asset_id', 'author', 'title', 'modified_date', 'sync_notes')
+            }
+
+        if len(stale) >= PARALLEL_LOAD_THRESHOLD:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+                headers = list(pool.map(read_header, stale))
+        else:
+            headers = [read_header(name) for name in stale]
+
+        for name, header in zip(stale, headers):
+            index[name]['header'] = header
+
+        if stale or len(index) != len(old_index):
+            self._write_index(path, index)
 
         md_books = {}
-        for bf in book_files:
+        for name in sorted(index):
+            header = index[name]['header']
+            if header is None:
+                continue
             try:
-                book = Book(filename=bf)
+                book = Book(filename=path / name, header=header,
+                            file_hash=index[name].get('hash'))
                 md_books[book.asset_id] = book
             except BookMetadataError:
                 pass
@@ -276,52 +475,54 @@ class BookList(object):
 
     def populate_annotations(self, annos: SqliteQueryType) -> None:
 
-        res = [
-            r
-            for r in annos
-            if r['asset_id'] is not None and
-            ((r['selected_text'] is not None) or (r['note'] is not None))
-        ]
+        fields = itemgetter(*NOTE_LIST_FIELDS)
+        self.populate_rows(fields(r) for r in annos)
 
-        for r in res:
-            book = self._get_create_book(str(r['asset_id']))
-            if book.title is None:
-                book.title = str(r['title'])
-            if book.author is None:
-                book.author = str(r['author'])
+    def populate_rows(self, rows: Iterable[Tuple]) -> None:
+        """
+        Single-pass ingest of raw query rows (tuples in NOTE_LIST_FIELDS
+        order, e.g. from booksdb.iter_annotation_rows).
+        """
 
         anno_group: Dict[str, List[Annotation]] = {}
-        for r in res:
-            asset_id = str(r['asset_id'])
-            if asset_id not in anno_group:
-                anno_group[asset_id] = []
-
-            location = str(r['location']) if r['location'] else None
-            selected_text = (
-                str(r['selected_text']) if r['selected_text'] else None)
-            note = str(r['note']) if r['note'] else None
-            represent_text = (
-                str(r['represent_text']) if r['represent_text'] else None)
-            chapter = str(r['chapter']) if r['chapter'] else None
-            style = str(r['style']) if r['style'] else None
-
-            anno = Annotation(
-                location=location,
-                selected_text=selected_text,
-                note=note,
-                represent_text=represent_text,
-                chapter=chapter,
-                style=style,
-                modified_date=dt.datetime.fromtimestamp(
-                    NS_TIME_INTERVAL_SINCE_1970 + int(r['modified_date'])),
-            )
-            anno_group[asset_id].append(anno)
+        for (_, asset_id, title, author, location, selected_text, note,
+             represent_text, chapter, style, modified_date) in rows:
+
+            if asset_id is None or (selected_text is None and note is None):
+                continue
+
+            asset_id = str(asset_id)
+            group = anno_group.get(asset_id)
+            if group is None:
+                group = anno_group[asset_id] = []
+                book = self._get_create_book(asset_id)
+                if book.title is None:
+                    book.title = str(title)
+                if book.author is None:
+                    book.author = str(author)
+
+            group.append(Annotation(
+                location=location or None,
+                selected_text=selected_text or None,
+                note=note or None,
+                represent_text=represent_text or None,
+                chapter=chapter or None,
+                style=str(style) if style else None,
+                modified_ts=modified_date,
+            ))
 
         for asset_id, anno_itr in anno_group.items():
             self.books[asset_id].annotations = anno_itr
 
     def write_modified(self, path: pathlib.Path=None, 
-                       force: bool=False) -> None:
+                       force: bool=False) -> Tuple[int, int]:
+        """
+        Writes the books with new annotations (or all of them with
+        ``force``), skipping files whose content would not change.
+
+        Returns:
+            The number of files written and skipped.
+        """
 
         if path is None:
             path = self._path
@@ -331,7 +532,31 @@ class BookList(object):
 
         path.mkdir(parents=True, exist_ok=True)
 
+        written = skipped = 0
         for book in self.books.values():
             if (not book.is_modified) and (not force):
                 continue
-            book.write(path)
+            if book.write(path):
+                written += 1
+            else:
+                skipped += 1
+
+            if path == self._path and book.sync_notes and book.file_hash is not None:
+                st = (path / book.filename).stat()
+                self._index[book.filename] = {
+                    'mtime_ns': st.st_mtime_ns,
+                    'size': st.st_size,
+                    'header': {
+                        'asset_id': book.asset_id,
+                        'author': book.author,
+                        'title': book.title,
+                        'modified_date': book.annotations_modified_date.isoformat(),
+                        'sync_notes': True,
+                    },
+                    'hash': book.file_hash,
+                }
+
+        if path == self._path and (written or skipped):
+            self._write_index(path, self._index)
+
+        return written, skipped
@@ -0,0 +1,483 @@
+"""
+The sync pipeline, as composable generator stages:
+
+    extract → group → match → enrich → export
+
+A source extracts the annotations, ``group`` splits them into books,
+``match`` looks up each book's BibTeX entry, ``enrich`` adds chapter names,
+merges or flags overlapping highlights and validates the enriched model, and
+``export`` writes the JSON and hands the book to each sink (the search index,
+Markdown and CSV exporters, or any callable). Books flow through the stages
+one at a time.
+
+``Pipeline.from_config`` loads the .bib and creates the exporters once, so a
+long-lived process can keep one around and run syncs in-process:
+
+    config = load_config('config.yaml')
+    configure_databases(config)
+    pipeline = Pipeline.from_config(config)
+    result = pipeline.run(source_from_config(config))
+
+The exporters and their dependencies are imported by ``from_config``, which
+keeps importing this module cheap.
+"""
+import os
+import pathlib
+from itertools import groupby
+from operator import itemgetter
+from typing import (TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional,
+                    Sequence, Tuple, Union)
+
+from . import booksdb, profiling
+
+if TYPE_CHECKING:
+    from .bib import BibTexLibrarian
+    from .epub import ChapterEnricher
+    from .export_csv import CsvExporter
+    from .export_json import EnrichedJSON, JsonExporter
+    from .export_md import MarkdownExporter
+    from .fragments import FragmentCache
+    from .search import HighlightIndex
+    from .staging import Change, StagingArea
+
+Log = Callable[[str], None]
+
+
+def load_config(config_path: str = 'config.yaml') -> Dict[str, Any]:
+    """Loads the YAML configuration file."""
+    import yaml
+
+    with open(config_path, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def configure_databases(config: Dict[str, Any]) -> None:
+    """Applies the optional overrides for the Books database locations, and the mirror extraction reads from."""
+    booksdb.set_database_paths(config.get('annotation_db_dir'), config.get('book_db_dir'))
+    booksdb.set_mirror_path(config.get('mirror_path'))
+
+
+def library_sources(config: Dict[str, Any]) -> Optional[List[Tuple[pathlib.Path, pathlib.Path]]]:
+    """Database files of each `library_sources` entry, or None to use the default library."""
+    sources = config.get('library_sources')
+    if not sources:
+        return None
+    return [booksdb.get_library_files(directory) for directory in sources]
+
+
+def search_index_path(config: Dict[str, Any]) -> str:
+    return config.get('search_index_path', os.path.join(config['json_output_dir'], '.search_index.sqlite'))
+
+
+class Extraction(NamedTuple):
+    """The annotations a source read, with what else the stages need about their books."""
+    annotations: List[Dict[str, Any]]
+    # ISBN/DOI by asset id, for exact BibTeX matches
+    identifiers: Dict[str, Dict[str, str]] = {}
+    # EPUB paths by asset id, for chapter names
+    book_paths: Dict[str, str] = {}
+    # annotations deleted in Books, from booksdb.fetch_deleted_annotations
+    tombstones: List[Dict[str, Any]] = []
+    # latest annotation modification date, where the next incremental sync starts
+    last_modified: Optional[float] = None
+
+    def fetch(self) -> 'Extraction':
+        """An extraction is its own source, to run annotations read elsewhere."""
+        return self
+
+
+class BooksSource:
+    """The default Books library, read through the mirror if one is configured."""
+
+    def __init__(self, since: Optional[float] = None, incremental: bool = False, book_paths: bool = False):
+        """
+        Args:
+            since: Core Data time of the last sync; annotations deleted after
+                it are read (all of them for None).
+            incremental: Only read the books whose annotations changed after
+                ``since``.
+            book_paths: Also read the books' EPUB paths, for chapter names.
+        """
+        self.since = since
+        self.incremental = incremental
+        self.book_paths = book_paths
+
+    def fetch(self) -> Extraction:
+        with profiling.stage('mirror'):
+            booksdb.refresh_mirror()
+
+        with profiling.stage('fetch_annotations'):
+            last_modified = booksdb.fetch_max_modified_date()
+            asset_ids = None
+            if self.incremental and self.since is not None:
+                asset_ids = booksdb.fetch_changed_asset_ids(self.since)
+                if not asset_ids:
+                    return Extraction([], last_modified=last_modified)
+
+            return Extraction(booksdb.fetch_annotations(refresh=False, asset_ids=asset_ids),
+                              booksdb.fetch_book_identifiers(),
+                              booksdb.fetch_book_paths() if self.book_paths else {},
+                              booksdb.fetch_deleted_annotations(self.since),
+                              last_modified)
+
+
+class LibrariesSource:
+    """Several Books libraries, consolidated into one set of annotations."""
+
+    def __init__(self, sources: Sequence[Tuple[pathlib.Path, pathlib.Path]], book_paths: bool = False):
+        """
+        Args:
+            sources: The database files of each library, from
+                booksdb.get_library_files.
+            book_paths: Also read the books' EPUB paths, for chapter names.
+        """
+        self.sources = list(sources)
+        self.book_paths = book_paths
+
+    def fetch(self) -> Extraction:
+        with profiling.stage('fetch_annotations'):
+            annotations = booksdb.fetch_libraries(self.sources)
+            identifiers: Dict[str, Dict[str, str]] = {}
+            book_paths: Dict[str, str] = {}
+            tombstones: List[Dict[str, Any]] = []
+            for files in self.sources:
+                identifiers.update(booksdb.fetch_book_identifiers(files))
+                tombstones.extend(booksdb.fetch_deleted_annotations(files=files))
+                if self.book_paths:
+                    book_paths.update(booksdb.fetch_book_paths(files))
+        # incremental syncs only follow the default library
+        return Extraction(annotations, identifiers, book_paths, tombstones)
+
+
+def source_from_config(config: Dict[str, Any], since: Optional[float] = None,
+                       incremental: bool = False) -> Union[BooksSource, LibrariesSource]:
+    """The libraries in `library_sources` if set, else the default library; see BooksSource."""
+    book_paths = bool(config.get('epub_chapters'))
+    sources = library_sources(config)
+    if sources:
+        return LibrariesSource(sources, book_paths)
+    return BooksSource(since, incremental, book_paths)
+
+
+class Book(NamedTuple):
+    """One book on its way through the stages, each of which fills in more of it."""
+    asset_id: str
+    # its live annotations; empty if all of them were deleted in Books
+    annotations: List[Dict[str, Any]]
+    # its annotations deleted in Books that are still in the exports
+    tombstones: List[Dict[str, Any]] = []
+    # ISBN/DOI, for an exact BibTeX match
+    identifiers: Optional[Dict[str, str]] = None
+    # normalized BibTeX metadata, from match
+    metadata: Optional[Dict[str, Any]] = None
+    # the validated model, from enrich
+    enriched: Optional['EnrichedJSON'] = None
+    # the JSON file the other exporters read, from export
+    json_path: Optional[pathlib.Path] = None
+
+    @property
+    def title(self) -> str:
+        return (self.annotations or self.tombstones)[0]['title']
+
+    @property
+    def author(self) -> str:
+        return (self.annotations or self.tombstones)[0]['author']
+
+    @property
+    def deleted_ids(self) -> List[str]:
+        return [t['annotation_id'] for t in self.tombstones]
+
+
+Sink = Callable[[Book], None]
+
+
+class SyncResult(NamedTuple):
+    """What a run of the pipeline did."""
+    # number of annotations extracted
+    annotations: int
+    # asset ids of the books exported
+    exported: List[str]
+    # the deleted annotations handled, to leave out of later runs
+    deleted: List[Dict[str, Any]]
+    # where the next incremental sync starts, if the source knows
+    last_modified: Optional[float]
+    # staged files moved into the output directories
+    changes: List['Change']
+
+
+def pending_deletions(extraction: Extraction, done: Iterable[str] = ()) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Groups the annotations deleted in Books by book, leaving out those already
+    removed from the exports and those live again (e.g. in another library).
+    """
+    live = {a['annotation_id'] for a in extraction.annotations}
+    done = set(done)
+    pending: Dict[str, List[Dict[str, Any]]] = {}
+    for tombstone in extraction.tombstones:
+        if tombstone['annotation_id'] not in live and tombstone['annotation_id'] not in done:
+            pending.setdefault(tombstone['asset_id'], []).append(tombstone)
+    return pending
+
+
+def _quiet(message: str) -> None:
+    pass
+
+
+class Pipeline:
+    """The stages of a sync, bound to a BibTeX library, the exporters and the sinks."""
+
+    def __init__(self, bib_librarian: 'BibTexLibrarian', json_exporter: 'JsonExporter',
+                 md_exporter: Optional['MarkdownExporter'] = None, csv_exporter: Optional['CsvExporter'] = None,
+                 search_index: Optional['HighlightIndex'] = None, chapters: Optional['ChapterEnricher'] = None,
+                 dedup: Optional[str] = None, staging: Optional['StagingArea'] = None,
+                 cache: Optional['FragmentCache'] = None, sinks: Optional[List[Sink]] = None,
+                 log: Optional[Log] = None):
+        """
+        Args:
+            bib_librarian: The BibTeX library books are matched against.
+            json_exporter: Writes the enriched JSON, which the other
+                exporters read.
+            md_exporter, csv_exporter, search_index: The default sinks.
+            chapters: Fills in missing chapter names from the EPUBs.
+            dedup: 'merge' or 'flag' overlapping highlights, see dedup.py.
+            staging: The staging area the exporters write into; committed
+                at the end of each run.
+            cache: The exporters' fragment cache, closed with the pipeline.
+            sinks: Called with each exported book, instead of the default
+                sinks; see ``default_sinks``.
+            log: Called with the progress messages, e.g. ``click.echo``.
+        """
+        self.bib_librarian = bib_librarian
+        self.json_exporter = json_exporter
+        self.md_exporter = md_exporter
+        self.csv_exporter = csv_exporter
+        self.search_index = search_index
+        self.chapters = chapters
+        self.dedup = dedup
+        self.staging = staging
+        self.cache = cache
+        self.sinks = self.default_sinks() if sinks is None else sinks
+        self.log = log or _quiet
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], dedup: Optional[str] = None,
+                    bib_librarian: Optional['BibTexLibrarian'] = None, log: Optional[Log] = None) -> 'Pipeline':
+        """
+        Creates the pipeline `sync` runs for a configuration.
+
+        Args:
+            config: The parsed configuration file.
+            dedup: Overrides `dedup` in the configuration.
+            bib_librarian: An already loaded BibTeX library to reuse, instead
+                of loading `bibtex_path`.
+            log: See ``__init__``.
+        """
+        from .bib import BibTexLibrarian
+        from .export_json import JsonExporter
+        from .export_md import MarkdownExporter
+        from .export_csv import CsvExporter
+
+        if bib_librarian is None:
+            with profiling.stage('bib_load'):
+                bib_librarian = BibTexLibrarian(config['bibtex_path'])
+
+        cache = None
+        if config.get('fragment_cache'):
+            from .fragments import FragmentCache, DEFAULT_MAX_ENTRIES
+
+            path = config.get('fragment_cache_path', os.path.join(config['json_output_dir'], '.fragment_cache.sqlite'))
+            cache = FragmentCache(path, max_entries=config.get('fragment_cache_size', DEFAULT_MAX_ENTRIES))
+
+        staging = None
+        if config.get('staging_dir'):
+            from .staging import StagingArea
+            staging = StagingArea(config['staging_dir'])
+
+        # the search index is only updated once `index` has created it
+        search_index = None
+        index_path = os.path.expanduser(search_index_path(config))
+        if os.path.exists(index_path):
+            from .search import HighlightIndex
+            search_index = HighlightIndex(index_path)
+
+        chapters = None
+        if config.get('epub_chapters'):
+            from .epub import ChapterEnricher
+
+            cache_path = config.get('epub_toc_cache', os.path.join(config['json_output_dir'], '.epub_toc_cache.json'))
+            chapters = ChapterEnricher(cache_path, epub_dir=config.get('epub_dir'))
+
+        return cls(bib_librarian,
+                   JsonExporter(config['json_output_dir'], staging=staging),
+                   MarkdownExporter(config['md_output_dir'], update=config.get('md_update', False), cache=cache,
+                                    staging=staging),
+                   CsvExporter(config['csv_output_dir'], cache=cache, staging=staging),
+                   search_index=search_index, chapters=chapters, dedup=dedup or config.get('dedup'),
+                   staging=staging, cache=cache, log=log)
+
+    def close(self) -> None:
+        """Closes the search index and the fragment cache."""
+        if self.search_index is not None:
+            self.search_index.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def default_sinks(self) -> List[Sink]:
+        """The search index (if any), Markdown and CSV exporters, in that order."""
+        sinks: List[Sink] = []
+        if self.search_index is not None:
+            sinks.append(self._index)
+        if self.md_exporter is not None:
+            sinks.append(self._export_markdown)
+        if self.csv_exporter is not None:
+            sinks.append(self._export_csv)
+        return sinks
+
+    def run(self, source: Any, done: Iterable[str] = ()) -> SyncResult:
+        """
+        Runs every stage over what ``source`` extracts, then saves the
+        exporters' indexes and commits the staged files.
+
+        Args:
+            source: Anything with a ``fetch()`` returning an Extraction, e.g.
+                BooksSource, LibrariesSource or an Extraction itself.
+            done: Ids of deleted annotations already removed from the exports.
+        """
+        extraction = source.fetch()
+        if not extraction.annotations and not extraction.tombstones:
+            return SyncResult(0, [], [], extraction.last_modified, [])
+        self.log(f"Found {len(extraction.annotations)} total annotations.")
+
+        deleted = pending_deletions(extraction, done)
+        if self.chapters is not None:
+            self.chapters.book_paths = extraction.book_paths
+
+        with profiling.current().hot_loop():
+            exported = [book.asset_id for book in self.export(self.enrich(self.match(self.group(extraction, deleted))))]
+
+        if self.md_exporter is not None:
+            self.md_exporter.save()
+        if self.chapters is not None:
+            self.chapters.save()
+        changes: List['Change'] = []
+        if self.staging is not None:
+            with profiling.stage('commit_staged'):
+                changes = self.staging.commit()
+
+        return SyncResult(len(extraction.annotations), exported,
+                          [t for tombstones in deleted.values() for t in tombstones],
+                          extraction.last_modified, changes)
+
+    def group(self, extraction: Extraction, deleted: Optional[Dict[str, List[Dict[str, Any]]]] = None) -> Iterator[Book]:
+        """
+        Splits the annotations into books, followed by the books none of whose
+        annotations are left but whose deletions are still to be exported.
+
+        Args:
+            extraction: What the source read.
+            deleted: The pending deletions by asset id, see ``pending_deletions``.
+        """
+        deleted = deleted or {}
+        with profiling.stage('group'):
+            key = itemgetter('asset_id')
+            grouped = {k: list(v) for k, v in groupby(sorted(extraction.annotations, key=key), key=key)}
+        self.log(f"Annotations are from {len(grouped)} different books.")
+
+        books = [Book(asset_id, annotations, deleted.get(asset_id, []), extraction.identifiers.get(asset_id))
+                 for asset_id, annotations in grouped.items()]
+        books += [Book(asset_id, [], tombstones, extraction.identifiers.get(asset_id))
+                  for asset_id, tombstones in deleted.items() if asset_id not in grouped]
+        for book in books:
+            # the later stages process a book before asking for the next,
+            # so they all run inside its stage
+            with profiling.stage('book', book=book.asset_id):
+                yield book
+
+    def match(self, books: Iterable[Book]) -> Iterator[Book]:
+        """Looks up each book's BibTeX entry, dropping the books without one."""
+        for book in books:
+            if book.annotations:
+                self.log(f"\nProcessing: {book.title} by {book.author}")
+                profiling.count('annotations', len(book.annotations), book=book.asset_id)
+
+            first = (book.annotations or book.tombstones)[0]
+            metadata = self.json_exporter.match(first, self.bib_librarian, book.identifiers)
+            if metadata is None:
+                if book.annotations:
+                    self.log(f"  ✗ Skipped (no BibTeX match found).")
+                    profiling.count('books_skipped')
+                continue
+            yield book._replace(metadata=metadata)
+
+    def enrich(self, books: Iterable[Book]) -> Iterator[Book]:
+        """
+        Fills in chapter names, merges or flags overlapping highlights and
+        validates each book. Books with only deletions left are read back
+        from their JSON instead, and dropped if they were never exported.
+        """
+        for book in books:
+            asset_id = book.asset_id
+            if not book.annotations:
+                enriched = self.json_exporter.remove(book.tombstones, book.metadata)
+                if enriched is not None:
+                    self.log(f"\nRemoving {len(book.tombstones)} deleted highlights of: {book.title} by {book.author}")
+                    yield book._replace(enriched=enriched)
+                continue
+
+            annotations = book.annotations
+            if self.chapters is not None:
+                with profiling.stage('epub_chapters', book=asset_id):
+                    filled = self.chapters.enrich(asset_id, annotations)
+                if filled:
+                    self.log(f"  ✓ Chapter names for {filled} highlights taken from the EPUB.")
+
+            if self.dedup:
+                from .dedup import dedup_annotations
+
+                with profiling.stage('dedup', book=asset_id):
+                    deduped = dedup_annotations(annotations, self.dedup)
+                if self.dedup == 'merge' and len(deduped) < len(annotations):
+                    self.log(f"  ✓ Merged {len(annotations) - len(deduped)} overlapping highlights.")
+                elif self.dedup == 'flag':
+                    flagged = sum(1 for a in deduped if a.get('overlaps_with'))
+                    if flagged:
+                        self.log(f"  ! {flagged} overlapping highlights flagged.")
+                annotations = deduped
+
+            yield book._replace(annotations=annotations,
+                                enriched=self.json_exporter.enrich(annotations, book.metadata))
+
+    def export(self, books: Iterable[Book]) -> Iterator[Book]:
+        """Writes each book's JSON (unless only deletions were removed from it) and passes it to the sinks."""
+        for book in books:
+            if book.annotations:
+                json_path = self.json_exporter.write(book.enriched)
+                self.log(f"  ✓ Enriched JSON created.")
+            else:
+                json_path = self.json_exporter.path_for(book.enriched.metadata)
+            book = book._replace(json_path=json_path)
+
+            for sink in self.sinks:
+                sink(book)
+
+            if book.annotations:
+                profiling.count('books_exported')
+            else:
+                self.log(f"  ✓ Deleted highlights removed.")
+                profiling.count('books_cleaned')
+            yield book
+
+    def _index(self, book: Book) -> None:
+        with profiling.stage('index', book=book.asset_id):
+            self.search_index.update(book.enriched)
+
+    def _export_markdown(self, book: Book) -> None:
+        # append new highlights, update changed ones with md_update
+        self.md_exporter.export(book.json_path, deleted=book.deleted_ids)
+        if book.annotations:
+            self.log(f"  ✓ Markdown export complete.")
+
+    def _export_csv(self, book: Book) -> None:
+        self.csv_exporter.export(book.json_path)
+        if book.annotations:
+            self.log(f"  ✓ CSV export complete.")
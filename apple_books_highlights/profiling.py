@@ -0,0 +1,238 @@
+"""
+Lightweight instrumentation for the sync pipeline.
+
+Stages are timed with named spans (``with profiling.stage('name'):``) and
+tallied with counters (``profiling.count('name')``). Both are routed to the
+currently active profiler, which by default is a no-op so uninstrumented runs
+pay next to nothing.
+"""
+import json
+import time
+import pathlib
+import contextlib
+from typing import List, Dict, Optional, Any, Iterator
+
+MIB = 1024 * 1024
+
+
+def _tracemalloc():
+    """tracemalloc, imported when memory is first traced; it pulls in pickle."""
+    import tracemalloc
+    return tracemalloc
+
+
+class StageStats:
+    """Accumulated timing and memory figures for one named stage."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.mem_peak = 0
+
+    def add(self, elapsed: float, mem_peak: int = 0) -> None:
+        self.calls += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.mem_peak = max(self.mem_peak, mem_peak)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'total_s': self.total,
+            'mean_ms': (self.total / self.calls * 1000) if self.calls else 0.0,
+            'max_ms': self.max * 1000,
+            'mem_peak_bytes': self.mem_peak,
+        }
+
+
+class _Frame:
+    __slots__ = ('start_mem', 'peak')
+
+    def __init__(self, start_mem: int):
+        self.start_mem = start_mem
+        self.peak = start_mem
+
+
+class Profiler:
+    """Collects per-stage timings, counters and peak memory for one run."""
+
+    enabled = True
+
+    def __init__(self, trace_memory: bool = True, cprofile_path: Optional[str] = None):
+        """
+        Args:
+            trace_memory: Track peak memory with tracemalloc (slows the run down).
+            cprofile_path: If given, dump cProfile stats of the hot loop here.
+        """
+        self.trace_memory = trace_memory
+        self.cprofile_path = cprofile_path
+        self.stages: Dict[str, StageStats] = {}
+        self.counters: Dict[str, int] = {}
+        self.books: Dict[str, Dict[str, float]] = {}
+        self.wall_time = 0.0
+        self.mem_peak = 0
+        self._stack: List[_Frame] = []
+        self._started: Optional[float] = None
+        self._cprofile = None
+
+    def start(self) -> None:
+        if self.trace_memory and not _tracemalloc().is_tracing():
+            _tracemalloc().start()
+        self._started = time.perf_counter()
+
+    def stop(self) -> None:
+        if self._started is not None:
+            self.wall_time = time.perf_counter() - self._started
+            self._started = None
+        if self.trace_memory and _tracemalloc().is_tracing():
+            self._update_peaks()
+            _tracemalloc().stop()
+
+    def _update_peaks(self) -> int:
+        current, peak = _tracemalloc().get_traced_memory()
+        for frame in self._stack:
+            frame.peak = max(frame.peak, peak)
+        self.mem_peak = max(self.mem_peak, peak)
+        return current
+
+    @contextlib.contextmanager
+    def stage(self, name: str, book: Optional[str] = None) -> Iterator[None]:
+        tracing = self.trace_memory and _tracemalloc().is_tracing()
+        if tracing:
+            # tracemalloc has a single peak counter, so fold it into every
+            # open frame before resetting it for the nested stage
+            current = self._update_peaks()
+            _tracemalloc().reset_peak()
+            self._stack.append(_Frame(current))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            mem_peak = 0
+            if tracing:
+                self._update_peaks()
+                frame = self._stack.pop()
+                mem_peak = frame.peak - frame.start_mem
+            if name not in self.stages:
+                self.stages[name] = StageStats(name)
+            self.stages[name].add(elapsed, mem_peak)
+            if book is not None:
+                stats = self.books.setdefault(book, {})
+                stats[name + '_s'] = stats.get(name + '_s', 0.0) + elapsed
+
+    def count(self, name: str, n: int = 1, book: Optional[str] = None) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+        if book is not None:
+            stats = self.books.setdefault(book, {})
+            stats[name] = stats.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def hot_loop(self) -> Iterator[None]:
+        """Runs the enclosed block under cProfile if a dump path was given."""
+        if not self.cprofile_path:
+            yield
+            return
+        import cProfile
+
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+        try:
+            yield
+        finally:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'wall_time_s': self.wall_time,
+            'mem_peak_bytes': self.mem_peak,
+            'stages': {name: s.to_dict() for name, s in self.stages.items()},
+            'counters': dict(self.counters),
+            'books': self.books,
+        }
+
+    def write_json(self, path: str) -> None:
+        output_path = pathlib.Path(path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self, top_books: int = 5) -> str:
+        """Formats the collected figures as a plain-text table."""
+        lines = [
+            f"{'stage':<24} {'calls':>7} {'total s':>9} {'mean ms':>9} {'max ms':>9} {'peak MiB':>9}",
+            '-' * 72,
+        ]
+        for s in sorted(self.stages.values(), key=lambda s: s.total, reverse=True):
+            d = s.to_dict()
+            lines.append(
+                f"{s.name:<24} {s.calls:>7} {s.total:>9.3f} {d['mean_ms']:>9.2f} "
+                f"{d['max_ms']:>9.2f} {s.mem_peak / MIB:>9.2f}"
+            )
+        lines.append('-' * 72)
+        lines.append(f"wall time: {self.wall_time:.3f} s")
+        if self.trace_memory:
+            lines.append(f"peak memory: {self.mem_peak / MIB:.2f} MiB")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name}: {value}")
+
+        # spans nest, so the largest per-book timing is the enclosing one
+        timed_books = [
+            (asset_id, max((v for k, v in stats.items() if k.endswith('_s')), default=0.0))
+            for asset_id, stats in self.books.items()
+        ]
+        timed_books.sort(key=lambda x: x[1], reverse=True)
+        if timed_books:
+            lines.append("slowest books:")
+            for asset_id, total in timed_books[:top_books]:
+                lines.append(f"  {asset_id[:8]:<8} {total:>9.3f} s")
+        return '\n'.join(lines)
+
+
+class NullProfiler(Profiler):
+    """Profiler that records nothing; the default when profiling is off."""
+
+    enabled = False
+
+    def __init__(self):
+        super().__init__(trace_memory=False)
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def stage(self, name: str, book: Optional[str] = None) -> contextlib.nullcontext:
+        return contextlib.nullcontext()
+
+    def count(self, name: str, n: int = 1, book: Optional[str] = None) -> None:
+        pass
+
+    def hot_loop(self) -> contextlib.nullcontext:
+        return contextlib.nullcontext()
+
+
+_active: Profiler = NullProfiler()
+
+
+def activate(profiler: Optional[Profiler]) -> Profiler:
+    """Makes ``profiler`` the target of module-level ``stage``/``count`` calls."""
+    global _active
+    _active = profiler if profiler is not None else NullProfiler()
+    return _active
+
+
+def current() -> Profiler:
+    return _active
+
+
+def stage(name: str, book: Optional[str] = None):
+    return _active.stage(name, book)
+
+
+def count(name: str, n: int = 1, book: Optional[str] = None) -> None:
+    _active.count(name, n, book)
@@ -0,0 +1,214 @@
+"""
+Full-text search over exported highlights, backed by an SQLite FTS5 index.
+
+The index is kept up to date from the enriched models ``JsonExporter``
+builds: only highlights whose text or metadata changed are rewritten, and
+highlights that disappeared from a book are removed. Only the standard
+library is used, so ``search`` starts quickly.
+"""
+import json
+import hashlib
+import pathlib
+import sqlite3
+from typing import TYPE_CHECKING, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    from .export_json import EnrichedJSON
+
+PathLike = Union[str, pathlib.Path]
+
+SCHEMA = """
+create table if not exists highlights (
+    id integer primary key,
+    annotation_id text not null unique,
+    asset_id text not null,
+    citation_key text,
+    title text,
+    authors text,
+    chapter text,
+    highlight text,
+    note text,
+    location text,
+    modified_date text,
+    content_hash text not null
+);
+create index if not exists highlights_asset on highlights (asset_id);
+
+create virtual table if not exists highlights_fts using fts5(
+    highlight, note, chapter, title, authors, citation_key,
+    content='highlights', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+create trigger if not exists highlights_ai after insert on highlights begin
+    insert into highlights_fts (rowid, highlight, note, chapter, title, authors, citation_key)
+    values (new.id, new.highlight, new.note, new.chapter, new.title, new.authors, new.citation_key);
+end;
+create trigger if not exists highlights_ad after delete on highlights begin
+    insert into highlights_fts (highlights_fts, rowid, highlight, note, chapter, title, authors, citation_key)
+    values ('delete', old.id, old.highlight, old.note, old.chapter, old.title, old.authors, old.citation_key);
+end;
+create trigger if not exists highlights_au after update on highlights begin
+    insert into highlights_fts (highlights_fts, rowid, highlight, note, chapter, title, authors, citation_key)
+    values ('delete', old.id, old.highlight, old.note, old.chapter, old.title, old.authors, old.citation_key);
+    insert into highlights_fts (rowid, highlight, note, chapter, title, authors, citation_key)
+    values (new.id, new.highlight, new.note, new.chapter, new.title, new.authors, new.citation_key);
+end;
+
+create table if not exists indexed_files (
+    path text primary key,
+    mtime_ns integer,
+    size integer
+);
+"""
+
+# bm25 column weights, in highlights_fts column order
+RANK_WEIGHTS = (10.0, 6.0, 2.0, 3.0, 1.0, 1.0)
+
+SEARCH_QUERY = """
+select
+    h.annotation_id, h.citation_key, h.title, h.authors, h.chapter, h.location,
+    snippet(highlights_fts, -1, ?, ?, '…', ?) as snippet,
+    bm25(highlights_fts, {weights}) as rank
+from highlights_fts
+join highlights h on h.id = highlights_fts.rowid
+where highlights_fts match ?
+order by rank
+limit ?
+""".format(weights=', '.join(str(w) for w in RANK_WEIGHTS))
+
+
+class SearchResult(NamedTuple):
+    annotation_id: str
+    citation_key: Optional[str]
+    title: Optional[str]
+    authors: Optional[str]
+    chapter: Optional[str]
+    location: Optional[str]
+    snippet: str
+    rank: float
+
+
+def _quote_terms(query: str) -> str:
+    """Turns free text into an FTS5 query that matches all of its words."""
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+
+class HighlightIndex:
+    """An FTS5 index of highlights, notes and book metadata."""
+
+    def __init__(self, path: PathLike):
+        """
+        Args:
+            path: The SQLite file holding the index; created if missing.
+        """
+        self.path = pathlib.Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    @staticmethod
+    def _rows(enriched: 'EnrichedJSON') -> Iterable[Tuple]:
+        meta = enriched.metadata
+        authors = '; '.join(meta.authors)
+        for ann in enriched.annotations:
+            modified = None if ann.modified_date is None else str(ann.modified_date)
+            fields = (ann.annotation_id, meta.asset_id, meta.citation_key, meta.title,
+                      authors, ann.chapter, ann.highlight, ann.note, ann.location, modified)
+            digest = hashlib.sha1(json.dumps(fields).encode('utf-8')).hexdigest()
+            yield fields + (digest,)
+
+    def update(self, enriched: 'EnrichedJSON') -> int:
+        """
+        Brings one book's highlights in the index up to date.
+
+        Args:
+            enriched: The enriched model of the book, as built by JsonExporter.
+
+        Returns:
+            The number of highlights inserted, updated or removed.
+        """
+        asset_id = enriched.metadata.asset_id
+        existing: Dict[str, str] = dict(self.conn.execute(
+            'select annotation_id, content_hash from highlights where asset_id = ?', (asset_id,)))
+
+        changed = []
+        for row in self._rows(enriched):
+            if existing.pop(row[0], None) != row[-1]:
+                changed.append(row)
+
+        with self.conn:
+            # unchanged rows are left alone so the FTS index isn't rewritten
+            self.conn.executemany("""
+                insert into highlights (annotation_id, asset_id, citation_key, title, authors,
+                                        chapter, highlight, note, location, modified_date, content_hash)
+                values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                on conflict (annotation_id) do update set
+                    asset_id = excluded.asset_id, citation_key = excluded.citation_key,
+                    title = excluded.title, authors = excluded.authors,
+                    chapter = excluded.chapter, highlight = excluded.highlight,
+                    note = excluded.note, location = excluded.location,
+                    modified_date = excluded.modified_date, content_hash = excluded.content_hash
+            """, changed)
+            # whatever is left was removed from the book
+            self.conn.executemany('delete from highlights where annotation_id = ?',
+                                  [(k,) for k in existing])
+
+        return len(changed) + len(existing)
+
+    def update_from_files(self, paths: Iterable[PathLike]) -> Tuple[int, int]:
+        """
+        Indexes enriched JSON files, skipping those unchanged since they were
+        last indexed.
+
+        Returns:
+            The number of files read and of highlights changed.
+        """
+        from .export_json import EnrichedJSON
+
+        seen = dict((p, (m, s)) for p, m, s in self.conn.execute('select * from indexed_files'))
+        files = changes = 0
+        for path in paths:
+            path = pathlib.Path(path)
+            st = path.stat()
+            stamp = (st.st_mtime_ns, st.st_size)
+            if seen.get(str(path)) == stamp:
+                continue
+            enriched = EnrichedJSON.model_validate_json(path.read_bytes())
+            changes += self.update(enriched)
+            files += 1
+            with self.conn:
+                self.conn.execute('insert or replace into indexed_files values (?, ?, ?)',
+                                  (str(path),) + stamp)
+        return files, changes
+
+    def search(self, query: str, limit: int = 20, start: str = '[', end: str = ']',
+               tokens: int = 16) -> List[SearchResult]:
+        """
+        Finds the highlights best matching ``query``, ranked with bm25.
+
+        Args:
+            query: An FTS5 query; plain text that isn't valid FTS5 syntax is
+                searched as a list of words.
+            limit: The maximum number of results.
+            start: Marker inserted before each match in the snippet.
+            end: Marker inserted after each match in the snippet.
+            tokens: The approximate snippet length, in tokens.
+
+        Returns:
+            The results, best first.
+        """
+        if not query.strip():
+            return []
+        args = (start, end, tokens)
+        try:
+            rows = self.conn.execute(SEARCH_QUERY, args + (query, limit)).fetchall()
+        except sqlite3.OperationalError:
+            rows = self.conn.execute(SEARCH_QUERY, args + (_quote_terms(query), limit)).fetchall()
+        return [SearchResult(*r) for r in rows]
+
+    def __len__(self) -> int:
+        return self.conn.execute('select count(*) from highlights').fetchone()[0]
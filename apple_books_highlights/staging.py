@@ -0,0 +1,137 @@
+"""
+Stages the exported files in a local directory and moves them into the output
+directories at the end of a sync.
+
+The exporters write every JSON, Markdown and CSV file of a sync into the
+staging tree instead of the output directories (which may be in a synced
+vault), and read the current version of a file from its staged copy if there
+is one, else from the output directory. ``commit`` then compares each staged
+file with the one it replaces, drops the unchanged ones, and renames the rest
+into place together, so the output directories only see the files that
+really changed and are never left with half of a sync's files written.
+"""
+import errno
+import os
+import pathlib
+import shutil
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+PathLike = Union[str, pathlib.Path]
+
+# suffix of new versions moved next to their targets, before the final renames
+PENDING_SUFFIX = '.staged'
+
+# marks a directory as a staging tree, so it is never mistaken for another
+MARKER_NAME = '.apple-books-highlights-staging'
+
+
+class StagingError(Exception):
+    pass
+
+
+class Change(NamedTuple):
+    """A file ``commit`` added to or replaced in an output directory."""
+    path: pathlib.Path
+    added: bool
+
+
+class StagingArea:
+    """A local tree with a staging directory per output directory."""
+
+    def __init__(self, path: PathLike):
+        """
+        Args:
+            path: The staging tree. Files left in it by an interrupted sync
+                are discarded.
+
+        Raises:
+            StagingError: ``path`` is a non-empty directory that isn't a
+                staging tree, e.g. the vault itself.
+        """
+        self.path = pathlib.Path(path).expanduser()
+        marker = self.path / MARKER_NAME
+        if self.path.is_dir() and not marker.exists() and any(self.path.iterdir()):
+            raise StagingError(f"{self.path} is not empty and not a staging directory; "
+                               f"point staging_dir at a new or empty directory")
+        self.path.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+        # staging directory -> output directory
+        self._targets: Dict[pathlib.Path, pathlib.Path] = {}
+
+    def directory(self, name: str, output_dir: PathLike) -> pathlib.Path:
+        """
+        Returns the staging directory for an output directory.
+
+        Args:
+            name: The exporter's name, e.g. 'md'; output directories may be shared.
+            output_dir: Where the files end up.
+        """
+        staged = self.path / name
+        if staged.exists():
+            shutil.rmtree(staged)
+        staged.mkdir()
+        target = pathlib.Path(output_dir)
+        target.mkdir(parents=True, exist_ok=True)
+        self._targets[staged] = target
+        return staged
+
+    def source(self, path: PathLike) -> pathlib.Path:
+        """The current version of a staged file: its staged copy if written yet, else the output file."""
+        path = pathlib.Path(path)
+        target = self._targets.get(path.parent)
+        if target is None or path.exists():
+            return path
+        return target / path.name
+
+    def _staged_changes(self) -> List[Tuple[pathlib.Path, pathlib.Path, bool]]:
+        """(staged file, output file, added) of the staged files that differ from their output files."""
+        changes = []
+        for staged_dir, target in self._targets.items():
+            for staged in sorted(staged_dir.iterdir()):
+                path = target / staged.name
+                if not path.exists():
+                    changes.append((staged, path, True))
+                elif path.stat().st_size != staged.stat().st_size or path.read_bytes() != staged.read_bytes():
+                    changes.append((staged, path, False))
+                else:
+                    staged.unlink()
+        return changes
+
+    def commit(self) -> List[Change]:
+        """
+        Moves the staged files that changed into the output directories.
+
+        The new versions are first moved (or copied, from another file
+        system) next to the files they replace, then all renamed into place.
+        Any left there by an interrupted commit are removed first.
+
+        Returns:
+            The files added or replaced, in the order they were committed.
+        """
+        # new versions left next to their targets by a commit that was interrupted
+        for target in set(self._targets.values()):
+            for leftover in target.glob('.*' + PENDING_SUFFIX):
+                leftover.unlink()
+
+        changes = self._staged_changes()
+
+        pending: List[Tuple[pathlib.Path, pathlib.Path]] = []
+        for staged, path, _ in changes:
+            temporary = path.with_name('.' + path.name + PENDING_SUFFIX)
+            try:
+                os.replace(staged, temporary)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copyfile(staged, temporary)
+                staged.unlink()
+            pending.append((temporary, path))
+
+        for temporary, path in pending:
+            os.replace(temporary, path)
+        return [Change(path, added) for _, path, added in changes]
+
+
+def source(path: PathLike, staging: Optional[StagingArea] = None) -> pathlib.Path:
+    """Where to read the current version of an exported file from."""
+    return pathlib.Path(path) if staging is None else staging.source(path)
@@ -0,0 +1,97 @@
+"""
+Persistent record of what the last successful sync saw.
+
+Kept deliberately free of heavy imports: the "nothing changed" check runs
+before any of the exporters are loaded.
+"""
+import os
+import json
+import pathlib
+from typing import Dict, Iterable, List, Optional, Any, Union
+
+PathLike = Union[str, pathlib.Path]
+
+# SQLite keeps recent writes in a write-ahead log next to the database
+SIDECAR_SUFFIXES = ('-wal',)
+
+
+def file_fingerprint(paths: Iterable[PathLike]) -> Dict[str, Optional[List[int]]]:
+    """
+    Returns ``[mtime_ns, size]`` for each path and its WAL file, or ``None``
+    for files that don't exist.
+    """
+    fingerprint: Dict[str, Optional[List[int]]] = {}
+    for path in paths:
+        path = str(path)
+        for candidate in (path,) + tuple(path + s for s in SIDECAR_SUFFIXES):
+            try:
+                st = os.stat(candidate)
+            except FileNotFoundError:
+                if candidate == path:
+                    fingerprint[candidate] = None
+                continue
+            fingerprint[candidate] = [st.st_mtime_ns, st.st_size]
+    return fingerprint
+
+
+class SyncState:
+    """JSON-backed state shared between sync runs."""
+
+    def __init__(self, path: PathLike):
+        self.path = pathlib.Path(path)
+        self.data: Dict[str, Any] = {}
+
+        if self.path.exists():
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.data = json.load(f)
+            except ValueError:
+                # a corrupt state file only costs us one full sync
+                self.data = {}
+
+    @property
+    def fingerprint(self) -> Optional[Dict[str, Any]]:
+        return self.data.get('fingerprint')
+
+    @fingerprint.setter
+    def fingerprint(self, value: Dict[str, Any]) -> None:
+        self.data['fingerprint'] = value
+
+    @property
+    def last_modified(self) -> Optional[float]:
+        """Latest annotation modification date (Core Data time) already synced."""
+        return self.data.get('last_modified')
+
+    @last_modified.setter
+    def last_modified(self, value: Optional[float]) -> None:
+        self.data['last_modified'] = value
+
+    @property
+    def deleted(self) -> Dict[str, Optional[float]]:
+        """
+        Modification dates of the annotations deleted in Books whose removal
+        was already exported, by id.
+        """
+        value = self.data.get('deleted', {})
+        # kept as a plain list of ids before the dates were recorded
+        return dict.fromkeys(value) if isinstance(value, list) else dict(value)
+
+    def record_deletions(self, tombstones: Iterable[Dict[str, Any]], last_modified: Optional[float]) -> None:
+        """
+        Adds the deletions a sync exported, and forgets those modified up to
+        ``last_modified``: later syncs only ask for deletions after it, so
+        they can't come back. (A full sync reads them again, but their
+        highlights are already gone from the exports.)
+        """
+        deleted = self.deleted
+        deleted.update((t['annotation_id'], t.get('modified_date')) for t in tombstones)
+        if last_modified is not None:
+            deleted = {i: m for i, m in deleted.items() if m is not None and m > last_modified}
+        self.data['deleted'] = deleted
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
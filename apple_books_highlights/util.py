@@ -1,13 +1,26 @@
 import os
 import re
+import stat
+import hashlib
 import pathlib
+import secrets
+import datetime as dt
 
-from typing import (List, Dict, Optional, Union, Any, Callable)
+from typing import (List, Dict, Optional, Tuple, Union, Any, Callable)
 from jinja2 import Environment, FileSystemLoader
 
 NS_TIME_INTERVAL_SINCE_1970 = 978307200
 
 
+def core_data_to_datetime(timestamp: Union[int, float]) -> dt.datetime:
+    """Converts a Core Data timestamp (seconds since 2001) to local time."""
+    return dt.datetime.fromtimestamp(NS_TIME_INTERVAL_SINCE_1970 + int(timestamp))
+
+
+def datetime_to_core_data(value: dt.datetime) -> float:
+    return value.timestamp() - NS_TIME_INTERVAL_SINCE_1970
+
+
 PATH = pathlib.Path(__file__).resolve().parent / 'templates'
 TEMPLATE_ENVIRONMENT = Environment(
     autoescape=False,
@@ -17,6 +30,57 @@ TEMPLATE_ENVIRONMENT = Environment(
 )
 
 
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _create_temporary(path: pathlib.Path) -> Tuple[int, str]:
+    """
+    Creates a new file next to ``path`` with the mode open() would give it:
+    the kernel applies the umask, which is never changed for the process.
+    """
+    while True:
+        name = str(path.with_name('.' + path.name + secrets.token_hex(4) + '.tmp'))
+        try:
+            return os.open(name, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666), name
+        except FileExistsError:
+            continue
+
+
+def atomic_write_text(path: pathlib.Path, text: str) -> None:
+    """
+    Writes ``text`` to a temporary file next to ``path`` and renames it into
+    place, so readers never see a partially written file. An existing file's
+    mode is kept.
+    """
+    fd, tmp_name = _create_temporary(path)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        try:
+            os.chmod(tmp_name, stat.S_IMODE(path.stat().st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+CFI_STEP = re.compile(r'/(\d+)')
+
+
+def _cfi_offsets(cfi: str) -> List[int]:
+    path, _, offset = cfi.partition(':')
+    offsets = [int(x) for x in CFI_STEP.findall(path)]
+    if offset:
+        offsets.append(int(offset))
+    return offsets
+
+
 def parse_epubcfi(raw: str) -> List[int]:
 
     if raw is None:
@@ -25,18 +89,26 @@ def parse_epubcfi(raw: str) -> List[int]:
     parts = raw[8:-1].split(',')
     cfistart = parts[0] + parts[1]
 
-    parts = cfistart.split(':')
+    return _cfi_offsets(cfistart)
 
-    path = parts[0]
-    offsets = [
-        int(x[1:])
-        for x in re.findall('(/\d+)', path)
-    ]
 
-    if len(parts) > 1:
-        offsets.append(int(parts[1]))
+def parse_epubcfi_range(raw: str) -> Optional[Tuple[List[int], List[int]]]:
+    """
+    Parses the start and end of an EPUB CFI range such as
+    ``epubcfi(/6/12[c]!/4/10,/1:0,/1:120)``. Offsets compare like
+    ``parse_epubcfi``; a CFI without a range starts and ends at one point.
+    """
+    if raw is None:
+        return None
 
-    return offsets
+    parts = raw[8:-1].split(',')
+    if len(parts) < 3:
+        point = _cfi_offsets(''.join(parts))
+        return point, point
+
+    # the shared parent path is parsed once for both ends
+    parent = _cfi_offsets(parts[0])
+    return parent + _cfi_offsets(parts[1]), parent + _cfi_offsets(parts[2])
 
 
 def epubcfi_compare(x: List[int], y: List[int]) -> int:
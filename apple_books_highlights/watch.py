@@ -0,0 +1,107 @@
+"""
+Polls the Apple Books databases for changes, for the long-running `watch`
+command.
+
+Only the standard library is used, so watching works the same on macOS and
+on Linux (e.g. against synthetic databases).
+"""
+import time
+import pathlib
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple, Union
+
+from apple_books_highlights.booksdb import readonly_uri
+from apple_books_highlights.state import file_fingerprint
+
+PathLike = Union[str, pathlib.Path]
+
+
+class DatabaseWatcher:
+    """
+    Detects writes to a set of SQLite files by polling their mtimes/sizes
+    (including the WAL files) and ``PRAGMA data_version``.
+    """
+
+    def __init__(self, paths: Iterable[PathLike], interval: float = 1.0,
+                 debounce: float = 2.0):
+        """
+        Args:
+            paths: The database files to watch.
+            interval: Seconds between polls.
+            debounce: Seconds the files must stay unchanged before a change
+                is reported, so a burst of writes triggers a single sync.
+        """
+        self.paths = [pathlib.Path(p) for p in paths]
+        self.interval = interval
+        self.debounce = debounce
+        self._connections: Dict[pathlib.Path, sqlite3.Connection] = {}
+        self._stop = threading.Event()
+        self._last = self.snapshot()
+
+    def _data_version(self, path: pathlib.Path) -> Optional[int]:
+        # data_version only changes when *another* connection commits, so a
+        # dedicated read-only connection is kept open per file
+        if path not in self._connections:
+            if not path.exists():
+                return None
+            self._connections[path] = sqlite3.connect(
+                readonly_uri(path), uri=True, check_same_thread=False)
+        try:
+            return self._connections[path].execute('pragma data_version').fetchone()[0]
+        except sqlite3.Error:
+            self._connections.pop(path).close()
+            return None
+
+    def snapshot(self) -> Tuple[Any, ...]:
+        versions = tuple(self._data_version(p) for p in self.paths)
+        return (file_fingerprint(self.paths), versions)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop.is_set()
+
+    def wait_for_change(self, timeout: Optional[float] = None) -> bool:
+        """
+        Blocks until the databases changed and then settled for ``debounce``
+        seconds.
+
+        Returns:
+            True on a change, False on timeout or when stopped.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            current = self.snapshot()
+            if current != self._last:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            if self._stop.wait(self.interval):
+                return False
+
+        quiet_since = time.monotonic()
+        while time.monotonic() - quiet_since < self.debounce:
+            if self._stop.wait(self.interval):
+                return False
+            latest = self.snapshot()
+            if latest != current:
+                current = latest
+                quiet_since = time.monotonic()
+
+        self._last = current
+        return True
+
+    def run(self, callback: Callable[[], Any]) -> None:
+        """Calls ``callback`` after every change until ``stop`` is called."""
+        while not self._stop.is_set():
+            if self.wait_for_change():
+                callback()
+
+    def close(self) -> None:
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
@@ -0,0 +1,6 @@
+"""
+Benchmarks for the sync pipeline, run against synthetic Books databases and
+BibTeX libraries so they work on any machine (Linux included).
+
+    python -m benchmarks.run --scale small
+"""
@@ -0,0 +1,106 @@
+"""
+Memory benchmark for the in-memory annotation model.
+
+Builds N ``models.Annotation`` records and compares their tracemalloc
+footprint with the previous ``__dict__``-based class, plus the cost of
+reading ``Book.is_modified`` repeatedly.
+
+    python -m benchmarks.memory --annotations 100000
+"""
+import argparse
+import datetime as dt
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, List, Optional
+
+from apple_books_highlights.models import Annotation, Book
+
+from benchmarks import synthetic
+
+
+class DictAnnotation(object):
+    """The pre-``__slots__`` annotation model, kept for comparison."""
+
+    def __init__(self, location: str, selected_text: str=None,
+                 note: str=None, represent_text: str=None, chapter: str=None,
+                 style: str=None, modified_date: dt.datetime=None) -> None:
+        stripspaces = lambda x : x.strip() if x else x
+        self.location = location
+        self.selected_text = stripspaces(selected_text)
+        self.represent_text = stripspaces(represent_text)
+        self.chapter = chapter
+        self.style = style
+        self.note = stripspaces(note)
+        self.modified_date = modified_date
+
+
+def make_rows(n: int, seed: int = 0) -> List[tuple]:
+    rng = random.Random(seed)
+    base = dt.datetime(2020, 1, 1)
+    return [
+        (
+            synthetic.epubcfi(1 + i % 20, f'chap{i % 20:02d}', rng.randint(1, 60), 0, 100),
+            f'highlight {i}',
+            None,
+            f'highlight {i}',
+            'Chapter',
+            str(rng.randint(0, 5)),
+            base + dt.timedelta(seconds=rng.randint(0, 10 ** 8)),
+        )
+        for i in range(n)
+    ]
+
+
+def measure(factory: Callable[..., Any], rows: List[tuple]) -> int:
+    """Returns the bytes allocated to hold one record per row."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = [factory(*row) for row in rows]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return after - before
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--annotations', type=int, default=100000)
+    parser.add_argument('--reads', type=int, default=1000,
+                        help='number of Book.is_modified reads to time')
+    args = parser.parse_args(argv)
+
+    rows = make_rows(args.annotations)
+    # the row strings themselves are shared, so only the records are measured
+    dict_bytes = measure(DictAnnotation, rows)
+    slot_bytes = measure(Annotation, rows)
+
+    print(f'{args.annotations} annotations')
+    print(f"{'model':<20} {'MiB':>8} {'bytes/record':>13}")
+    print('-' * 43)
+    for name, size in (('__dict__ (before)', dict_bytes), ('__slots__ (after)', slot_bytes)):
+        print(f'{name:<20} {size / 2 ** 20:>8.2f} {size / args.annotations:>13.1f}')
+    print(f'saving: {(1 - slot_bytes / dict_bytes) * 100:.0f}%')
+
+    book = Book(asset_id='BENCHMARK')
+    book.annotations = [Annotation(*row) for row in rows]
+    book._modified_date = dt.datetime(2030, 1, 1)
+
+    start = time.perf_counter()
+    for _ in range(args.reads):
+        book.is_modified
+    cached = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(min(args.reads, 20)):
+        max(a.modified_date for a in book.annotations) > book._modified_date
+    recomputed = (time.perf_counter() - start) / min(args.reads, 20) * args.reads
+
+    print(f'\n{args.reads} is_modified reads: {cached * 1000:.2f} ms cached, '
+          f'~{recomputed * 1000:.0f} ms if recomputed per read')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
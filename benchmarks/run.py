@@ -0,0 +1,427 @@
+"""
+Timed scenarios for the sync pipeline against synthetic fixtures.
+
+    python -m benchmarks.run --scale small
+    python -m benchmarks.run --scale small --record     # update baselines.json
+    python -m benchmarks.run --scale small --compare    # fail on regressions
+"""
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+from typing import Callable, Dict, List, Optional, Any
+
+from apple_books_highlights import booksdb
+from apple_books_highlights.bib import BibTexLibrarian
+from apple_books_highlights.export_json import JsonExporter
+from apple_books_highlights.export_md import MarkdownExporter
+from apple_books_highlights.export_csv import CsvExporter
+from apple_books_highlights.fragments import FragmentCache
+from apple_books_highlights.dedup import dedup_annotations
+from apple_books_highlights.epub import ChapterEnricher
+from apple_books_highlights.models import BookList, BOOK_INDEX_FILENAME
+from apple_books_highlights.pipeline import BooksSource, Pipeline
+from apple_books_highlights.search import HighlightIndex
+from apple_books_highlights.staging import StagingArea
+
+from benchmarks import synthetic
+
+BASELINES_PATH = pathlib.Path(__file__).resolve().parent / 'baselines.json'
+
+# books, annotations per book, .bib entries
+SCALES = {
+    'small': (20, 50, 300),
+    'medium': (100, 200, 1000),
+    'large': (400, 250, 3000),
+}
+
+REGRESSION_THRESHOLD = 1.25
+
+
+def timeit(fn: Callable[[], Any], repeat: int,
+           setup: Optional[Callable[[], Any]] = None) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+class Fixture:
+    """Synthetic databases, .bib and output directories for one scale."""
+
+    def __init__(self, root: pathlib.Path, books: int, annotations: int,
+                 bib_entries: int, seed: int = 0):
+        self.root = root
+        self.books = synthetic.make_books(books, seed=seed)
+        anno_dir, book_dir = synthetic.generate_books_databases(
+            root / 'db', self.books, annotations, seed=seed)
+        self.annotations_per_book = annotations
+        self.seed = seed
+        booksdb.set_database_paths(anno_dir, book_dir)
+        self.bib_path = synthetic.generate_bibtex(
+            root / 'library.bib', self.books, bib_entries, seed=seed)
+        self.out = root / 'out'
+        self.db_dir = root / 'db'
+        self.large_book_highlights = books * annotations
+
+    def exporters(self):
+        return (JsonExporter(self.out / 'json'),
+                MarkdownExporter(self.out / 'md'),
+                CsvExporter(self.out / 'csv'))
+
+
+def run_scenarios(fixture: Fixture, repeat: int) -> Dict[str, List[float]]:
+    results: Dict[str, List[float]] = {}
+
+    def extract():
+        booksdb.close_pool()
+        return booksdb.fetch_annotations(refresh=False)
+
+    results['extract'] = timeit(extract, repeat)
+
+    # one query per book, from worker threads sharing the connection pool
+    def extract_per_book():
+        booksdb.close_pool()
+        with ThreadPoolExecutor(max_workers=booksdb.POOL_SIZE) as pool:
+            return list(pool.map(booksdb.fetch_book_annotations, booksdb.fetch_annotated_asset_ids()))
+
+    results['extract_per_book'] = timeit(extract_per_book, repeat)
+
+    # deletions since the last sync, as an incremental sync asks for them
+    since = booksdb.fetch_max_modified_date() - 86400
+    results['extract_deleted'] = timeit(lambda: booksdb.fetch_deleted_annotations(since), repeat)
+
+    # The same extraction against a local, indexed mirror: building it once,
+    # the refresh check when nothing changed, and the query itself
+    mirror_path = fixture.root / 'mirror.sqlite'
+    booksdb.set_mirror_path(mirror_path)
+    results['mirror_build'] = timeit(lambda: booksdb.refresh_mirror(force=True), 1)
+    results['mirror_refresh_noop'] = timeit(booksdb.refresh_mirror, repeat)
+    results['extract_mirror'] = timeit(extract, repeat)
+    booksdb.set_mirror_path(None)
+
+    # Three libraries consolidated in one pass: the fixture, an identical
+    # snapshot of it and a library with different highlights of the same books
+    shutil.copytree(fixture.db_dir, fixture.root / 'db-copy')
+    synthetic.generate_books_databases(fixture.root / 'db-other', fixture.books,
+                                       fixture.annotations_per_book, seed=fixture.seed + 1)
+    sources = [booksdb.get_library_files(fixture.root / d) for d in ('db', 'db-copy', 'db-other')]
+    results['extract_libraries'] = timeit(lambda: booksdb.fetch_libraries(sources), repeat)
+
+    annotations = extract()
+    key = itemgetter('asset_id')
+    grouped = {k: list(v) for k, v in groupby(sorted(annotations, key=key), key=key)}
+
+    # Building the in-memory book models: from fetch_annotations dicts, and
+    # in a single pass over the raw cursor rows
+    ingest_dir = fixture.out / 'ingest'
+    ingest_dir.mkdir(parents=True, exist_ok=True)
+
+    def ingest_rows():
+        booksdb.close_pool()
+        BookList(ingest_dir).populate_rows(booksdb.iter_annotation_rows())
+
+    results['ingest_dicts'] = timeit(lambda: BookList(ingest_dir).populate_annotations(extract()), repeat)
+    results['ingest_rows'] = timeit(ingest_rows, repeat)
+
+    # Per-book notes written through models.BookList, loaded back cold (no
+    # header index) and warm (unchanged files aren't reopened)
+    notes_dir = fixture.out / 'notes'
+    notes_dir.mkdir(parents=True, exist_ok=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        book_list = BookList(notes_dir)
+        book_list.populate_annotations(annotations)
+        book_list.write_modified()
+
+    def drop_index():
+        (notes_dir / BOOK_INDEX_FILENAME).unlink(missing_ok=True)
+
+    results['booklist_load_cold'] = timeit(lambda: BookList(notes_dir), repeat, setup=drop_index)
+    results['booklist_load_warm'] = timeit(lambda: BookList(notes_dir), repeat)
+
+    def forced_write():
+        book_list = BookList(notes_dir)
+        book_list.populate_annotations(annotations)
+        with contextlib.redirect_stdout(io.StringIO()):
+            book_list.write_modified(force=True)
+
+    # a --force run over an already synced vault should write nothing
+    results['booklist_write_forced'] = timeit(forced_write, repeat)
+
+    # Chapter names from generated EPUBs: parsing every TOC, and the cached
+    # path where no EPUB is opened
+    epub_dir = synthetic.generate_epubs(fixture.root / 'epubs', fixture.books)
+    toc_cache = fixture.out / 'toc_cache.json'
+
+    def enrich_chapters():
+        enricher = ChapterEnricher(toc_cache, epub_dir=epub_dir)
+        for asset_id, annos in grouped.items():
+            enricher.enrich(asset_id, [dict(a) for a in annos])
+        enricher.save()
+
+    results['epub_chapters_cold'] = timeit(enrich_chapters, repeat, setup=lambda: toc_cache.unlink(missing_ok=True))
+    results['epub_chapters_warm'] = timeit(enrich_chapters, repeat)
+
+    # Overlapping-highlight detection for every book, and for one very large
+    # book whose highlights overlap often
+    results['dedup_flag'] = timeit(lambda: [dedup_annotations(a, 'flag') for a in grouped.values()], repeat)
+    results['dedup_merge'] = timeit(lambda: [dedup_annotations(a, 'merge') for a in grouped.values()], repeat)
+    large_book = synthetic.make_book_highlights(fixture.large_book_highlights)
+    results['dedup_large_book'] = timeit(lambda: dedup_annotations(large_book, 'merge'), repeat)
+
+    librarian = None
+
+    def bib_load():
+        nonlocal librarian
+        librarian = BibTexLibrarian(str(fixture.bib_path))
+
+    results['bib_load'] = timeit(bib_load, 1)
+
+    identifiers = booksdb.fetch_book_identifiers()
+
+    def match():
+        for asset_id, annos in grouped.items():
+            librarian.find_bibtex_entry(annos[0]['title'], [annos[0]['author']],
+                                        asset_id=asset_id, **identifiers.get(asset_id, {}))
+
+    def match_fuzzy():
+        for annos in grouped.values():
+            librarian._find_bibtex_entry(annos[0]['title'], [annos[0]['author']], 80, 80)
+
+    # the librarian caches matches, so start every repetition cold; exact
+    # keys first with fuzzy fallback, and fuzzy matching alone for reference
+    results['match'] = timeit(match, repeat, setup=lambda: librarian._match_cache.clear())
+    results['match_fuzzy'] = timeit(match_fuzzy, repeat)
+
+    # ...and leave it warm so the export scenarios don't re-time matching
+    match()
+
+    json_exporter, md_exporter, csv_exporter = fixture.exporters()
+    json_paths: List[pathlib.Path] = []
+
+    def export_json():
+        json_paths.clear()
+        for annos in grouped.values():
+            path = json_exporter.export([dict(a) for a in annos], librarian)
+            if path:
+                json_paths.append(path)
+
+    results['export_json'] = timeit(export_json, repeat)
+
+    # Full-text index: built from scratch, refreshed with nothing changed,
+    # and a batch of queries
+    models = [json_exporter.build([dict(a) for a in annos], librarian) for annos in grouped.values()]
+    models = [m for m in models if m is not None]
+    index_path = fixture.out / 'search.sqlite'
+
+    def build_index():
+        search_index = HighlightIndex(index_path)
+        for model in models:
+            search_index.update(model)
+        search_index.close()
+
+    results['index_build'] = timeit(build_index, repeat, setup=lambda: index_path.unlink(missing_ok=True))
+    results['index_update_noop'] = timeit(build_index, repeat)
+
+    search_index = HighlightIndex(index_path)
+    queries = ['theory', 'city knowledge', 'mark* NOT power', '"machine theory"', 'innovation culture']
+    results['search'] = timeit(lambda: [search_index.search(q) for q in queries], repeat)
+    search_index.close()
+
+    md_dir = fixture.out / 'md'
+
+    def clear_md():
+        shutil.rmtree(md_dir, ignore_errors=True)
+        md_dir.mkdir(parents=True)
+
+    def export_md():
+        for path in json_paths:
+            md_exporter.export(path)
+
+    results['export_md_create'] = timeit(export_md, repeat, setup=clear_md)
+
+    # Append scenario: start from notes holding ~80% of each book's highlights
+    partial_dir = fixture.root / 'partial-json'
+    partial_dir.mkdir(exist_ok=True)
+    partial_paths = []
+    for path in json_paths:
+        data = json.loads(path.read_text(encoding='utf-8'))
+        keep = int(len(data['annotations']) * 0.8)
+        data['annotations'] = data['annotations'][:keep]
+        partial = partial_dir / path.name
+        partial.write_text(json.dumps(data), encoding='utf-8')
+        partial_paths.append(partial)
+
+    def seed_md():
+        clear_md()
+        for path in partial_paths:
+            md_exporter.export(path)
+
+    results['export_md_append'] = timeit(export_md, repeat, setup=seed_md)
+
+    # Update scenario: ~5% of each book's highlights got a new note in Books
+    edited_dir = fixture.root / 'edited-json'
+    edited_dir.mkdir(exist_ok=True)
+    edited_paths = []
+    for path in json_paths:
+        data = json.loads(path.read_text(encoding='utf-8'))
+        for ann in data['annotations'][::20]:
+            ann['note'] = (ann.get('note') or '') + ' (edited)'
+        edited = edited_dir / path.name
+        edited.write_text(json.dumps(data), encoding='utf-8')
+        edited_paths.append(edited)
+
+    def seed_md_update():
+        clear_md()
+        seeder = MarkdownExporter(md_dir, update=True)
+        for path in json_paths:
+            seeder.export(path)
+        seeder.save()
+
+    def export_md_update():
+        updater = MarkdownExporter(md_dir, update=True)
+        for path in edited_paths:
+            updater.export(path)
+        updater.save()
+
+    results['export_md_update'] = timeit(export_md_update, repeat, setup=seed_md_update)
+
+    def export_csv():
+        for path in json_paths:
+            csv_exporter.export(path)
+
+    results['export_csv'] = timeit(export_csv, repeat)
+
+    # the same exports with a warm fragment cache: nothing is rendered
+    cache = FragmentCache(fixture.out / 'fragments.sqlite')
+    cached_md = MarkdownExporter(md_dir, cache=cache)
+    cached_csv = CsvExporter(fixture.out / 'csv', cache=cache)
+
+    def export_md_cached():
+        for path in json_paths:
+            cached_md.export(path)
+
+    def export_csv_cached():
+        for path in json_paths:
+            cached_csv.export(path)
+
+    clear_md()
+    export_md_cached()
+    export_csv_cached()
+    results['export_md_create_cached'] = timeit(export_md_cached, repeat, setup=clear_md)
+    results['export_csv_cached'] = timeit(export_csv_cached, repeat)
+    cache.close()
+
+    # the CSV exports again through a staging area: every file is compared
+    # with the unchanged one in place and none is moved
+    def export_csv_staged():
+        staging = StagingArea(fixture.root / 'staging')
+        staged_csv = CsvExporter(fixture.out / 'csv', staging=staging)
+        for path in json_paths:
+            staged_csv.export(path)
+        staging.commit()
+
+    results['export_csv_staged'] = timeit(export_csv_staged, repeat)
+
+    # a whole sync in-process, reusing the warm librarian as a long-lived
+    # process would; the notes exist, so Markdown only checks for new highlights
+    sync_pipeline = Pipeline(librarian, *fixture.exporters())
+    results['pipeline_run'] = timeit(lambda: sync_pipeline.run(BooksSource()), repeat)
+
+    return results
+
+
+def load_baselines() -> Dict[str, Any]:
+    if BASELINES_PATH.exists():
+        return json.loads(BASELINES_PATH.read_text(encoding='utf-8'))
+    return {}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--books', type=int, help='override the number of books')
+    parser.add_argument('--annotations', type=int, help='override annotations per book')
+    parser.add_argument('--bib-entries', type=int, help='override the number of .bib entries')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', action='store_true', help='store results as the baseline for this scale')
+    parser.add_argument('--compare', action='store_true', help='exit non-zero if a scenario regressed')
+    parser.add_argument('--keep', action='store_true', help='keep the generated fixture directory')
+    args = parser.parse_args(argv)
+
+    books, annotations, bib_entries = SCALES[args.scale]
+    books = args.books or books
+    annotations = args.annotations or annotations
+    bib_entries = args.bib_entries or bib_entries
+    custom = (books, annotations, bib_entries) != SCALES[args.scale]
+
+    root = pathlib.Path(tempfile.mkdtemp(prefix='abh-bench-'))
+    try:
+        print(f'Generating {books} books x {annotations} annotations, '
+              f'{bib_entries} .bib entries in {root}')
+        fixture = Fixture(root, books, annotations, bib_entries, seed=args.seed)
+        results = run_scenarios(fixture, args.repeat)
+    finally:
+        if args.keep:
+            print(f'Fixture kept at {root}')
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    baselines = load_baselines()
+    baseline = baselines.get(args.scale, {}).get('scenarios', {}) if not custom else {}
+
+    regressed = []
+    print(f"\n{'scenario':<20} {'median s':>10} {'min s':>10} {'baseline':>10} {'ratio':>7}")
+    print('-' * 61)
+    medians = {}
+    for name, times in results.items():
+        median = statistics.median(times)
+        medians[name] = median
+        base = baseline.get(name)
+        ratio = median / base if base else None
+        flag = ''
+        if ratio is not None and ratio > REGRESSION_THRESHOLD:
+            regressed.append(name)
+            flag = ' !'
+        print(f"{name:<20} {median:>10.4f} {min(times):>10.4f} "
+              f"{base if base is not None else float('nan'):>10.4f} "
+              f"{ratio if ratio is not None else float('nan'):>7.2f}{flag}")
+
+    if args.record:
+        if custom:
+            print('\nNot recording: baselines are only kept for the predefined scales.')
+        else:
+            baselines[args.scale] = {
+                'books': books,
+                'annotations_per_book': annotations,
+                'bib_entries': bib_entries,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'scenarios': {k: round(v, 6) for k, v in medians.items()},
+            }
+            BASELINES_PATH.write_text(json.dumps(baselines, indent=2) + '\n', encoding='utf-8')
+            print(f'\nBaseline recorded in {BASELINES_PATH}')
+
+    if args.compare and regressed:
+        print(f"\nRegressed (> {REGRESSION_THRESHOLD}x baseline): {', '.join(regressed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
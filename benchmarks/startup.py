@@ -0,0 +1,147 @@
+"""
+Startup-time benchmark for the CLI, based on ``python -X importtime``.
+
+Measures `--help` and a no-op `sync -n` (nothing changed since the last run)
+and fails if either pulls in a heavy dependency or exceeds the import budget.
+
+    python -m benchmarks.startup
+"""
+import argparse
+import os
+import pathlib
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks import synthetic
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+SCRIPT = ROOT / 'scripts' / 'apple-books-highlights.py'
+
+# Cumulative import time allowed on top of the bare interpreter, in ms
+# (best of --repeat runs, to keep scheduler noise out of the comparison)
+IMPORT_BUDGET_MS = 60.0
+
+# Lets the CLI cache its bytecode as an installed one does; without it every
+# run compiles the package from source, which isn't what users wait for
+CHILD_ENV = {k: v for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE'}
+
+HEAVY_MODULES = ('bibtexparser', 'thefuzz', 'rapidfuzz', 'pydantic', 'jinja2', 'tqdm', 'frontmatter')
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def parse_importtime(stderr: str) -> Tuple[float, List[str]]:
+    """Returns the total import time in ms and the top-level modules imported."""
+    total_us = 0
+    modules = []
+    for line in stderr.splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if not m:
+            continue
+        modules.append(m.group(4))
+        if not m.group(3):
+            total_us += int(m.group(2))
+    return total_us / 1000, modules
+
+
+def run_cli(args: List[str], cwd: Optional[pathlib.Path] = None,
+            importtime: bool = False) -> Tuple[float, str]:
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ['-X', 'importtime']
+    cmd += [str(SCRIPT)] + args
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True, env=CHILD_ENV)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed:\n{proc.stderr}")
+    return elapsed, proc.stderr
+
+
+def measure(args: List[str], repeat: int, cwd: Optional[pathlib.Path] = None) -> Dict[str, object]:
+    walls = [run_cli(args, cwd=cwd)[0] for _ in range(repeat)]
+    runs = [parse_importtime(run_cli(args, cwd=cwd, importtime=True)[1]) for _ in range(repeat)]
+    import_ms = min(r[0] for r in runs)
+    modules = runs[0][1]
+    heavy = sorted({m.split('.')[0] for m in modules if m.split('.')[0] in HEAVY_MODULES})
+    return {
+        'wall_ms': statistics.median(walls) * 1000,
+        'import_ms': import_ms,
+        'heavy': heavy,
+    }
+
+
+def make_noop_fixture(root: pathlib.Path) -> pathlib.Path:
+    """Builds a tiny library, syncs it once and returns the config path."""
+    books = synthetic.make_books(2)
+    anno_dir, book_dir = synthetic.generate_books_databases(root / 'db', books, 5)
+    bib_path = synthetic.generate_bibtex(root / 'library.bib', books, 10, matched_ratio=1.0)
+    config_path = root / 'config.yaml'
+    config_path.write_text(
+        f'bibtex_path: "{bib_path}"\n'
+        f'json_output_dir: "{root / "out" / "json"}"\n'
+        f'md_output_dir: "{root / "out" / "md"}"\n'
+        f'csv_output_dir: "{root / "out" / "csv"}"\n'
+        f'annotation_db_dir: "{anno_dir}"\n'
+        f'book_db_dir: "{book_dir}"\n',
+        encoding='utf-8'
+    )
+    run_cli(['--config', str(config_path), 'sync', '-n'])
+    return config_path
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=IMPORT_BUDGET_MS,
+                        help='import-time budget on top of the bare interpreter')
+    args = parser.parse_args(argv)
+
+    baseline = statistics.median(
+        _time([sys.executable, '-c', 'pass']) for _ in range(args.repeat))
+    baseline_import_ms = min(
+        parse_importtime(subprocess.run([sys.executable, '-X', 'importtime', '-c', 'pass'],
+                                        capture_output=True, text=True).stderr)[0]
+        for _ in range(args.repeat))
+
+    root = pathlib.Path(tempfile.mkdtemp(prefix='abh-startup-'))
+    try:
+        config_path = make_noop_fixture(root)
+        results = {
+            '--help': measure(['--help'], args.repeat),
+            'sync -n (no-op)': measure(['--config', str(config_path), 'sync', '-n'], args.repeat),
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    failed = False
+    print(f'bare interpreter: {baseline * 1000:.1f} ms wall, {baseline_import_ms:.1f} ms imports')
+    print(f"\n{'command':<18} {'wall ms':>9} {'import ms':>10} {'over bare':>10}  heavy imports")
+    print('-' * 70)
+    for name, r in results.items():
+        over = r['import_ms'] - baseline_import_ms
+        ok = over <= args.budget_ms and not r['heavy']
+        failed |= not ok
+        print(f"{name:<18} {r['wall_ms']:>9.1f} {r['import_ms']:>10.1f} {over:>10.1f}  "
+              f"{', '.join(r['heavy']) or '-'}{'' if ok else '  FAIL'}")
+
+    if failed:
+        print(f'\nStartup budget exceeded ({args.budget_ms:.0f} ms over bare, no heavy imports).')
+        return 1
+    return 0
+
+
+def _time(cmd: List[str]) -> float:
+    start = time.perf_counter()
+    subprocess.run(cmd, capture_output=True)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    sys.exit(main())
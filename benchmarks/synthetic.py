@@ -0,0 +1,406 @@
+"""
+Generates synthetic Apple Books databases and matching BibTeX libraries.
+
+The SQLite files mirror the parts of Apple's Core Data schema that the
+exporter reads (``ZAEANNOTATION`` and ``ZBKLIBRARYASSET``), laid out in the
+same AEAnnotation/BKLibrary directory structure that ``booksdb`` expects.
+"""
+import random
+import sqlite3
+import pathlib
+import uuid
+import zipfile
+from typing import List, Dict, Any, Tuple
+
+ANNOTATION_DB_NAME = 'AEAnnotation_v10312011_1727_local.sqlite'
+BOOK_DB_NAME = 'BKLibrary-1-091020131601.sqlite'
+
+# Core Data timestamps are seconds since 2001-01-01
+CORE_DATA_2020 = 599616000
+CORE_DATA_2025 = 757382400
+
+ANNOTATION_SCHEMA = """
+create table ZAEANNOTATION (
+    Z_PK integer primary key,
+    Z_ENT integer,
+    Z_OPT integer,
+    ZANNOTATIONDELETED integer,
+    ZANNOTATIONISUNDERLINE integer,
+    ZANNOTATIONSTYLE integer,
+    ZANNOTATIONTYPE integer,
+    ZPLLOCATIONRANGEEND integer,
+    ZPLLOCATIONRANGESTART integer,
+    ZANNOTATIONCREATIONDATE timestamp,
+    ZANNOTATIONMODIFICATIONDATE timestamp,
+    ZANNOTATIONASSETID varchar,
+    ZANNOTATIONLOCATION varchar,
+    ZANNOTATIONNOTE varchar,
+    ZANNOTATIONREPRESENTATIVETEXT varchar,
+    ZANNOTATIONSELECTEDTEXT varchar,
+    ZANNOTATIONUUID varchar,
+    ZFUTUREPROOFING5 varchar
+)
+"""
+
+# Core Data indexes the asset id, which per-book queries rely on
+ANNOTATION_INDEX = """
+create index ZAEANNOTATION_ZANNOTATIONASSETID_INDEX on ZAEANNOTATION (ZANNOTATIONASSETID)
+"""
+
+BOOK_SCHEMA = """
+create table ZBKLIBRARYASSET (
+    Z_PK integer primary key,
+    Z_ENT integer,
+    Z_OPT integer,
+    ZMODIFICATIONDATE timestamp,
+    ZASSETID varchar,
+    ZAUTHOR varchar,
+    ZBOOKDESCRIPTION varchar,
+    ZEPUBID varchar,
+    ZGENRE varchar,
+    ZPATH varchar,
+    ZSORTAUTHOR varchar,
+    ZSORTTITLE varchar,
+    ZSTOREID varchar,
+    ZTITLE varchar
+)
+"""
+
+WORDS = (
+    'history theory practice design systems culture organisation network '
+    'knowledge power market city future science mind nature language '
+    'economy society code machine learning innovation strategy change '
+    'evidence method infrastructure building craft work value risk time '
+    'memory story order chaos growth trust decision judgement habit'
+).split()
+
+FIRST_NAMES = (
+    'Andrew Yuval Mary Stephen Ada Grace Daniel Amos Kate Hannah Noam '
+    'Rachel Sherry Carlo Ursula Ruth Toni Octavia Ibram Bell'
+).split()
+
+LAST_NAMES = (
+    'McAfee Harari Beard Elms Lovelace Hopper Kahneman Tversky Raworth '
+    'Arendt Chomsky Carson Turkle Rovelli LeGuin Ginsburg Morrison Butler '
+    'Kendi Hooks'
+).split()
+
+CHAPTER_TITLES = (
+    'Introduction', 'Foundations', 'The Long View', 'Networks and Nodes',
+    'Against Method', 'Case Studies', 'Counterpoints', 'Conclusion',
+)
+
+
+def _sentence(rng: random.Random, lo: int, hi: int) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(lo, hi))]
+    words[0] = words[0].capitalize()
+    return ' '.join(words) + '.'
+
+
+def _title(rng: random.Random) -> str:
+    main = ' '.join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(2, 4)))
+    if rng.random() < 0.6:
+        sub = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 6)))
+        return f'{main}: The {sub}'
+    return main
+
+
+def _isbn13(rng: random.Random) -> str:
+    digits = [9, 7, 8] + [rng.randint(0, 9) for _ in range(9)]
+    check = (10 - sum(d * (1 if i % 2 == 0 else 3) for i, d in enumerate(digits)) % 10) % 10
+    return ''.join(map(str, digits + [check]))
+
+
+def epubcfi(spine_index: int, chapter_id: str, paragraph: int, start: int, end: int) -> str:
+    """Builds an Apple-style EPUB CFI range for a highlight."""
+    return (f'epubcfi(/6/{spine_index * 2}[{chapter_id}]!/4/{paragraph * 2},'
+            f'/1:{start},/1:{end})')
+
+
+def make_books(count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Builds ``count`` fake books with titles, authors and identifiers."""
+    rng = random.Random(seed)
+    books = []
+    for i in range(count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        books.append({
+            'asset_id': uuid.UUID(int=rng.getrandbits(128)).hex.upper(),
+            'title': _title(rng),
+            'first': first,
+            'last': last,
+            'author': f'{first} {last}',
+            'year': rng.randint(1950, 2025),
+            'isbn': _isbn13(rng),
+            'chapters': rng.randint(4, 30),
+        })
+    return books
+
+
+def generate_books_databases(directory: pathlib.Path, books: List[Dict[str, Any]],
+                             annotations_per_book: int, seed: int = 0,
+                             deleted_ratio: float = 0.02,
+                             note_ratio: float = 0.15) -> Tuple[pathlib.Path, pathlib.Path]:
+    """
+    Writes AEAnnotation/ and BKLibrary/ SQLite databases under ``directory``.
+
+    Returns:
+        The annotation and library directories, suitable for
+        ``booksdb.set_database_paths``.
+    """
+    rng = random.Random(seed)
+    directory = pathlib.Path(directory)
+    anno_dir = directory / 'AEAnnotation'
+    book_dir = directory / 'BKLibrary'
+    anno_dir.mkdir(parents=True, exist_ok=True)
+    book_dir.mkdir(parents=True, exist_ok=True)
+
+    book_db = sqlite3.connect(str(book_dir / BOOK_DB_NAME))
+    book_db.execute('drop table if exists ZBKLIBRARYASSET')
+    book_db.execute(BOOK_SCHEMA)
+    book_db.executemany(
+        'insert into ZBKLIBRARYASSET (Z_ENT, Z_OPT, ZMODIFICATIONDATE, ZASSETID, '
+        'ZAUTHOR, ZEPUBID, ZGENRE, ZPATH, ZSORTAUTHOR, ZSORTTITLE, ZSTOREID, ZTITLE) '
+        'values (5, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        [
+            (
+                rng.uniform(CORE_DATA_2020, CORE_DATA_2025),
+                b['asset_id'],
+                b['author'],
+                f"urn:isbn:{b['isbn']}",
+                rng.choice(['Nonfiction', 'History', 'Science', 'Business']),
+                f"/Books/{b['asset_id']}.epub",
+                f"{b['last']}, {b['first']}",
+                b['title'],
+                str(rng.randint(10 ** 8, 10 ** 10)),
+                b['title'],
+            )
+            for b in books
+        ]
+    )
+    book_db.commit()
+    book_db.close()
+
+    anno_db = sqlite3.connect(str(anno_dir / ANNOTATION_DB_NAME))
+    anno_db.execute('drop table if exists ZAEANNOTATION')
+    anno_db.execute(ANNOTATION_SCHEMA)
+    anno_db.execute(ANNOTATION_INDEX)
+
+    def rows():
+        for b in books:
+            chapters = b['chapters']
+            for n in range(annotations_per_book):
+                spine = 1 + (n * chapters) // annotations_per_book
+                paragraph = rng.randint(1, 60)
+                start = rng.randint(0, 400)
+                end = start + rng.randint(20, 600)
+                has_note = rng.random() < note_ratio
+                selected = _sentence(rng, 8, 60)
+                if has_note and rng.random() < 0.1:
+                    selected = None
+                created = rng.uniform(CORE_DATA_2020, CORE_DATA_2025)
+                yield (
+                    1 if rng.random() < deleted_ratio else 0,
+                    rng.randint(0, 5),
+                    spine * 100000 + paragraph * 1000 + start,
+                    spine * 100000 + paragraph * 1000 + end,
+                    created,
+                    created + rng.uniform(0, 86400 * 30),
+                    b['asset_id'],
+                    epubcfi(spine, f'chap{spine:02d}', paragraph, start, end),
+                    _sentence(rng, 4, 30) if has_note else None,
+                    selected,
+                    selected,
+                    str(uuid.UUID(int=rng.getrandbits(128))).upper(),
+                    (CHAPTER_TITLES[spine % len(CHAPTER_TITLES)]
+                     if rng.random() < 0.7 else None),
+                )
+
+    anno_db.executemany(
+        'insert into ZAEANNOTATION (Z_ENT, Z_OPT, ZANNOTATIONISUNDERLINE, ZANNOTATIONTYPE, '
+        'ZANNOTATIONDELETED, ZANNOTATIONSTYLE, ZPLLOCATIONRANGESTART, ZPLLOCATIONRANGEEND, '
+        'ZANNOTATIONCREATIONDATE, ZANNOTATIONMODIFICATIONDATE, ZANNOTATIONASSETID, '
+        'ZANNOTATIONLOCATION, ZANNOTATIONNOTE, ZANNOTATIONREPRESENTATIVETEXT, '
+        'ZANNOTATIONSELECTEDTEXT, ZANNOTATIONUUID, ZFUTUREPROOFING5) '
+        'values (3, 1, 0, 2, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        rows()
+    )
+    anno_db.commit()
+    anno_db.close()
+
+    return anno_dir, book_dir
+
+
+def make_book_highlights(count: int, seed: int = 0, overlap_ratio: float = 0.2,
+                         asset_id: str = 'LARGEBOOK') -> List[Dict[str, Any]]:
+    """
+    Builds ``count`` annotation dicts for one book, shaped like
+    ``booksdb.fetch_annotations`` rows. Highlight text is cut from each
+    paragraph at the CFI offsets, and about ``overlap_ratio`` of the
+    highlights extend or sit inside the previous one.
+    """
+    rng = random.Random(seed)
+    paragraphs: Dict[Tuple[int, int], str] = {}
+    annotations = []
+    previous = None
+    for n in range(count):
+        if previous is not None and rng.random() < overlap_ratio:
+            spine, paragraph, prev_start, prev_end = previous
+            start = rng.randint(prev_start, prev_end - 1)
+            end = max(start + 1, rng.randint(prev_start + 1, prev_end + 200))
+        else:
+            spine = 1 + (n * 40) // count
+            paragraph = rng.randint(1, 200)
+            start = rng.randint(0, 500)
+            end = start + rng.randint(20, 300)
+        text = paragraphs.get((spine, paragraph))
+        if text is None:
+            text = paragraphs[(spine, paragraph)] = ' '.join(_sentence(rng, 30, 60) for _ in range(4))
+        end = min(end, len(text))
+        start = min(start, end - 1)
+        previous = (spine, paragraph, start, end)
+        annotations.append({
+            'annotation_id': str(uuid.UUID(int=rng.getrandbits(128))).upper(),
+            'asset_id': asset_id,
+            'title': 'A Very Large Book',
+            'author': 'Some Author',
+            'location': epubcfi(spine, f'chap{spine:02d}', paragraph, start, end),
+            'selected_text': text[start:end],
+            'note': _sentence(rng, 4, 12) if rng.random() < 0.1 else None,
+            'represent_text': text[start:end],
+            'chapter': CHAPTER_TITLES[spine % len(CHAPTER_TITLES)],
+            'style': rng.randint(0, 5),
+            'modified_date': rng.uniform(CORE_DATA_2020, CORE_DATA_2025),
+        })
+    return annotations
+
+
+EPUB_CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+
+def epub_files(title: str, chapters: List[str], version: int = 3) -> Dict[str, str]:
+    """
+    Builds the files of a minimal EPUB whose spine has one XHTML file per
+    chapter, with ids chap01, chap02... as in ``epubcfi``. EPUB 3 books get a
+    nav document, EPUB 2 books an NCX.
+    """
+    ids = [f'chap{i:02d}' for i in range(1, len(chapters) + 1)]
+    items = '\n'.join(
+        f'    <item id="{i}" href="text/{i}.xhtml" media-type="application/xhtml+xml"/>' for i in ids)
+    itemrefs = '\n'.join(f'    <itemref idref="{i}"/>' for i in ids)
+    if version == 3:
+        toc_item = '    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+        spine_attr = ''
+    else:
+        toc_item = '    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+        spine_attr = ' toc="ncx"'
+
+    files = {
+        'mimetype': 'application/epub+zip',
+        'META-INF/container.xml': EPUB_CONTAINER,
+        'OEBPS/content.opf': (
+            f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<package xmlns="http://www.idpf.org/2007/opf" version="{version}.0" unique-identifier="id">\n'
+            f'  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>{title}</dc:title></metadata>\n'
+            f'  <manifest>\n{toc_item}\n{items}\n  </manifest>\n'
+            f'  <spine{spine_attr}>\n{itemrefs}\n  </spine>\n'
+            f'</package>\n'
+        ),
+    }
+    for i, name in zip(ids, chapters):
+        files[f'OEBPS/text/{i}.xhtml'] = (
+            f'<html xmlns="http://www.w3.org/1999/xhtml"><body><h1>{name}</h1>'
+            f'<p>{name}</p></body></html>\n'
+        )
+    if version == 3:
+        links = '\n'.join(f'      <li><a href="text/{i}.xhtml#top">{name}</a></li>'
+                          for i, name in zip(ids, chapters))
+        files['OEBPS/nav.xhtml'] = (
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops"><body>\n'
+            f'  <nav epub:type="toc"><ol>\n{links}\n  </ol></nav>\n</body></html>\n'
+        )
+    else:
+        points = '\n'.join(
+            f'    <navPoint id="p{n}" playOrder="{n}"><navLabel><text>{name}</text></navLabel>'
+            f'<content src="text/{i}.xhtml"/></navPoint>'
+            for n, (i, name) in enumerate(zip(ids, chapters), 1))
+        files['OEBPS/toc.ncx'] = (
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+            f'  <navMap>\n{points}\n  </navMap>\n</ncx>\n'
+        )
+    return files
+
+
+def generate_epubs(directory: pathlib.Path, books: List[Dict[str, Any]], seed: int = 0,
+                   unpacked_ratio: float = 0.3) -> pathlib.Path:
+    """
+    Writes ``<asset_id>.epub`` for each book into ``directory``, with chapter
+    titles for every spine position ``generate_books_databases`` uses. About
+    ``unpacked_ratio`` are unpacked directories, as Books stores them, and
+    half of the zipped ones are EPUB 2.
+    """
+    rng = random.Random(seed + 3)
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for b in books:
+        chapters = [f'{n}. {_sentence(rng, 2, 5)[:-1]}' for n in range(1, b['chapters'] + 1)]
+        path = directory / f"{b['asset_id']}.epub"
+        if rng.random() < unpacked_ratio:
+            for name, content in epub_files(b['title'], chapters).items():
+                (path / name).parent.mkdir(parents=True, exist_ok=True)
+                (path / name).write_text(content, encoding='utf-8')
+        else:
+            version = 3 if rng.random() < 0.5 else 2
+            with zipfile.ZipFile(str(path), 'w', zipfile.ZIP_DEFLATED) as zf:
+                for name, content in epub_files(b['title'], chapters, version).items():
+                    zf.writestr(name, content)
+    return directory
+
+
+def generate_bibtex(path: pathlib.Path, books: List[Dict[str, Any]], entries: int,
+                    seed: int = 0, matched_ratio: float = 0.9,
+                    isbn_ratio: float = 0.6) -> pathlib.Path:
+    """
+    Writes a .bib file with ``entries`` entries, including one for roughly
+    ``matched_ratio`` of ``books``; the rest are unrelated filler. About
+    ``isbn_ratio`` of the entries have an ISBN.
+    """
+    rng = random.Random(seed + 1)
+    matched = [b for b in books if rng.random() < matched_ratio][:entries]
+    fillers = make_books(max(entries - len(matched), 0), seed=seed + 2)
+
+    records = []
+    used_keys = set()
+    for b in matched + fillers:
+        key = f"{b['last']}{b['year']}-{''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(2))}"
+        while key in used_keys:
+            key += rng.choice('abcdefghijklmnopqrstuvwxyz')
+        used_keys.add(key)
+        # like real libraries, only some entries carry an ISBN, in varied formats
+        isbn = ''
+        if rng.random() < isbn_ratio:
+            value = b['isbn']
+            if rng.random() < 0.5:
+                value = f'{value[:3]}-{value[3]}-{value[4:9]}-{value[9:12]}-{value[12]}'
+            isbn = f"  isbn      = {{{value}}},\n"
+        records.append(
+            f"@BOOK{{{key},\n"
+            f"  title     = {{{b['title']}}},\n"
+            f"  author    = {{{b['last']}, {b['first']}}},\n"
+            f"  publisher = {{Synthetic Press}},\n"
+            f"  year      = {{{b['year']}}},\n"
+            f"{isbn}"
+            f"  language  = {{en}}\n"
+            f"}}\n"
+        )
+    rng.shuffle(records)
+
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text('\n'.join(records), encoding='utf-8')
+    return path
@@ -1,81 +1,238 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import yaml
+import os
+import sys
 import click
-from itertools import groupby
-from operator import itemgetter
+from datetime import datetime
 
-from apple_books_highlights import booksdb
-from apple_books_highlights.bib import BibTexLibrarian
-from apple_books_highlights.export_json import JsonExporter
-from apple_books_highlights.export_md import MarkdownExporter
-from apple_books_highlights.export_csv import CsvExporter
-
-def load_config(config_path='config.yaml'):
-    """Loads the YAML configuration file."""
-    with open(config_path, 'r') as f:
-        return yaml.safe_load(f)
+# Only lightweight modules are imported up front so that `--help` and the
+# "nothing changed" check start quickly; the exporters and their heavy
+# dependencies (bibtexparser, thefuzz, pydantic, jinja2) are imported by the
+# stages that use them.
+from apple_books_highlights import booksdb, pipeline, profiling
+from apple_books_highlights.state import SyncState, file_fingerprint
 
 @click.group()
-def cli():
+@click.option('--config', 'config_path', default='config.yaml', type=click.Path(dir_okay=False), help="Path to the configuration file.")
+@click.pass_context
+def cli(ctx, config_path):
     """Apple Books Highlights Export Tool"""
-    pass
+    ctx.obj = {'config_path': config_path}
 
 @cli.command()
 @click.option('--norefresh', '-n', default=False, is_flag=True, help="Disable refreshing the database by opening and closing Apple Books.")
-def sync(norefresh):
+@click.option('--force', '-f', default=False, is_flag=True, help="Run the full sync even if nothing changed since the last one.")
+@click.option('--dedup', type=click.Choice(['merge', 'flag']), default=None, help="Merge or flag overlapping highlights of the same passage (overrides `dedup` in the config).")
+@click.option('--profile', default=False, is_flag=True, help="Print per-stage timings, counters and peak memory after the sync.")
+@click.option('--profile-memory/--no-profile-memory', default=True, help="Track peak memory with tracemalloc while profiling (slows the run down considerably).")
+@click.option('--profile-json', type=click.Path(dir_okay=False), default=None, help="Write the profiling results as JSON to this path.")
+@click.option('--cprofile', type=click.Path(dir_okay=False), default=None, help="Dump cProfile stats of the per-book loop to this path.")
+@click.pass_context
+def sync(ctx, norefresh, force, dedup, profile, profile_memory, profile_json, cprofile):
     """Extracts highlights, enriches them with BibTeX, and exports to JSON, Markdown, and CSV."""
-    
+
+    profiler = None
+    if profile or profile_json or cprofile:
+        profiler = profiling.Profiler(trace_memory=profile_memory, cprofile_path=cprofile)
+    profiler = profiling.activate(profiler)
+    profiler.start()
+
+    try:
+        _sync(ctx.obj['config_path'], norefresh, force, dedup)
+    finally:
+        profiler.stop()
+        profiling.activate(None)
+
+    if profile:
+        click.echo("\n" + profiler.summary())
+    if profile_json:
+        profiler.write_json(profile_json)
+        click.echo(f"Profile written to {profile_json}")
+
+
+def _state_path(config):
+    return config.get('state_path', os.path.join(config['json_output_dir'], '.sync_state.json'))
+
+
+def _fingerprint(config, config_path, sources=None):
+    database_files = [f for files in sources for f in files] if sources else booksdb.get_database_files()
+    return file_fingerprint([*database_files, config['bibtex_path'], config_path])
+
+
+def _sync(config_path, norefresh, force, dedup=None):
     # T017: Load config
-    config = load_config()
-    bibtex_path = config['bibtex_path']
-    json_dir = config['json_output_dir']
-    md_dir = config['md_output_dir']
-    csv_dir = config['csv_output_dir']
+    with profiling.stage('load_config'):
+        config = pipeline.load_config(config_path)
+
+    pipeline.configure_databases(config)
+
+    if not norefresh:
+        booksdb.refresh_database()
+
+    # Skip the whole run when neither the databases, the .bib nor the config changed
+    sources = pipeline.library_sources(config)
+    state = SyncState(_state_path(config))
+    fingerprint = _fingerprint(config, config_path, sources)
+    if not force and state.fingerprint == fingerprint:
+        click.echo("Nothing changed since the last sync.")
+        return
 
     # Initialize exporters and librarian
-    bib_librarian = BibTexLibrarian(bibtex_path)
-    json_exporter = JsonExporter(json_dir)
-    md_exporter = MarkdownExporter(md_dir)
-    csv_exporter = CsvExporter(csv_dir)
-
-    # T018: Fetch all annotations
-    click.echo("Fetching annotations from Apple Books database...")
-    all_annotations = booksdb.fetch_annotations(refresh=not norefresh)
-    click.echo(f"Found {len(all_annotations)} total annotations.")
-
-    # T019: Group annotations by book (asset_id)
-    key = itemgetter('asset_id')
-    grouped_annotations = {k: list(v) for k, v in groupby(sorted(all_annotations, key=key), key=key)}
-    click.echo(f"Annotations are from {len(grouped_annotations)} different books.")
-
-    # --- Main Processing Loop ---
-    # T020 & T021: Process each book
-    for asset_id, annotations in grouped_annotations.items():
-        book_title = annotations[0]['title']
-        book_author = annotations[0]['author']
-        
-        click.echo(f"\nProcessing: {book_title} by {book_author}")
-
-        # 1. Enrich with BibTeX and create JSON
-        enriched_json_path = json_exporter.export(annotations, bib_librarian)
-
-        if not enriched_json_path:
-            click.echo(f"  ✗ Skipped (no BibTeX match found).")
-            continue
-        
-        click.echo(f"  ✓ Enriched JSON created.")
-
-        # 2. Export to Markdown (Append-Only)
-        md_exporter.export(enriched_json_path)
-        click.echo(f"  ✓ Markdown export complete.")
-
-        # 3. Export to CSV
-        csv_exporter.export(enriched_json_path)
-        click.echo(f"  ✓ CSV export complete.")
+    sync_pipeline = _load_pipeline(config, dedup=dedup)
+
+    # T018-T021: Fetch all annotations, then group, match, enrich and export them book by book
+    if sources is None:
+        click.echo("Fetching annotations from Apple Books database...")
+    else:
+        click.echo(f"Fetching annotations from {len(sources)} Apple Books libraries...")
+    source = pipeline.source_from_config(config, since=None if force else state.last_modified)
+    try:
+        result = sync_pipeline.run(source, done=state.deleted)
+    finally:
+        sync_pipeline.close()
+    _echo_changes(sync_pipeline, result)
 
+    _save_state(state, result, fingerprint)
     click.echo("\nSync complete!")
 
+
+def _load_pipeline(config, dedup=None):
+    from apple_books_highlights.staging import StagingError
+
+    try:
+        return pipeline.Pipeline.from_config(config, dedup=dedup, log=click.echo)
+    except StagingError as e:
+        raise click.UsageError(str(e))
+
+
+def _echo_changes(sync_pipeline, result):
+    """Lists the staged files a sync moved into the output directories."""
+    if sync_pipeline.staging is None:
+        return
+    if not result.changes:
+        click.echo("\nNo exported files changed.")
+        return
+    click.echo(f"\nCommitted {len(result.changes)} changed files:")
+    for change in result.changes:
+        click.echo(f"  {'A' if change.added else 'M'} {change.path}")
+
+
+def _save_state(state, result, fingerprint):
+    state.fingerprint = fingerprint
+    state.last_modified = result.last_modified
+    state.record_deletions(result.deleted, result.last_modified)
+    state.save()
+
+
+@cli.command()
+@click.option('--interval', default=1.0, show_default=True, help="Seconds between checks of the database files.")
+@click.option('--debounce', default=2.0, show_default=True, help="Seconds the databases must stay unchanged before syncing.")
+@click.pass_context
+def watch(ctx, interval, debounce):
+    """Keeps running and syncs changed books whenever the Books databases change."""
+    from apple_books_highlights.watch import DatabaseWatcher
+
+    config_path = ctx.obj['config_path']
+    config = pipeline.load_config(config_path)
+    if config.get('library_sources'):
+        raise click.UsageError("watch follows a single library; remove library_sources from the configuration to use it.")
+    pipeline.configure_databases(config)
+    state = SyncState(_state_path(config))
+
+    click.echo("Loading BibTeX library...")
+    sync_pipeline = _load_pipeline(config)
+
+    def sync_changes():
+        # the books changed since the last sync, or all of them before the first
+        source = pipeline.BooksSource(state.last_modified, incremental=True,
+                                      book_paths=bool(config.get('epub_chapters')))
+        result = sync_pipeline.run(source, done=state.deleted)
+        if result.annotations or result.deleted:
+            _echo_changes(sync_pipeline, result)
+            click.echo(f"\nSynced at {datetime.now():%H:%M:%S}.")
+        _save_state(state, result, _fingerprint(config, config_path))
+
+    def sync_or_log():
+        # a failed run (e.g. the databases locked while Books writes) leaves
+        # the state as it was, so its books are synced again on the next change
+        try:
+            sync_changes()
+        except Exception as e:
+            click.echo(f"\nSync failed at {datetime.now():%H:%M:%S}: {type(e).__name__}: {e}", err=True)
+
+    # catch up on anything that changed while we weren't running
+    sync_or_log()
+
+    watcher = DatabaseWatcher(booksdb.get_database_files(), interval=interval, debounce=debounce)
+    click.echo("Watching for changes (Ctrl-C to stop)...")
+    try:
+        watcher.run(sync_or_log)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        sync_pipeline.close()
+
+
+@cli.command()
+@click.pass_context
+def index(ctx):
+    """Creates or updates the full-text search index from the enriched JSON files."""
+    import glob
+    from apple_books_highlights.search import HighlightIndex
+
+    config = pipeline.load_config(ctx.obj['config_path'])
+    search_index = HighlightIndex(pipeline.search_index_path(config))
+    paths = sorted(glob.glob(os.path.join(os.path.expanduser(config['json_output_dir']), '*-ab.json')))
+    files, changes = search_index.update_from_files(paths)
+    click.echo(f"Indexed {files} changed of {len(paths)} books ({changes} highlights updated); "
+               f"{len(search_index)} highlights in {search_index.path}.")
+    search_index.close()
+
+
+@cli.command()
+@click.argument('query', nargs=-1, required=True)
+@click.option('--limit', '-l', default=20, show_default=True, help="Maximum number of results.")
+@click.pass_context
+def search(ctx, query, limit):
+    """Searches the exported highlights (run `index` first)."""
+    from apple_books_highlights.search import HighlightIndex
+
+    config = pipeline.load_config(ctx.obj['config_path'])
+    path = os.path.expanduser(pipeline.search_index_path(config))
+    if not os.path.exists(path):
+        raise click.UsageError("No search index yet; run the `index` command first.")
+
+    search_index = HighlightIndex(path)
+    start, end = (('\x1b[1m', '\x1b[0m') if sys.stdout.isatty() else ('**', '**'))
+    results = search_index.search(' '.join(query), limit=limit, start=start, end=end)
+    search_index.close()
+
+    for result in results:
+        chapter = f" — {result.chapter}" if result.chapter else ""
+        click.echo(f"{result.title} ({result.citation_key}){chapter}")
+        click.echo(f"    {result.snippet}\n")
+    if not results:
+        click.echo("No matches.")
+
+
+@cli.command()
+@click.option('--force', '-f', default=False, is_flag=True, help="Rebuild the mirror from scratch.")
+@click.pass_context
+def mirror(ctx, force):
+    """Creates or updates the local mirror of the Books databases."""
+    config = pipeline.load_config(ctx.obj['config_path'])
+    pipeline.configure_databases(config)
+    if booksdb.MIRROR_PATH is None:
+        raise click.UsageError("Set mirror_path in the configuration file to use a mirror.")
+
+    annotations, library = booksdb.refresh_mirror(force=force)
+    if annotations or library:
+        updated = ' and '.join(name for name, changed in (('annotations', annotations), ('library', library)) if changed)
+        click.echo(f"Mirror at {booksdb.MIRROR_PATH} updated ({updated}).")
+    else:
+        click.echo(f"Mirror at {booksdb.MIRROR_PATH} is up to date.")
+
 if __name__ == '__main__':
     cli()
\ No newline at end of file
@@ -0,0 +1,105 @@
+import json
+import sqlite3
+
+import pytest
+
+from apple_books_highlights import booksdb
+from apple_books_highlights.bib import BibTexLibrarian
+from apple_books_highlights.export_csv import CsvExporter
+from apple_books_highlights.export_json import JsonExporter
+from apple_books_highlights.export_md import DELETED_MARK_PATTERN, MarkdownExporter
+from apple_books_highlights.pipeline import BooksSource, Extraction, Pipeline, pending_deletions
+from apple_books_highlights.state import SyncState
+from benchmarks import synthetic
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    books = synthetic.make_books(2)
+    anno_dir, book_dir = synthetic.generate_books_databases(tmp_path / 'db', books, 6, deleted_ratio=0)
+    bib_path = synthetic.generate_bibtex(tmp_path / 'library.bib', books, 10, matched_ratio=1.0)
+    # the database paths are module state; restore them for the other tests
+    monkeypatch.setattr(booksdb, 'ANNOTATION_DB_PATH', booksdb.ANNOTATION_DB_PATH)
+    monkeypatch.setattr(booksdb, 'BOOK_DB_PATH', booksdb.BOOK_DB_PATH)
+    monkeypatch.setattr(booksdb, 'MIRROR_PATH', None)
+    booksdb.set_database_paths(anno_dir, book_dir)
+    yield booksdb.get_library_files(tmp_path / 'db')[0], bib_path
+    booksdb.close_pool()
+
+
+def _pipeline(out, bib_path):
+    return Pipeline(BibTexLibrarian(str(bib_path)), JsonExporter(out / 'json'),
+                    MarkdownExporter(str(out / 'md'), update=True), CsvExporter(str(out / 'csv')))
+
+
+def _exported(out):
+    """Annotation ids by asset id, and the Markdown file, of each exported book."""
+    books = {}
+    for path in (out / 'json').glob('*.json'):
+        data = json.loads(path.read_text(encoding='utf-8'))
+        md_path = out / 'md' / (path.stem + '.md')
+        books[data['metadata']['asset_id']] = ([a['annotation_id'] for a in data['annotations']], md_path)
+    return books
+
+
+def _delete(annotation_file, annotation_ids, modified):
+    conn = sqlite3.connect(str(annotation_file))
+    with conn:
+        conn.executemany('update ZAEANNOTATION set ZANNOTATIONDELETED = 1, ZANNOTATIONMODIFICATIONDATE = ? '
+                         'where ZANNOTATIONUUID = ?', [(modified, i) for i in annotation_ids])
+    conn.close()
+    booksdb.close_pool()
+
+
+def test_deleted_highlights_are_removed_from_the_exports(tmp_path, library):
+    annotation_file, bib_path = library
+    out = tmp_path / 'out'
+    state = SyncState(tmp_path / 'state.json')
+
+    first = _pipeline(out, bib_path).run(BooksSource())
+    (edited_book, (edited_ids, edited_md)), (emptied_book, (emptied_ids, emptied_md)) = sorted(_exported(out).items())
+    removed, hand_edited = edited_ids[:2]
+    content = edited_md.read_text(encoding='utf-8')
+    marker = f'<!-- an_id: {hand_edited} -->\n- '
+    edited_md.write_text(content.replace(marker, marker + 'MY EDIT '), encoding='utf-8')
+
+    _delete(annotation_file, [removed, hand_edited] + emptied_ids, first.last_modified + 10)
+    result = _pipeline(out, bib_path).run(BooksSource(first.last_modified, incremental=True), done=state.deleted)
+
+    assert sorted(t['annotation_id'] for t in result.deleted) == sorted([removed, hand_edited] + emptied_ids)
+    exported = _exported(out)
+    assert exported[edited_book][0] == edited_ids[2:]
+    assert exported[emptied_book][0] == []
+    csv_text = ''.join(p.read_text(encoding='utf-8') for p in (out / 'csv').glob('*.csv'))
+    assert removed not in csv_text and hand_edited not in csv_text
+
+    # an unedited block is removed, one edited by hand is kept and marked
+    content = edited_md.read_text(encoding='utf-8')
+    assert removed not in content
+    assert 'MY EDIT' in content
+    assert DELETED_MARK_PATTERN.search(content, 0, content.index(f'<!-- an_id: {hand_edited} -->'))
+    assert '<!-- an_id: ' not in emptied_md.read_text(encoding='utf-8')
+
+    # handled deletions are left out of later runs, and then forgotten
+    state.record_deletions(result.deleted, first.last_modified)
+    assert set(state.deleted) == {t['annotation_id'] for t in result.deleted}
+    again = _pipeline(out, bib_path).run(BooksSource(first.last_modified, incremental=True), done=state.deleted)
+    assert again.deleted == []
+    assert edited_md.read_text(encoding='utf-8') == content
+    state.record_deletions(again.deleted, again.last_modified)
+    assert state.deleted == {}
+
+
+def test_pending_deletions_skip_handled_and_live_annotations():
+    tombstones = [{'annotation_id': i, 'asset_id': 'A'} for i in ('live', 'done', 'new')]
+    extraction = Extraction([{'annotation_id': 'live'}], tombstones=tombstones)
+    assert pending_deletions(extraction, done=['done']) == {'A': [tombstones[2]]}
+
+
+def test_state_reads_deletions_recorded_as_a_list(tmp_path):
+    path = tmp_path / 'state.json'
+    path.write_text(json.dumps({'deleted': ['a', 'b']}), encoding='utf-8')
+    state = SyncState(path)
+    assert state.deleted == {'a': None, 'b': None}
+    state.record_deletions([{'annotation_id': 'c', 'modified_date': 20.0}], 10.0)
+    assert state.deleted == {'c': 20.0}
@@ -0,0 +1,86 @@
+import json
+
+from apple_books_highlights.export_md import MarkdownExporter
+from apple_books_highlights.fragments import FragmentCache
+
+
+def _write_book(path, note):
+    data = {
+        'metadata': {
+            'asset_id': 'A1', 'citation_key': 'Doe2020', 'title': 'A Book', 'authors': ['Jane Doe'],
+            'editors': [], 'year': 2020, 'entry_type': 'book', 'short_title': 'A Book',
+        },
+        'annotations': [
+            {'annotation_id': 'X1', 'highlight': 'First highlight', 'note': note, 'color': 3, 'chapter': 'One'},
+            {'annotation_id': 'X2', 'highlight': 'Second highlight', 'note': None, 'color': 1, 'chapter': None},
+        ],
+    }
+    path.write_text(json.dumps(data), encoding='utf-8')
+    return path
+
+
+def test_update_keeps_user_text_under_a_memo(tmp_path):
+    json_path = tmp_path / 'book.json'
+    md_dir = tmp_path / 'md'
+
+    exporter = MarkdownExporter(str(md_dir), update=True)
+    exporter.export(str(_write_book(json_path, 'old note')))
+    exporter.save()
+    md_path = md_dir / 'Doe2020 book-ab.md'
+    content = md_path.read_text(encoding='utf-8')
+    assert '> old note\n' in content
+    md_path.write_text(content.replace('> old note\n', '> old note\nMY OWN THOUGHTS\nand more of them\n'),
+                       encoding='utf-8')
+
+    exporter = MarkdownExporter(str(md_dir), update=True)
+    exporter.export(str(_write_book(json_path, 'new note')))
+    exporter.save()
+
+    content = md_path.read_text(encoding='utf-8')
+    assert '> new note\nMY OWN THOUGHTS\nand more of them\n' in content
+    assert 'old note' not in content
+    assert content.count('<!-- an_id: X2 -->') == 1
+
+
+def test_update_leaves_unrecorded_blocks_edited_by_hand(tmp_path):
+    json_path = _write_book(tmp_path / 'book.json', 'a note')
+    md_dir = tmp_path / 'md'
+
+    # written before md_update was enabled, so the blocks have no record
+    MarkdownExporter(str(md_dir)).export(str(json_path))
+    md_path = md_dir / 'Doe2020 book-ab.md'
+    content = md_path.read_text(encoding='utf-8')
+    edited = content.replace('> tags: #general-ab\n', '> tags: #general-ab #my-own-tag\n')
+    edited = edited.replace('First highlight', 'First highlight, typo fixed')
+    assert edited != content
+    md_path.write_text(edited, encoding='utf-8')
+
+    exporter = MarkdownExporter(str(md_dir), update=True)
+    exporter.export(str(json_path))
+    exporter.save()
+
+    assert md_path.read_text(encoding='utf-8') == edited
+    records = json.loads((md_dir / '.md_blocks.json').read_text(encoding='utf-8'))['Doe2020 book-ab.md']
+    # the untouched block is adopted, the edited one isn't
+    assert set(records) == {'X2'}
+
+
+def _without_dates(content):
+    return [line for line in content.splitlines() if not line.startswith(('creation:', 'modified:', '## Highlights'))]
+
+
+def test_new_note_reuses_cached_blocks(tmp_path):
+    json_path = _write_book(tmp_path / 'book.json', 'a note')
+    cache = FragmentCache(tmp_path / 'fragments.sqlite')
+    try:
+        MarkdownExporter(str(tmp_path / 'rendered'), cache=cache).export(str(json_path))
+
+        exporter = MarkdownExporter(str(tmp_path / 'cached'), cache=cache)
+        exporter.blocks_template = exporter.block_template = None  # rendering would fail
+        exporter.export(str(json_path))
+    finally:
+        cache.close()
+
+    rendered = (tmp_path / 'rendered' / 'Doe2020 book-ab.md').read_text(encoding='utf-8')
+    cached = (tmp_path / 'cached' / 'Doe2020 book-ab.md').read_text(encoding='utf-8')
+    assert _without_dates(cached) == _without_dates(rendered)
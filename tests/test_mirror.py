@@ -0,0 +1,64 @@
+import sqlite3
+
+from apple_books_highlights import booksdb
+from apple_books_highlights.mirror import ANNOTATION_TABLE, ASSET_TABLE, BooksMirror
+from benchmarks import synthetic
+
+
+def _library(directory, annotations_per_book=5):
+    synthetic.generate_books_databases(directory, synthetic.make_books(3), annotations_per_book)
+    return booksdb.get_library_files(directory)
+
+
+def _rows(path, table):
+    conn = sqlite3.connect(str(path))
+    try:
+        return sorted(conn.execute(f'select * from {table}'))
+    finally:
+        conn.close()
+
+
+def test_refresh_copies_databases_whose_path_needs_quoting(tmp_path):
+    annotation_file, assets_file = _library(tmp_path / 'Books?#1 100%')
+    mirror = BooksMirror(tmp_path / 'mirror.sqlite')
+
+    assert mirror.refresh(annotation_file, assets_file) == (True, True)
+    assert _rows(mirror.path, ANNOTATION_TABLE) == _rows(annotation_file, ANNOTATION_TABLE)
+    assert _rows(mirror.path, ASSET_TABLE) == _rows(assets_file, ASSET_TABLE)
+
+
+def test_refresh_copies_only_what_changed(tmp_path):
+    annotation_file, assets_file = _library(tmp_path / 'library')
+    mirror = BooksMirror(tmp_path / 'mirror.sqlite')
+    mirror.refresh(annotation_file, assets_file)
+    assert mirror.refresh(annotation_file, assets_file) == (False, False)
+
+    source = sqlite3.connect(str(annotation_file))
+    with source:
+        first, last = source.execute(f'select min(Z_PK), max(Z_PK) from {ANNOTATION_TABLE}').fetchone()
+        source.execute(f"update {ANNOTATION_TABLE} set ZANNOTATIONNOTE = 'edited', Z_OPT = Z_OPT + 1 "
+                       f"where Z_PK = ?", (first,))
+        source.execute(f'delete from {ANNOTATION_TABLE} where Z_PK = ?', (last,))
+        source.execute(f'insert into {ANNOTATION_TABLE} (Z_PK, Z_ENT, Z_OPT, ZANNOTATIONDELETED, '
+                       f"ZANNOTATIONASSETID, ZANNOTATIONSELECTEDTEXT) values (?, 3, 1, 0, 'NEW', 'new')",
+                       (last + 1,))
+    source.close()
+
+    assert mirror.refresh(annotation_file, assets_file) == (True, False)
+    assert _rows(mirror.path, ANNOTATION_TABLE) == _rows(annotation_file, ANNOTATION_TABLE)
+    assert _rows(mirror.path, ASSET_TABLE) == _rows(assets_file, ASSET_TABLE)
+
+
+def test_refresh_copies_everything_again_when_the_schema_changes(tmp_path):
+    annotation_file, assets_file = _library(tmp_path / 'library')
+    mirror = BooksMirror(tmp_path / 'mirror.sqlite')
+    mirror.refresh(annotation_file, assets_file)
+
+    source = sqlite3.connect(str(annotation_file))
+    with source:
+        source.execute(f'alter table {ANNOTATION_TABLE} add column ZNEWCOLUMN integer')
+        source.execute(f'update {ANNOTATION_TABLE} set ZNEWCOLUMN = 1')
+    source.close()
+
+    assert mirror.refresh(annotation_file, assets_file) == (True, True)
+    assert _rows(mirror.path, ANNOTATION_TABLE) == _rows(annotation_file, ANNOTATION_TABLE)
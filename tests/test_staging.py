@@ -0,0 +1,91 @@
+import errno
+import os
+import pathlib
+
+import pytest
+
+from apple_books_highlights import staging as staging_module
+from apple_books_highlights.staging import Change, StagingArea, StagingError
+
+
+@pytest.fixture
+def output(tmp_path):
+    output = tmp_path / 'out'
+    output.mkdir()
+    (output / 'same.md').write_text('same', encoding='utf-8')
+    (output / 'changed.md').write_text('old', encoding='utf-8')
+    return output
+
+
+def _stage(area, output):
+    staged = area.directory('md', output)
+    (staged / 'same.md').write_text('same', encoding='utf-8')
+    (staged / 'changed.md').write_text('new', encoding='utf-8')
+    (staged / 'added.md').write_text('added', encoding='utf-8')
+    return staged
+
+
+def _files(directory):
+    return {p.name: p.read_text(encoding='utf-8') for p in directory.iterdir()}
+
+
+def test_commit_moves_only_the_changed_files(tmp_path, output):
+    area = StagingArea(tmp_path / 'staging')
+    staged = _stage(area, output)
+    same_mtime = (output / 'same.md').stat().st_mtime_ns
+    # exporters read the staged copy once it is written, else the output file
+    assert area.source(staged / 'changed.md') == staged / 'changed.md'
+    assert area.source(staged / 'missing.md') == output / 'missing.md'
+
+    changes = area.commit()
+
+    assert changes == [Change(output / 'added.md', True), Change(output / 'changed.md', False)]
+    assert _files(output) == {'same.md': 'same', 'changed.md': 'new', 'added.md': 'added'}
+    assert (output / 'same.md').stat().st_mtime_ns == same_mtime
+    assert list(staged.iterdir()) == []
+
+
+def test_commit_copies_across_file_systems(tmp_path, output, monkeypatch):
+    area = StagingArea(tmp_path / 'staging')
+    staged = _stage(area, output)
+    replace = os.replace
+    copied = []
+
+    def cross_device_replace(src, dst):
+        # the staging tree is on another file system than the output
+        if pathlib.Path(src).parent == staged:
+            copied.append(pathlib.Path(src).name)
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        replace(src, dst)
+
+    monkeypatch.setattr(staging_module.os, 'replace', cross_device_replace)
+    changes = area.commit()
+
+    assert copied == ['added.md', 'changed.md']
+    assert [c.path.name for c in changes] == ['added.md', 'changed.md']
+    assert _files(output) == {'same.md': 'same', 'changed.md': 'new', 'added.md': 'added'}
+    assert list(staged.iterdir()) == []
+
+
+def test_commit_removes_files_left_by_an_interrupted_commit(tmp_path, output):
+    (output / '.changed.md.staged').write_text('half', encoding='utf-8')
+    area = StagingArea(tmp_path / 'staging')
+    _stage(area, output)
+
+    area.commit()
+
+    assert _files(output) == {'same.md': 'same', 'changed.md': 'new', 'added.md': 'added'}
+
+
+def test_refuses_a_directory_that_is_not_a_staging_tree(tmp_path, output):
+    with pytest.raises(StagingError):
+        StagingArea(output)
+    assert _files(output) == {'same.md': 'same', 'changed.md': 'old'}
+
+    # its own tree is reused, and only the exporter's directory is cleared
+    area = StagingArea(tmp_path / 'staging')
+    _stage(area, output)
+    (area.path / 'notes.txt').write_text('kept', encoding='utf-8')
+    area = StagingArea(tmp_path / 'staging')
+    assert list(area.directory('md', output).iterdir()) == []
+    assert (area.path / 'notes.txt').exists()
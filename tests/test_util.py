@@ -0,0 +1,29 @@
+import os
+import stat
+
+from apple_books_highlights.util import atomic_write_text
+
+
+def _mode(path):
+    return stat.S_IMODE(path.stat().st_mode)
+
+
+def test_atomic_write_text_uses_the_umask_for_new_files(tmp_path):
+    path = tmp_path / 'note.md'
+    umask = os.umask(0o027)
+    try:
+        atomic_write_text(path, 'text')
+    finally:
+        os.umask(umask)
+    assert path.read_text(encoding='utf-8') == 'text'
+    assert _mode(path) == 0o640
+    assert [p.name for p in tmp_path.iterdir()] == ['note.md']
+
+
+def test_atomic_write_text_keeps_the_mode_of_existing_files(tmp_path):
+    path = tmp_path / 'note.md'
+    path.write_text('old', encoding='utf-8')
+    path.chmod(0o604)
+    atomic_write_text(path, 'new')
+    assert path.read_text(encoding='utf-8') == 'new'
+    assert _mode(path) == 0o604